@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# auth: Philip J Grabner <phil@canary.md>
+# date: 2026/10/19
+# copy: (C) Copyright 2015-EOT Canary Health, Inc., All Rights Reserved.
+#------------------------------------------------------------------------------
+
+'''
+Compares the in-process `MemoryCache` with the cross-process
+`SqliteCache` pagination cache backends. Usage::
+
+  python bench/cache.py [--iterations N] [--workers N]
+
+The `--workers` option additionally measures the effective hit rate
+when N processes share a cache (as with N gunicorn workers), which
+is where the shared backend pays off.
+'''
+
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pyramid_pagination.cache import MemoryCache, SqliteCache
+
+PAGE = dict(
+  result = [dict(id=num, name='item-%d' % num) for num in range(25)],
+  page   = dict(offset=0, limit=25, count=10000, attribute='result'),
+)
+
+#------------------------------------------------------------------------------
+def bench(name, cache, iterations):
+  keys = ['view|%d' % num for num in range(100)]
+  for key in keys:
+    cache.put(key, PAGE)
+  put = timeit.timeit(
+    lambda: [cache.put(key, PAGE) for key in keys], number=iterations // 100)
+  get = timeit.timeit(
+    lambda: [cache.get(key) for key in keys], number=iterations // 100)
+  print('%-12s put: %8.1f us/op   get: %8.1f us/op' % (
+    name, put * 1e6 / iterations, get * 1e6 / iterations))
+
+#------------------------------------------------------------------------------
+def worker(args):
+  path, wid, requests = args
+  cache = MemoryCache() if path is None else SqliteCache(path)
+  for num in range(requests):
+    key = 'view|%d' % ( num % 50 )
+    if cache.get(key) is None:
+      cache.put(key, PAGE)
+  stats = cache.stats()
+  return stats['hits'], stats['misses']
+
+#------------------------------------------------------------------------------
+def hitrate(name, path, workers, requests):
+  pool = multiprocessing.Pool(workers)
+  try:
+    results = pool.map(worker, [(path, wid, requests) for wid in range(workers)])
+  finally:
+    pool.close()
+    pool.join()
+  hits   = sum(res[0] for res in results)
+  misses = sum(res[1] for res in results)
+  print('%-12s %d workers: hit rate %5.1f%% (%d misses)' % (
+    name, workers, 100.0 * hits / ( hits + misses ), misses))
+
+#------------------------------------------------------------------------------
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--iterations', type=int, default=20000)
+  parser.add_argument('--workers', type=int, default=4)
+  options = parser.parse_args()
+  tmpdir = tempfile.mkdtemp()
+  try:
+    path = os.path.join(tmpdir, 'cache.db')
+    bench('memory', MemoryCache(), options.iterations)
+    bench('sqlite', SqliteCache(path), options.iterations)
+    if options.workers:
+      hitrate('memory', None, options.workers, 200)
+      hitrate('sqlite', path + '.shared', options.workers, 200)
+  finally:
+    shutil.rmtree(tmpdir)
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+  main()
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# auth: Philip J Grabner <phil@canary.md>
+# date: 2026/10/19
+# copy: (C) Copyright 2015-EOT Canary Health, Inc., All Rights Reserved.
+#------------------------------------------------------------------------------
+
+'''
+End-to-end scaling benchmark: drives real Pyramid WSGI requests
+through `@paginate` views that are backed by in-memory lists and by
+generated SQLite tables (via `RawQuery`), sweeping the data size,
+offset depth (as a fraction of the data size), limit, and number of
+sort keys. For each combination, the throughput, p50/p99 latency, and
+the process' peak RSS are reported. Usage::
+
+  python bench/scaling.py [--backends list,sqlite] [--sizes 1000,10000]
+                          [--offsets 0,0.5,0.99] [--limits 10,100]
+                          [--sorts 1,2,3] [--requests N]
+                          [--save FILE] [--baseline FILE]
+
+Each backend and data size is run in a fresh process so that the peak
+RSS is attributable to it. Use `--save` to record a baseline and
+`--baseline` to compare a later run against it (the ``delta`` column
+is the relative change in p50 latency).
+'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pyramid.config import Configurator
+from pyramid.request import Request
+
+from pyramid_pagination import paginate, RawQuery
+
+COMPARERS = ('a', 'b', 'c')
+SORTS     = ('a', 'b-', 'c')
+
+#------------------------------------------------------------------------------
+def rows(size, seed=0):
+  rnd = random.Random(seed)
+  for num in range(size):
+    yield (
+      num, rnd.randint(0, 99), rnd.randint(0, 9999),
+      'item-%08x' % rnd.getrandbits(32))
+
+#------------------------------------------------------------------------------
+def make_app(backend, size, tmpdir):
+  pager = paginate(comparers=COMPARERS, limit_default=25)
+  if backend == 'list':
+    data = [dict(id=row[0], a=row[1], b=row[2], c=row[3]) for row in rows(size)]
+    @pager
+    def view(context, request):
+      return data
+  else:
+    path = os.path.join(tmpdir, 'scaling-%d.db' % (size,))
+    db   = sqlite3.connect(path)
+    db.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, a INTEGER, b INTEGER, c TEXT)')
+    db.executemany('INSERT INTO items VALUES (?, ?, ?, ?)', rows(size))
+    db.commit()
+    @pager
+    def view(context, request):
+      return RawQuery('SELECT id, a, b, c FROM items', (), db, nolimit='LIMIT -1')
+  # note: the paginated wrapper accepts `*args`, so pyramid calls it
+  #       with `(context, request)`
+  config = Configurator()
+  config.add_route('items', '/items')
+  config.add_view(view, route_name='items', renderer='json')
+  return config.make_wsgi_app()
+
+#------------------------------------------------------------------------------
+def peak_rss():
+  ret = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # note: linux reports kilobytes, macOS reports bytes
+  return ret if sys.platform == 'darwin' else ret * 1024
+
+#------------------------------------------------------------------------------
+def percentile(values, pct):
+  return values[min(len(values) - 1, int(len(values) * pct))]
+
+#------------------------------------------------------------------------------
+def run_case(app, size, offset, limit, nsorts, requests):
+  url = '/items?page.offset=%d&page.limit=%d&page.sort=%s' % (
+    int(size * offset), limit, ','.join(SORTS[:nsorts]))
+  times = []
+  for num in range(requests):
+    start = timeit.default_timer()
+    response = Request.blank(url).get_response(app)
+    times.append(timeit.default_timer() - start)
+    if response.status_int != 200:
+      raise RuntimeError('%s: %s' % (url, response.status))
+  times.sort()
+  return dict(
+    offset     = offset,
+    limit      = limit,
+    sorts      = nsorts,
+    throughput = len(times) / sum(times),
+    p50_ms     = percentile(times, 0.50) * 1000,
+    p99_ms     = percentile(times, 0.99) * 1000,
+    rss_mb     = peak_rss() / 1048576.0,
+  )
+
+#------------------------------------------------------------------------------
+def run_size(args):
+  backend, size, options = args
+  tmpdir = tempfile.mkdtemp()
+  try:
+    app = make_app(backend, size, tmpdir)
+    ret = []
+    for offset in options['offsets']:
+      for limit in options['limits']:
+        for nsorts in options['sorts']:
+          result = run_case(app, size, offset, limit, nsorts, options['requests'])
+          result.update(backend=backend, size=size)
+          ret.append(result)
+    return ret
+  finally:
+    shutil.rmtree(tmpdir)
+
+#------------------------------------------------------------------------------
+def case_key(result):
+  return (result['backend'], result['size'], result['offset'],
+          result['limit'], result['sorts'])
+
+#------------------------------------------------------------------------------
+def report(results, baseline):
+  base = dict((case_key(result), result) for result in baseline or ())
+  print('%-7s %9s %7s %6s %5s %10s %10s %10s %9s %8s' % (
+    'backend', 'size', 'offset', 'limit', 'sorts',
+    'req/s', 'p50 ms', 'p99 ms', 'rss MB', 'delta'))
+  for result in results:
+    prev  = base.get(case_key(result))
+    delta = '%+7.1f%%' % ( 100.0 * ( result['p50_ms'] / prev['p50_ms'] - 1 ),) \
+      if prev and prev['p50_ms'] else ''
+    print('%-7s %9d %7.2f %6d %5d %10.1f %10.2f %10.2f %9.1f %8s' % (
+      result['backend'], result['size'], result['offset'], result['limit'],
+      result['sorts'], result['throughput'], result['p50_ms'],
+      result['p99_ms'], result['rss_mb'], delta))
+
+#------------------------------------------------------------------------------
+def main():
+  parse = lambda conv: lambda value: [conv(val) for val in value.split(',')]
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--backends', type=parse(str), default=['list', 'sqlite'])
+  parser.add_argument('--sizes', type=parse(int), default=[1000, 10000, 100000])
+  parser.add_argument('--offsets', type=parse(float), default=[0, 0.5, 0.99])
+  parser.add_argument('--limits', type=parse(int), default=[10, 100])
+  parser.add_argument('--sorts', type=parse(int), default=[1, 2, 3])
+  parser.add_argument('--requests', type=int, default=20)
+  parser.add_argument('--save', metavar='FILE')
+  parser.add_argument('--baseline', metavar='FILE')
+  options = parser.parse_args()
+  baseline = None
+  if options.baseline:
+    with open(options.baseline) as fp:
+      baseline = json.load(fp)
+  params  = dict(
+    offsets=options.offsets, limits=options.limits,
+    sorts=options.sorts, requests=options.requests)
+  results = []
+  for backend in options.backends:
+    for size in options.sizes:
+      pool = multiprocessing.Pool(1)
+      try:
+        results.extend(pool.apply(run_size, ((backend, size, params),)))
+      finally:
+        pool.close()
+        pool.join()
+  report(results, baseline)
+  if options.save:
+    with open(options.save, 'w') as fp:
+      json.dump(results, fp, indent=2, sort_keys=True)
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+  main()
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# auth: Philip J Grabner <phil@canary.md>
+# date: 2026/10/19
+# copy: (C) Copyright 2015-EOT Canary Health, Inc., All Rights Reserved.
+#------------------------------------------------------------------------------
+
+'''
+Compares the allocation and attribute access cost (and memory size)
+of the slotted `PaginationState` with the previously used `aadict`
+pagination state. Usage::
+
+  python bench/state.py [--iterations N]
+'''
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aadict import aadict
+from pyramid_pagination.state import PaginationState
+
+DECODED = dict(offset=50, limit=25, sort=[('name', True)])
+
+#------------------------------------------------------------------------------
+def create(klass):
+  def _create():
+    ret = klass(paginator=None, request=None)
+    ret.update(DECODED)
+    return ret
+  return _create
+
+#------------------------------------------------------------------------------
+def access(state):
+  def _access():
+    return state.offset + state.limit + state.offset + state.limit
+  return _access
+
+#------------------------------------------------------------------------------
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--iterations', type=int, default=200000)
+  options = parser.parse_args()
+  for name, klass in (('aadict', aadict), ('PaginationState', PaginationState)):
+    state = create(klass)()
+    alloc = timeit.timeit(create(klass), number=options.iterations)
+    read  = timeit.timeit(access(state), number=options.iterations)
+    print('%-16s create+update: %6.3f us   4x access: %6.3f us   size: %4d bytes' % (
+      name,
+      alloc * 1e6 / options.iterations,
+      read * 1e6 / options.iterations,
+      sys.getsizeof(state)))
+
+#------------------------------------------------------------------------------
+if __name__ == '__main__':
+  main()
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------
@@ -9,7 +9,14 @@
 from .decoder import *
 from .mapper import *
 from .engine import *
+from .state import *
 from .paginator import *
+from .stream import *
+from .cache import *
+from .collection import *
+from .profiling import *
+from .telemetry import *
+from .deriver import *
 
 #------------------------------------------------------------------------------
 # end of $Id$
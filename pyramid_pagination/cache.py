@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# auth: Philip J Grabner <phil@canary.md>
+# date: 2026/10/19
+# copy: (C) Copyright 2015-EOT Canary Health, Inc., All Rights Reserved.
+#------------------------------------------------------------------------------
+
+import abc
+from collections import OrderedDict
+import os
+import sqlite3
+import threading
+import time
+
+import six
+from six.moves import cPickle as pickle
+
+__all__ = ('Cache', 'MemoryCache', 'SqliteCache')
+
+#------------------------------------------------------------------------------
+@six.add_metaclass(abc.ABCMeta)
+class Cache(object):
+  '''
+  The abstract interface of pagination cache backends, which are used
+  to cache paginated output (see the paginator's `cache` option) and
+  result set counts (see the engine's `count_cache` option). Backends
+  must implement all of the methods below. Keys are strings and values
+  must be picklable. Note that ``None`` cannot be cached, since it is
+  what `get` returns on a cache miss.
+  '''
+
+  #----------------------------------------------------------------------------
+  @abc.abstractmethod
+  def get(self, key):
+    '''
+    Returns the value cached for `key`, or ``None`` if there is no
+    such (unexpired) entry.
+    '''
+    raise NotImplementedError()
+
+  #----------------------------------------------------------------------------
+  @abc.abstractmethod
+  def put(self, key, value, ttl=None, tags=()):
+    '''
+    Stores `value` under `key` for `ttl` seconds (defaulting to the
+    cache's `ttl`; ``0`` means no expiry), and associates it with the
+    specified invalidation `tags`.
+    '''
+    raise NotImplementedError()
+
+  #----------------------------------------------------------------------------
+  @abc.abstractmethod
+  def invalidate(self, tag):
+    '''
+    Removes all entries associated with `tag`.
+    '''
+    raise NotImplementedError()
+
+  #----------------------------------------------------------------------------
+  @abc.abstractmethod
+  def clear(self):
+    '''
+    Removes all entries.
+    '''
+    raise NotImplementedError()
+
+  #----------------------------------------------------------------------------
+  @abc.abstractmethod
+  def stats(self):
+    '''
+    Returns a dict of cache statistics, namely the number of `hits`,
+    `misses`, `expirations`, `evictions`, and the current `size`.
+    '''
+    raise NotImplementedError()
+
+
+#------------------------------------------------------------------------------
+class MemoryCache(Cache):
+  '''
+  An in-process, thread-safe cache with per-entry time-to-live (`ttl`,
+  in seconds), least-recently-used eviction once `maxsize` entries are
+  reached, and tag-based invalidation.
+  '''
+
+  #----------------------------------------------------------------------------
+  def __init__(self, ttl=60, maxsize=1024, clock=time.time, *args, **kw):
+    super(MemoryCache, self).__init__(*args, **kw)
+    self.ttl       = ttl
+    self.maxsize   = maxsize
+    self.clock     = clock
+    self._lock     = threading.Lock()
+    self._entries  = OrderedDict()
+    self._tags     = dict()
+    self._stats    = dict(hits=0, misses=0, expirations=0, evictions=0)
+
+  #----------------------------------------------------------------------------
+  def get(self, key):
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is None:
+        self._stats['misses'] += 1
+        return None
+      if entry[0] is not None and entry[0] <= self.clock():
+        self._remove(key, entry)
+        self._stats['expirations'] += 1
+        self._stats['misses'] += 1
+        return None
+      # re-insert to mark as most recently used
+      self._entries[key] = entry
+      self._stats['hits'] += 1
+      return entry[1]
+
+  #----------------------------------------------------------------------------
+  def put(self, key, value, ttl=None, tags=()):
+    ttl = self.ttl if ttl is None else ttl
+    expires = self.clock() + ttl if ttl else None
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is not None:
+        self._remove(key, entry)
+      while self.maxsize and len(self._entries) >= self.maxsize:
+        oldkey = next(iter(self._entries))
+        self._remove(oldkey, self._entries.pop(oldkey))
+        self._stats['evictions'] += 1
+      self._entries[key] = (expires, value, tuple(tags))
+      for tag in tags:
+        self._tags.setdefault(tag, set()).add(key)
+
+  #----------------------------------------------------------------------------
+  def invalidate(self, tag):
+    with self._lock:
+      for key in self._tags.pop(tag, ()):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+          self._remove(key, entry)
+
+  #----------------------------------------------------------------------------
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._tags.clear()
+
+  #----------------------------------------------------------------------------
+  def stats(self):
+    with self._lock:
+      ret = dict(self._stats)
+      ret['size'] = len(self._entries)
+      return ret
+
+  #----------------------------------------------------------------------------
+  def _remove(self, key, entry):
+    # note: the caller must hold the lock and have removed `key` from
+    #       `self._entries` already
+    for tag in entry[2]:
+      keys = self._tags.get(tag)
+      if keys is not None:
+        keys.discard(key)
+        if not keys:
+          del self._tags[tag]
+
+
+#------------------------------------------------------------------------------
+class SqliteCache(Cache):
+  '''
+  A cache that is stored in the SQLite database file `path` and can
+  therefore be shared by all processes (e.g. all gunicorn workers) on
+  a host without requiring an external service. Writes are atomic
+  (each is a single transaction) and entries expire after `ttl`
+  seconds. Once more than `maxsize` entries are stored, the entries
+  closest to expiry are evicted. Note that the `hits`, `misses`,
+  `expirations`, and `evictions` statistics are per-process.
+  '''
+
+  #----------------------------------------------------------------------------
+  def __init__(self, path, ttl=60, maxsize=None, timeout=5.0,
+               clock=time.time, *args, **kw):
+    super(SqliteCache, self).__init__(*args, **kw)
+    self.path      = path
+    self.ttl       = ttl
+    self.maxsize   = maxsize
+    self.timeout   = timeout
+    self.clock     = clock
+    self._local    = threading.local()
+    self._lock     = threading.Lock()
+    self._stats    = dict(hits=0, misses=0, expirations=0, evictions=0)
+    with self._connect() as db:
+      db.execute(
+        'CREATE TABLE IF NOT EXISTS p8n_cache'
+        ' (key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+      db.execute(
+        'CREATE TABLE IF NOT EXISTS p8n_cache_tag'
+        ' (tag TEXT, key TEXT, PRIMARY KEY (tag, key))')
+      db.execute(
+        'CREATE INDEX IF NOT EXISTS p8n_cache_tag_key ON p8n_cache_tag (key)')
+
+  #----------------------------------------------------------------------------
+  def _connect(self):
+    # note: sqlite connections must not be shared across threads or
+    #       forked processes, hence the per-thread, per-pid connection
+    db = getattr(self._local, 'db', None)
+    if db is None or self._local.pid != os.getpid():
+      db = sqlite3.connect(self.path, timeout=self.timeout)
+      db.execute('PRAGMA journal_mode=WAL')
+      db.execute('PRAGMA synchronous=NORMAL')
+      self._local.db  = db
+      self._local.pid = os.getpid()
+    return db
+
+  #----------------------------------------------------------------------------
+  def _count(self, stat, value=1):
+    with self._lock:
+      self._stats[stat] += value
+
+  #----------------------------------------------------------------------------
+  def get(self, key):
+    db  = self._connect()
+    row = db.execute(
+      'SELECT value, expires FROM p8n_cache WHERE key = ?', (key,)).fetchone()
+    if row is None:
+      self._count('misses')
+      return None
+    if row[1] is not None and row[1] <= self.clock():
+      with db:
+        db.execute(
+          'DELETE FROM p8n_cache WHERE key = ? AND expires = ?', (key, row[1]))
+        db.execute('DELETE FROM p8n_cache_tag WHERE key = ?', (key,))
+      self._count('expirations')
+      self._count('misses')
+      return None
+    self._count('hits')
+    return pickle.loads(bytes(row[0]))
+
+  #----------------------------------------------------------------------------
+  def put(self, key, value, ttl=None, tags=()):
+    ttl     = self.ttl if ttl is None else ttl
+    now     = self.clock()
+    expires = now + ttl if ttl else None
+    value   = sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    db      = self._connect()
+    with db:
+      db.execute('DELETE FROM p8n_cache_tag WHERE key = ?', (key,))
+      db.execute(
+        'INSERT OR REPLACE INTO p8n_cache (key, value, expires) VALUES (?, ?, ?)',
+        (key, value, expires))
+      db.executemany(
+        'INSERT OR IGNORE INTO p8n_cache_tag (tag, key) VALUES (?, ?)',
+        [(tag, key) for tag in tags])
+      if not self.maxsize:
+        return
+      size = db.execute('SELECT COUNT(*) FROM p8n_cache').fetchone()[0]
+      if size <= self.maxsize:
+        return
+      db.execute('DELETE FROM p8n_cache WHERE expires <= ?', (now,))
+      size = db.execute('SELECT COUNT(*) FROM p8n_cache').fetchone()[0]
+      if size > self.maxsize:
+        evict = size - self.maxsize
+        # note: entries without expiry are evicted last
+        db.execute(
+          'DELETE FROM p8n_cache WHERE key IN ('
+          ' SELECT key FROM p8n_cache WHERE key != ?'
+          ' ORDER BY expires IS NULL, expires LIMIT ?)', (key, evict))
+        self._count('evictions', evict)
+      db.execute(
+        'DELETE FROM p8n_cache_tag WHERE key NOT IN (SELECT key FROM p8n_cache)')
+
+  #----------------------------------------------------------------------------
+  def invalidate(self, tag):
+    db = self._connect()
+    with db:
+      db.execute(
+        'DELETE FROM p8n_cache WHERE key IN'
+        ' (SELECT key FROM p8n_cache_tag WHERE tag = ?)', (tag,))
+      db.execute(
+        'DELETE FROM p8n_cache_tag WHERE key IN'
+        ' (SELECT key FROM p8n_cache_tag WHERE tag = ?)', (tag,))
+
+  #----------------------------------------------------------------------------
+  def clear(self):
+    db = self._connect()
+    with db:
+      db.execute('DELETE FROM p8n_cache')
+      db.execute('DELETE FROM p8n_cache_tag')
+
+  #----------------------------------------------------------------------------
+  def stats(self):
+    size = self._connect().execute(
+      'SELECT COUNT(*) FROM p8n_cache').fetchone()[0]
+    with self._lock:
+      ret = dict(self._stats)
+    ret['size'] = size
+    return ret
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------
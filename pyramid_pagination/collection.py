@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# auth: Philip J Grabner <phil@canary.md>
+# date: 2026/10/19
+# copy: (C) Copyright 2015-EOT Canary Health, Inc., All Rights Reserved.
+#------------------------------------------------------------------------------
+
+import bisect
+from collections import OrderedDict
+import itertools
+import threading
+
+__all__ = ('SortedCollection', 'Dataset')
+
+#------------------------------------------------------------------------------
+class _Key(object):
+  # note: orders by `cmp` first and then by insertion sequence (so
+  #       that ties are kept in insertion order), calling `cmp` only
+  #       once per comparison
+  __slots__ = ('cmp', 'item', 'seq')
+  def __init__(self, cmp, item, seq):
+    self.cmp  = cmp
+    self.item = item
+    self.seq  = seq
+  def __lt__(self, other):
+    ret = self.cmp(self.item, other.item)
+    if ret != 0:
+      return ret < 0
+    return self.seq < other.seq
+
+#------------------------------------------------------------------------------
+class _Ordering(object):
+  '''
+  One sorted view of a :class:`SortedCollection`. The `keys` list holds
+  the sort keys in sorted order and the `items` list holds the
+  corresponding items.
+  '''
+  def __init__(self, cmp, entries):
+    self.cmp   = cmp
+    self.keys  = sorted(_Key(cmp, item, seq) for seq, item in entries)
+    self.items = [key.item for key in self.keys]
+  def add(self, seq, item):
+    key = _Key(self.cmp, item, seq)
+    idx = bisect.bisect_right(self.keys, key)
+    self.keys.insert(idx, key)
+    self.items.insert(idx, item)
+  def remove(self, seq, item):
+    idx = bisect.bisect_left(self.keys, _Key(self.cmp, item, seq))
+    del self.keys[idx]
+    del self.items[idx]
+  def find(self, item):
+    lo  = bisect.bisect_left(self.keys, _Key(self.cmp, item, -1))
+    hi  = bisect.bisect_right(self.keys, _Key(self.cmp, item, float('inf')))
+    for idx in range(lo, hi):
+      if self.items[idx] is item:
+        return self.keys[idx].seq
+    for idx in range(lo, hi):
+      if self.items[idx] == item:
+        return self.keys[idx].seq
+    return None
+
+
+#------------------------------------------------------------------------------
+class SortedCollection(object):
+  '''
+  An in-memory collection that is intended for long-lived, mostly-read
+  result sets. It keeps one sorted ordering per sort specification
+  that has been requested, and maintains these orderings under
+  :meth:`add` and :meth:`remove`, so that the `Engine` can answer page
+  requests by slicing, i.e. without sorting at request time. Each
+  update locates its position in each ordering by binary search, i.e.
+  with O(log n) comparisons, but then inserts into or deletes from a
+  list, which moves O(n) pointers per ordering (a fast memmove, but
+  still linear). Orderings are created on first use, and only the
+  `max_orderings` most recently used ones are kept (each update costs
+  one such insert or delete per ordering).
+
+  Since the orderings are cached across requests, the comparers used
+  to paginate a `SortedCollection` must not depend on the pagination
+  state, and the items must not be modified in a way that changes
+  their ordering while they are in the collection (remove and re-add
+  them instead). Items that compare equal are kept in insertion order.
+  '''
+
+  #----------------------------------------------------------------------------
+  def __init__(self, items=(), max_orderings=16):
+    self.max_orderings = max_orderings
+    self._lock      = threading.Lock()
+    self._seq       = itertools.count()
+    self._entries   = OrderedDict()
+    self._orderings = OrderedDict()
+    self.update(items)
+
+  #----------------------------------------------------------------------------
+  def __len__(self):
+    return len(self._entries)
+
+  #----------------------------------------------------------------------------
+  def __iter__(self):
+    # note: iterates over a snapshot, in insertion order
+    with self._lock:
+      return iter(list(self._entries.values()))
+
+  #----------------------------------------------------------------------------
+  def add(self, item):
+    with self._lock:
+      seq = next(self._seq)
+      self._entries[seq] = item
+      for ordering in self._orderings.values():
+        ordering.add(seq, item)
+
+  #----------------------------------------------------------------------------
+  def update(self, items):
+    for item in items:
+      self.add(item)
+
+  #----------------------------------------------------------------------------
+  def remove(self, item):
+    '''
+    Removes `item` (preferably by identity, otherwise by equality) from
+    the collection. Raises a ValueError if it is not in the collection.
+    '''
+    with self._lock:
+      seq = self._find(item)
+      if seq is None:
+        raise ValueError('item not in collection')
+      del self._entries[seq]
+      for ordering in self._orderings.values():
+        ordering.remove(seq, item)
+
+  #----------------------------------------------------------------------------
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._orderings.clear()
+
+  #----------------------------------------------------------------------------
+  def _find(self, item):
+    for ordering in self._orderings.values():
+      return ordering.find(item)
+    for seq, entry in self._entries.items():
+      if entry is item:
+        return seq
+    for seq, entry in self._entries.items():
+      if entry == item:
+        return seq
+    return None
+
+  #----------------------------------------------------------------------------
+  def slice(self, key, comparator, start, stop=None):
+    '''
+    Returns the list of items from `start` to `stop` of the ordering
+    defined by the ``cmp``-style `comparator` function, which must be
+    identified by the hashable `key`. The ordering is created on first
+    use and maintained from then on, until it is evicted as the least
+    recently used one.
+    '''
+    with self._lock:
+      ordering = self._orderings.pop(key, None)
+      if ordering is None:
+        ordering = _Ordering(comparator, self._entries.items())
+      self._orderings[key] = ordering
+      while len(self._orderings) > self.max_orderings:
+        self._orderings.popitem(last=False)
+      return ordering.items[start:stop]
+
+
+#------------------------------------------------------------------------------
+class Dataset(object):
+  '''
+  An immutable result set with precomputed sort orders, as returned by
+  :meth:`Engine.register` (or :meth:`Paginator.register`). The `items`
+  are stored as a tuple and `orders` maps each comparer name to a
+  three-element tuple of ``(comparer, ascending, descending)``, where
+  the latter two are ``array('I')`` permutations of item indexes.
+  '''
+
+  #----------------------------------------------------------------------------
+  def __init__(self, items, orders):
+    self.items  = items
+    self.orders = orders
+
+  #----------------------------------------------------------------------------
+  def __len__(self):
+    return len(self.items)
+
+  #----------------------------------------------------------------------------
+  def __iter__(self):
+    return iter(self.items)
+
+  #----------------------------------------------------------------------------
+  @property
+  def nbytes(self):
+    '''
+    The number of bytes used by the precomputed permutations.
+    '''
+    return sum(
+      perm.itemsize * len(perm)
+      for order in self.orders.values()
+      for perm in order[1:])
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------
@@ -6,9 +6,14 @@
 # copy: (C) Copyright 2015-EOT Canary Health, Inc., All Rights Reserved.
 #------------------------------------------------------------------------------
 
-import formencode
-from formencode import validators
+from collections import OrderedDict
+
 import morph
+try:
+  import formencode
+  import formencode.validators
+except ImportError:
+  formencode = None
 
 #------------------------------------------------------------------------------
 class _SmartSort(object):
@@ -18,20 +23,107 @@ class _SmartSort(object):
 SmartSort = _SmartSort()
 
 #------------------------------------------------------------------------------
-class RenameFields(formencode.validators.FormValidator):
-  def __init__(self, name_map, *args, **kw):
-    formencode.validators.FormValidator.__init__(
-      self, name_map=name_map, *args, **kw)
-  def _to_python(self, value, state):
-    return self.keymap(value, self.name_map)
-  def _from_python(self, value, state):
-    return self.keymap(value, {v: k for k, v in self.nmap})
-  def keymap(self, value, nmap):
-    return {nmap[k] if k in nmap else k: v for k, v in value.items()}
+class DecodeError(ValueError):
+  '''
+  The exception raised for invalid pagination parameters if the
+  `formencode` package is not installed (otherwise, a
+  `formencode.api.Invalid` exception is raised). It has the same
+  `msg`, `value`, `state`, and `error_dict` attributes.
+  '''
+  def __init__(self, msg, value, state=None, error_list=None, error_dict=None):
+    super(DecodeError, self).__init__(msg)
+    self.msg        = msg
+    self.value      = value
+    self.state      = state
+    self.error_list = error_list
+    self.error_dict = error_dict
+  def __str__(self):
+    return self.msg
+
+def Invalid(*args, **kw):
+  '''
+  Returns a `formencode.api.Invalid` exception if the `formencode`
+  package is installed, otherwise a :class:`DecodeError`.
+  '''
+  return InvalidType()(*args, **kw)
+def InvalidType():
+  if formencode is None:
+    return DecodeError
+  return formencode.api.Invalid
+
+#------------------------------------------------------------------------------
+def is_empty(value):
+  return value is None or value == '' \
+    or ( isinstance(value, (list, tuple, dict)) and len(value) == 0 )
+
+#------------------------------------------------------------------------------
+if formencode is not None:
+
+  _Validator = formencode.validators.FancyValidator
+
+  #----------------------------------------------------------------------------
+  class RenameFields(formencode.validators.FormValidator):
+    def __init__(self, name_map, *args, **kw):
+      formencode.validators.FormValidator.__init__(
+        self, name_map=name_map, *args, **kw)
+    def _convert_to_python(self, value, state):
+      return self.keymap(value, self.name_map)
+    def _convert_from_python(self, value, state):
+      return self.keymap(
+        value, dict((v, k) for k, v in self.name_map.items()))
+    def keymap(self, value, nmap):
+      return dict(
+        (nmap[k] if k in nmap else k, v) for k, v in value.items())
+
+else:
+
+  #----------------------------------------------------------------------------
+  class _Validator(object):
+    # a minimal stand-in for `formencode.validators.FancyValidator`
+    messages   = {}
+    if_missing = None
+    if_empty   = None
+    def __init__(self, **kw):
+      for key, value in kw.items():
+        setattr(self, key, value)
+    def message(self, name, state, **kw):
+      return self.messages[name] % kw
+    def to_python(self, value, state=None):
+      if is_empty(value):
+        return self.if_empty
+      return self._convert_to_python(value, state)
+
+#------------------------------------------------------------------------------
+class IntValidator(object):
+  messages = {
+    'integer'    : 'Please enter an integer value',
+    'tooLow'     : 'Please enter a number that is %(min)s or greater',
+    'tooHigh'    : 'Please enter a number that is %(max)s or smaller',
+    'range'      : 'Please enter a number from %(min)s to %(max)s',
+  }
+  def __init__(self, min=None, max=None, if_missing=None, if_empty=None):
+    self.min        = min
+    self.max        = max
+    self.if_missing = if_missing
+    self.if_empty   = if_empty
+  def message(self, name, state, **kw):
+    return self.messages[name] % kw
+  def to_python(self, value, state=None):
+    if is_empty(value):
+      return self.if_empty
+    try:
+      ret = int(value)
+    except (TypeError, ValueError):
+      raise Invalid(self.message('integer', state), value, state)
+    if self.min is not None and ret < self.min:
+      raise Invalid(self.message('tooLow', state, min=self.min), value, state)
+    if self.max is not None and ret > self.max:
+      raise Invalid(self.message('tooHigh', state, max=self.max), value, state)
+    return ret
 
 
 #------------------------------------------------------------------------------
-class SortValidator(formencode.validators.FancyValidator):
+class SortValidator(_Validator):
   messages = {
     'bad_type'   : 'Please specify a string or list of strings',
     'bad_method' : 'Invalid sorting method "%(method)s"',
@@ -39,12 +131,13 @@ class SortValidator(formencode.validators.FancyValidator):
                      ' list of strings, '
                      ' or list of (string, bool) tuples' ),
   }
-  def _to_python(self, value, state):
+  if_missing = ()
+  if_empty   = ()
+  def _convert_to_python(self, value, state):
     try:
       return self.decode(value)
     except:
-      raise formencode.api.Invalid(
-        self.message('bad_type', state), value, state)
+      raise Invalid(self.message('bad_type', state), value, state)
   @staticmethod
   def decode(spec):
     if spec is None:
@@ -85,6 +178,84 @@ class SortValidator(formencode.validators.FancyValidator):
       if spec[0]])
 
 
+#------------------------------------------------------------------------------
+class FilterValidator(object):
+  OPERATORS = ('eq', 'in', 'range', 'prefix')
+  messages = {
+    'bad_filter'   : 'Invalid filter "%(filter)s"',
+    'bad_operator' : 'Invalid filter operator "%(op)s"',
+    'bad_value'    : 'Invalid filter value',
+    'bad_range'    : 'Please specify a range as "MIN,MAX"',
+  }
+  def message(self, name, state, **kw):
+    return self.messages[name] % kw
+  @staticmethod
+  def split(values):
+    ret = []
+    for value in values:
+      if morph.isstr(value):
+        ret.extend(val.strip() for val in value.split(','))
+      else:
+        ret.append(value)
+    return ret
+  def to_python(self, op, values, convert=None):
+    '''
+    Converts the list of raw request `values` of a filter with
+    operator `op` into the filter argument, i.e. a scalar for ``eq``
+    and ``prefix``, a tuple for ``in``, and a ``(min, max)`` tuple
+    (where either may be ``None``) for ``range``. Raises a ValueError
+    with the message name on failure.
+    '''
+    convert = convert or ( lambda value: value )
+    if op == 'in':
+      return tuple(convert(value) for value in self.split(values) if value != '')
+    if op == 'range':
+      values = self.split(values)
+      if len(values) != 2:
+        raise ValueError('bad_range')
+      return tuple(
+        convert(value) if value not in ('', None) else None
+        for value in values)
+    if len(values) != 1:
+      raise ValueError('bad_value')
+    if op == 'prefix':
+      if not morph.isstr(values[0]):
+        raise ValueError('bad_value')
+      return values[0]
+    return convert(values[0])
+
+
+#------------------------------------------------------------------------------
+class FieldsValidator(object):
+  messages = {
+    'bad_type'   : 'Please specify a string or list of strings',
+    'bad_field'  : 'Invalid field "%(field)s"',
+  }
+  def message(self, name, state, **kw):
+    return self.messages[name] % kw
+  @staticmethod
+  def decode(values):
+    '''
+    Converts the list of raw request `values` (each of which may be a
+    comma-separated string) into a tuple of field names with
+    duplicates removed, or ``None`` if no fields were specified.
+    Raises a ValueError for non-string values.
+    '''
+    ret = []
+    for value in values:
+      if morph.isstr(value):
+        value = value.split(',')
+      if not morph.isseq(value):
+        raise ValueError(FieldsValidator.messages['bad_type'])
+      for field in value:
+        if not morph.isstr(field):
+          raise ValueError(FieldsValidator.messages['bad_type'])
+        field = field.strip()
+        if field and field not in ret:
+          ret.append(field)
+    return tuple(ret) or None
+
+
 #------------------------------------------------------------------------------
 class Decoder(object):
   '''
@@ -108,13 +279,147 @@ class Decoder(object):
 
   #----------------------------------------------------------------------------
   def decode(self, p8n):
-    if not getattr(p8n.paginator, 'schema', None):
-      p8n.paginator.schema = self.make_schema(p8n)
-    ret = p8n.paginator.schema.to_python(
-      dict(getattr(p8n.request, self.params)))
+    ret = p8n.paginator.schema.to_python(getattr(p8n.request, self.params))
+    ret = self.validate_limits(p8n, self.validate_sort(p8n, ret))
+    if p8n.paginator.engine.filters:
+      ret['filter'] = self.decode_filters(p8n)
+    if p8n.paginator.engine.fields:
+      ret['fields'] = self.decode_fields(p8n)
+    return ret
+
+  #----------------------------------------------------------------------------
+  def fingerprint(self, p8n):
+    '''
+    Returns a string that identifies the raw (i.e. undecoded)
+    pagination parameters of the current request, which is cheap to
+    compute and can therefore be used as a cache key.
+    '''
+    params = getattr(p8n.request, self.params)
+    if p8n.paginator.page_name is not None and self.structured:
+      page = params.get(p8n.paginator.page_name) or {}
+      return repr(sorted(page.items()))
+    ret = repr([
+      params.get(self.param_name(p8n, name))
+      for name in (
+        p8n.paginator.offset_name,
+        p8n.paginator.limit_name,
+        p8n.paginator.sort_name)])
+    if p8n.paginator.engine.filters:
+      ret += repr(sorted(self.filter_params(p8n)))
+    if p8n.paginator.engine.fields:
+      ret += repr(self.fields_params(p8n))
+    return ret
+
+  #----------------------------------------------------------------------------
+  def fields_params(self, p8n):
+    '''
+    Returns the list of raw `fields` parameter values of the current
+    request.
+    '''
+    params = getattr(p8n.request, self.params)
+    if p8n.paginator.page_name is not None and self.structured:
+      params = params.get(p8n.paginator.page_name) or {}
+      if not morph.isdict(params):
+        return []
+    key = self.param_name(p8n, p8n.paginator.fields_name)
+    if hasattr(params, 'getall'):
+      return params.getall(key)
+    if key not in params:
+      return []
+    return [params[key]]
+
+  #----------------------------------------------------------------------------
+  def decode_fields(self, p8n):
+    '''
+    Decodes the `fields` parameter of the current request and validates
+    it against the engine's `fields` whitelist. Returns a tuple of
+    field names, or ``None`` if the request does not select fields.
+    '''
+    values    = self.fields_params(p8n)
+    validator = FieldsValidator()
+    try:
+      ret = validator.decode(values)
+    except ValueError:
+      self.invalid_param(
+        p8n, values, p8n.paginator.fields_name,
+        validator.message('bad_type', None))
+    for field in ret or ():
+      if field not in p8n.paginator.engine.fields:
+        self.invalid_param(
+          p8n, values, p8n.paginator.fields_name,
+          validator.message('bad_field', None, field=field))
+    return ret
+
+  #----------------------------------------------------------------------------
+  def filter_params(self, p8n):
+    '''
+    Returns the raw filter parameters of the current request as a list
+    of ``(name, operator, values)`` tuples, where `operator` is ``None``
+    if not specified and `values` is a list.
+    '''
+    params = getattr(p8n.request, self.params)
+    fname  = p8n.paginator.filter_name
     if p8n.paginator.page_name is not None and self.structured:
-      ret = ret.get('page')
-    return self.validate_sort(p8n, ret)
+      params = params.get(p8n.paginator.page_name) or {}
+      if not morph.isdict(params):
+        return []
+      nested = params.get(fname) or {}
+      params = dict(
+        (key, value) for key, value in params.items()
+        if key.startswith(fname + '.'))
+      if morph.isdict(nested):
+        for name, value in nested.items():
+          if morph.isdict(value):
+            for op, val in value.items():
+              params[fname + '.' + name + '.' + op] = val
+          else:
+            params[fname + '.' + name] = value
+    prefix = self.param_name(p8n, fname) + '.'
+    ret = []
+    # note: the keys of a MultiDict are repeated for repeated parameters,
+    #       whose values are all collected by `getall`
+    for key in OrderedDict.fromkeys(params.keys()):
+      if not key.startswith(prefix):
+        continue
+      name, _, op = key[len(prefix):].partition('.')
+      if hasattr(params, 'getall'):
+        values = params.getall(key)
+      else:
+        values = params[key]
+        values = list(values) if morph.isseq(values) else [values]
+      ret.append((name, op or None, values))
+    return ret
+
+  #----------------------------------------------------------------------------
+  def decode_filters(self, p8n):
+    '''
+    Decodes and validates the filter parameters of the current request
+    against the engine's `filters` and returns them as a sorted tuple
+    of ``(name, operator, argument)`` tuples (see
+    :meth:`FilterValidator.to_python`).
+    '''
+    fname     = p8n.paginator.filter_name
+    filters   = p8n.paginator.engine.filters
+    validator = FilterValidator()
+    ret       = []
+    for name, op, values in self.filter_params(p8n):
+      param = fname + '.' + name + ( '.' + op if op else '' )
+      if name not in filters:
+        self.invalid_param(
+          p8n, values, param, validator.message('bad_filter', None, filter=name))
+      op = op or 'eq'
+      if op not in validator.OPERATORS:
+        self.invalid_param(
+          p8n, values, param, validator.message('bad_operator', None, op=op))
+      spec = filters[name]
+      try:
+        arg = validator.to_python(
+          op, values, spec[1] if isinstance(spec, tuple) else None)
+      except (TypeError, ValueError) as exc:
+        msg = exc.args[0] if exc.args and exc.args[0] in validator.messages else 'bad_value'
+        self.invalid_param(p8n, values, param, validator.message(msg, None))
+      ret.append((name, op, arg))
+    return tuple(sorted(ret, key=lambda item: item[:2]))
 
   #----------------------------------------------------------------------------
   def validate_sort(self, p8n, result):
@@ -125,19 +430,51 @@ class Decoder(object):
         self.invalid_sort(p8n, result, spec[0])
     return result
 
+  #----------------------------------------------------------------------------
+  def validate_limits(self, p8n, result):
+    '''
+    Enforces the paginator's `offset_max` and `limit_max` options by
+    either clamping the offending value or rejecting the request,
+    depending on the `limit_policy` option. Note that a `limit_max`
+    also disallows unlimited (i.e. zero) limits. The configured
+    defaults are always clamped (never rejected), so that e.g. a
+    `limit_max` below the `limit_default` does not reject requests
+    that do not specify a limit.
+    '''
+    pager = p8n.paginator
+    clamp = pager.limit_policy == 'clamp'
+    if pager.offset_max is not None and result['offset'] > pager.offset_max:
+      if not clamp and result['offset'] != pager.offset_default:
+        self.invalid_param(
+          p8n, result['offset'], pager.offset_name,
+          IntValidator().message('tooHigh', None, max=pager.offset_max))
+      result['offset'] = pager.offset_max
+    if pager.limit_max \
+        and ( result['limit'] <= 0 or result['limit'] > pager.limit_max ):
+      if not clamp and result['limit'] != pager.limit_default:
+        self.invalid_param(
+          p8n, result['limit'], pager.limit_name,
+          IntValidator().message('range', None, min=1, max=pager.limit_max))
+      result['limit'] = pager.limit_max
+    return result
+
   #----------------------------------------------------------------------------
   def invalid_sort(self, p8n, result, method):
-    val = result['sort']
-    msg = SortValidator().message('bad_method', None, method=method)
-    err = dict([(self.param_name(p8n, p8n.paginator.sort_name), msg)])
-    exc = formencode.api.Invalid(
+    self.invalid_param(
+      p8n, result['sort'], p8n.paginator.sort_name,
+      SortValidator().message('bad_method', None, method=method))
+
+  #----------------------------------------------------------------------------
+  def invalid_param(self, p8n, value, param, message):
+    err = dict([(self.param_name(p8n, param), message)])
+    exc = Invalid(
       '\n'.join([k + ': ' + v for k, v in err.items()]),
-      val, None, error_dict=err)
+      value, None, error_dict=err)
     if p8n.paginator.page_name is None or not self.structured:
       raise exc
-    raise formencode.api.Invalid(
+    raise Invalid(
       self.param_name(p8n, p8n.paginator.page_name) + ': ' + exc.msg,
-      val, None, error_dict=dict([
+      value, None, error_dict=dict([
         (self.param_name(p8n, p8n.paginator.page_name), exc)]))
 
   #----------------------------------------------------------------------------
@@ -148,56 +485,87 @@ class Decoder(object):
 
   #----------------------------------------------------------------------------
   def make_schema(self, p8n):
-    decoder = self
-    class PaginationSchema(formencode.Schema):
-      filter_extra_fields = True
-      allow_extra_fields = True
-      chained_validators = [
-        RenameFields(dict((
-          (decoder.param_name(p8n, p8n.paginator.offset_name), 'offset'),
-          (decoder.param_name(p8n, p8n.paginator.limit_name),  'limit'),
-          (decoder.param_name(p8n, p8n.paginator.sort_name),   'sort'),
-        )))]
-      def __init__(self, *args, **kw):
-        super(PaginationSchema, self).__init__(*args, **kw)
-        self.add_field(
-          decoder.param_name(p8n, p8n.paginator.offset_name),
-          validators.Int(
-            min        = 0,
-            if_missing = p8n.paginator.offset_default,
-            if_empty   = p8n.paginator.offset_default))
-        self.add_field(
-          decoder.param_name(p8n, p8n.paginator.limit_name),
-          validators.Int(
-            min        = 0,
-            if_missing = p8n.paginator.limit_default,
-            if_empty   = p8n.paginator.limit_default))
-        self.add_field(
-          decoder.param_name(p8n, p8n.paginator.sort_name),
-          SortValidator(
-            if_missing = SortValidator.decode(p8n.paginator.sort_default),
-            if_empty   = SortValidator.decode('')))
-    schema = PaginationSchema()
+    '''
+    Returns the `PaginationSchema` for the paginator of `p8n`, which
+    must only depend on the paginator's options, i.e. not on the
+    request. It is built once when the paginator is created (see
+    :attr:`Paginator.schema`) and then shared by all requests.
+    '''
+    fields = (
+      (self.param_name(p8n, p8n.paginator.offset_name), 'offset',
+       IntValidator(
+         min        = 0,
+         if_missing = p8n.paginator.offset_default,
+         if_empty   = p8n.paginator.offset_default)),
+      (self.param_name(p8n, p8n.paginator.limit_name), 'limit',
+       IntValidator(
+         min        = 0,
+         if_missing = p8n.paginator.limit_default,
+         if_empty   = p8n.paginator.limit_default)),
+      (self.param_name(p8n, p8n.paginator.sort_name), 'sort',
+       SortValidator(
+         if_missing = SortValidator.decode(p8n.paginator.sort_default),
+         if_empty   = SortValidator.decode(''))),
+    )
     if p8n.paginator.page_name is not None and self.structured:
-      subschema = PaginationSchema(if_missing=None)
-      class PaginationNamespaceSchema(formencode.Schema):
-        filter_extra_fields = True
-        allow_extra_fields = True
-        chained_validators = [
-          RenameFields(dict((
-            (decoder.param_name(p8n, p8n.paginator.page_name), 'page'),
-          )))]
-        def __init__(self, *args, **kw):
-          super(PaginationNamespaceSchema, self).__init__(*args, **kw)
-          self.add_field(p8n.paginator.page_name, subschema)
-        def to_python(self, value):
-          # todo: there *must* be a more formencode'ish way of doing this...
-          ret = super(PaginationNamespaceSchema, self).to_python(value)
-          if ret.get('page', None) is None:
-            ret['page'] = subschema.to_python({})
-          return ret
-      schema = PaginationNamespaceSchema()
-    return schema
+      return PaginationSchema(fields, namespace=p8n.paginator.page_name)
+    return PaginationSchema(fields)
+
+
+#------------------------------------------------------------------------------
+class PaginationSchema(object):
+  '''
+  Converts the raw request parameters into the ``offset``, ``limit``,
+  and ``sort`` values. If `namespace` is specified, the parameters are
+  expected in a nested dict-like parameter of that name. Errors are
+  reported with the same messages and structure that the `formencode`
+  package uses.
+  '''
+
+  messages = {
+    'badDictType' : 'The input must be dict-like (not a %(type)s: %(value)r)',
+  }
+
+  #----------------------------------------------------------------------------
+  def __init__(self, fields, namespace=None):
+    self.fields    = fields
+    self.namespace = namespace
+
+  #----------------------------------------------------------------------------
+  def to_python(self, params):
+    if self.namespace is None:
+      return self.convert(params)
+    value = params.get(self.namespace)
+    try:
+      if value is None:
+        return self.convert({})
+      if not hasattr(value, 'get'):
+        raise Invalid(
+          self.messages['badDictType'] % dict(type=type(value), value=value),
+          value, None)
+      return self.convert(value)
+    except InvalidType() as exc:
+      raise Invalid(
+        self.namespace + ': ' + exc.msg, params, None,
+        error_dict={self.namespace: exc})
+
+  #----------------------------------------------------------------------------
+  def convert(self, params):
+    ret    = dict()
+    errors = dict()
+    for param, name, validator in self.fields:
+      if param not in params:
+        ret[name] = validator.if_missing
+        continue
+      try:
+        ret[name] = validator.to_python(params[param])
+      except InvalidType() as exc:
+        errors[param] = exc
+    if errors:
+      raise Invalid(
+        '\n'.join([key + ': ' + errors[key].msg for key in sorted(errors)]),
+        params, None, error_dict=errors)
+    return ret
 
 #------------------------------------------------------------------------------
 # end of $Id$
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# auth: Philip J Grabner <phil@canary.md>
+# date: 2026/10/19
+# copy: (C) Copyright 2015-EOT Canary Health, Inc., All Rights Reserved.
+#------------------------------------------------------------------------------
+
+import six
+import morph
+
+from .paginator import Paginator, paginate
+
+__all__ = ('resolve_paginator', 'paginated_view', 'includeme')
+
+#------------------------------------------------------------------------------
+def resolve_paginator(value):
+  '''
+  Returns the `Paginator` for the ``paginate`` view option `value`,
+  which can be ``True`` (the default paginator), a dict of paginator
+  options (passed to ``paginate.extend()``), or a `Paginator`.
+  '''
+  if isinstance(value, Paginator):
+    return value
+  if value is True:
+    return paginate
+  if morph.isdict(value):
+    return paginate.extend(**value)
+  raise ValueError(
+    'the "paginate" view option must be True, a dict, or a Paginator,'
+    ' not %r' % (value,))
+
+#------------------------------------------------------------------------------
+def paginated_view(view, info):
+  '''
+  A pyramid view deriver that paginates the return value of views
+  that were configured with the ``paginate`` view option (see
+  :func:`includeme`). The paginator is resolved once, when the view is
+  configured, and is available as the ``__paginator__`` attribute of
+  the derived view. For the output cache and telemetry, the view is
+  identified by the original view's name, its `attr` (for class-based
+  views), and its route name (if any), e.g.
+  ``"myapp.views.Items:12.list@items"``.
+  '''
+  value = info.options.get('paginate')
+  if value is None or value is False:
+    return view
+  pager = resolve_paginator(value)
+  @six.wraps(info.original_view, updated=())
+  def handler(context, request):
+    return view(context, request)
+  # note: the same callable may be configured as several views (e.g.
+  #       for different routes or attributes), which must not share
+  #       cached output or telemetry
+  name  = Paginator.view_name(info.original_view)
+  attr  = info.options.get('attr')
+  route = info.options.get('route_name')
+  handler.__view_name__ = name + ( '.' + attr if attr else '' ) \
+    + ( '@' + route if route else '' )
+  def paginated(context, request):
+    return pager.paginate(handler, context, request)
+  paginated.__paginator__ = pager
+  return paginated
+
+paginated_view.options = ('paginate',)
+
+#------------------------------------------------------------------------------
+def includeme(config):
+  '''
+  Registers the :func:`paginated_view` view deriver, which enables the
+  ``paginate`` view option, e.g.::
+
+    config.include('pyramid_pagination')
+    config.add_view(handler, renderer='json', paginate={'comparers': ['id']})
+
+  The deriver is placed directly around the view (i.e. under the
+  renderer), so that it sees the view's raw return value.
+  '''
+  config.add_view_deriver(
+    paginated_view, name='paginated_view',
+    under='rendered_view', over='mapped_view')
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------
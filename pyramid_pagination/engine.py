@@ -6,14 +6,177 @@
 # copy: (C) Copyright 2015-EOT Canary Health, Inc., All Rights Reserved.
 #------------------------------------------------------------------------------
 
+from array import array
 from collections import OrderedDict
+import contextlib
+import functools
+import heapq
+import itertools
+from multiprocessing.pool import ThreadPool
+import multiprocessing
+import sys
+import tempfile
+import threading
+import time
 
 import six
+from six.moves import cPickle as pickle
 import morph
-import sqlalchemy
-import sqlalchemy.orm
 
-from .decoder import SmartSort
+from .decoder import SmartSort, SortValidator
+from .collection import SortedCollection, Dataset
+
+#------------------------------------------------------------------------------
+# the compiled SQL of recently counted SQLAlchemy statements, keyed by
+# their SQLAlchemy cache key (see `Engine.statement_key`)
+_statement_sql      = OrderedDict()
+_statement_sql_lock = threading.Lock()
+_statement_sql_size = 256
+
+#------------------------------------------------------------------------------
+def _bind_name(bind, statement):
+  # returns the (password-masked) database URL of a SQLAlchemy engine,
+  # connection or session, or ``''`` if it cannot be determined
+  if hasattr(bind, 'get_bind'):
+    try:
+      bind = bind.get_bind(clause=statement)
+    except Exception:
+      return ''
+  url = getattr(getattr(bind, 'engine', None), 'url', None)
+  return repr(url) if url is not None else ''
+
+#------------------------------------------------------------------------------
+class _Task(object):
+  # runs ``func(*args)`` on a new daemon thread, which occupies one of
+  # the `slots` (a semaphore) until it completes; if none is available,
+  # the task fails immediately as if it had timed out. `get` mirrors the
+  # `AsyncResult.get` of `multiprocessing.pool`
+  def __init__(self, slots, func, *args):
+    self._done   = threading.Event()
+    self._result = None
+    self._error  = None
+    self._busy   = not slots.acquire(False)
+    if self._busy:
+      self._done.set()
+      return
+    thread = threading.Thread(target=self._run, args=(slots, func, args))
+    thread.daemon = True
+    thread.start()
+  def _run(self, slots, func, args):
+    try:
+      self._result = func(*args)
+    except Exception:
+      self._error = sys.exc_info()
+    finally:
+      slots.release()
+      self._done.set()
+  def get(self, timeout=None):
+    if self._busy or not self._done.wait(timeout):
+      raise multiprocessing.TimeoutError()
+    if self._error is not None:
+      six.reraise(*self._error)
+    return self._result
+
+#------------------------------------------------------------------------------
+class StatementTimeout(Exception):
+  '''
+  Raised when a database query exceeds the engine's `statement_timeout`.
+  The `timeout` attribute is the timeout (in seconds) that was exceeded.
+  '''
+  def __init__(self, timeout, *args, **kw):
+    super(StatementTimeout, self).__init__(
+      'statement timeout of %s seconds exceeded' % (timeout,), *args, **kw)
+    self.timeout = timeout
+
+#------------------------------------------------------------------------------
+class Statement(object):
+  '''
+  Wraps a SQLAlchemy Core selectable (e.g. a ``select()`` statement)
+  together with the connection or session that it should be executed
+  with so that it can be paginated by the `Engine`. If `mappings` is
+  truthy, the resulting rows are returned as mappings instead of
+  tuple-like Row objects.
+  '''
+  def __init__(self, statement, bind, mappings=False):
+    self.statement = statement
+    self.bind      = bind
+    self.mappings  = mappings
+
+#------------------------------------------------------------------------------
+class Presorted(object):
+  '''
+  Wraps a result set `value` (of any supported type) that is already
+  sorted by `order` (a sort specification, e.g. ``'name,id'``), so
+  that the `Engine` can skip sorting it when the requested sort order
+  is a prefix of `order`. See the paginator's `presorted` option for
+  declaring this for all result sets of a paginator.
+  '''
+  def __init__(self, value, order):
+    self.value = value
+    self.order = order
+
+#------------------------------------------------------------------------------
+class RawQuery(object):
+  '''
+  Wraps a raw SQL ``SELECT`` statement string and its parameters
+  together with the DB-API `connection` that it should be executed
+  with so that it can be paginated by the `Engine`. The ``ORDER BY``,
+  ``LIMIT`` and ``OFFSET`` clauses are appended to `sql`, which must
+  therefore not have any of its own. Rows are streamed from the
+  cursor in batches of `batch_size` via ``fetchmany()``.
+
+  Since not all databases support an ``OFFSET`` without a ``LIMIT``,
+  unlimited requests with an offset skip the leading rows client-side
+  unless `nolimit` specifies the SQL to use instead (e.g. ``'LIMIT
+  -1'`` for SQLite).
+  '''
+  def __init__(self, sql, params=(), connection=None, batch_size=100,
+               nolimit=None):
+    self.sql        = sql
+    self.params     = params
+    self.connection = connection
+    self.batch_size = batch_size
+    self.nolimit    = nolimit
+
+#------------------------------------------------------------------------------
+class MultiSource(object):
+  '''
+  Combines multiple result `sources` (e.g. the same query against
+  several databases, or lists and queries of compatible items) into a
+  single result set that can be paginated by the `Engine`. Each source
+  is sorted and narrowed to its first ``offset + limit`` items
+  independently, and the sources are then lazily merged so that only
+  the requested window is produced. The count is the sum of the
+  per-source counts. Note that the comparers must therefore be
+  applicable both to each source and to the resulting items.
+  '''
+  def __init__(self, *sources):
+    self.sources = sources
+
+#------------------------------------------------------------------------------
+class ShardedQuery(MultiSource):
+  '''
+  A :class:`MultiSource` of equivalent queries against different
+  databases (shards). Unlike a plain `MultiSource`, the count and page
+  queries of the shards are issued concurrently on the engine's
+  thread pool (see the `shard_workers` engine option). If `timeout` is
+  specified, the shards that do not respond within that many seconds
+  are considered failed and are abandoned; such queries are therefore
+  run on threads of their own instead (at most `shard_threads` at a
+  time, see the engine option), so that abandoned shards never tie up
+  the shared pool. The `partial` policy controls what happens
+  if any shard fails: ``'raise'`` re-raises the shard's exception (a
+  :class:`StatementTimeout` for timeouts) and ``'skip'`` paginates the
+  remaining shards; the indexes of the skipped shards are then stored
+  in the pagination state's ``skipped_shards`` attribute.
+  '''
+  def __init__(self, *sources, **kw):
+    super(ShardedQuery, self).__init__(*sources)
+    self.timeout = kw.pop('timeout', None)
+    self.partial = kw.pop('partial', 'raise')
+    if kw:
+      raise TypeError(
+        'unexpected keyword arguments: ' + ', '.join(sorted(kw.keys())))
 
 #------------------------------------------------------------------------------
 class Engine(object):
@@ -23,20 +186,61 @@ class Engine(object):
   '''
 
   #----------------------------------------------------------------------------
-  def __init__(self, comparers={}, *args, **kw):
+  def __init__(self, comparers={}, spill_size=None, spill_merge=16,
+               count_cache=None, count_ttl=None, count_namespace=None,
+               statement_timeout=None, shard_workers=8, shard_threads=32,
+               filters={}, fields={}, yield_per=None, max_orderings=256,
+               *args, **kw):
     super(Engine, self).__init__(*args, **kw)
-    self.comparers = OrderedDict()
-    if morph.isstr(comparers):
-      comparers = [comparers]
-    if morph.isseq(comparers) and len(comparers) > 0 \
-        and not morph.isseq(comparers[0]):
-      self.comparers.update((k, k) for k in comparers)
+    self.spill_size  = spill_size
+    self.spill_merge = spill_merge
+    self.count_cache = count_cache
+    self.count_ttl   = count_ttl
+    self.count_namespace = count_namespace
+    self.statement_timeout = statement_timeout
+    self.shard_workers = shard_workers
+    self.shard_threads = shard_threads
+    self.yield_per   = yield_per
+    self.max_orderings = max_orderings
+    self._pool       = None
+    self._pool_lock  = threading.Lock()
+    self._shard_slots = threading.Semaphore(shard_threads)
+    self.comparers   = self._registry(comparers)
+    self.filters     = self._registry(filters)
+    self.fields      = self._registry(fields)
+    self._orderings  = OrderedDict()
+    self._orderings_lock = threading.Lock()
+
+  #----------------------------------------------------------------------------
+  @staticmethod
+  def _registry(specs):
+    ret = OrderedDict()
+    if morph.isstr(specs):
+      specs = [specs]
+    if morph.isseq(specs) and len(specs) > 0 \
+        and not morph.isseq(specs[0]):
+      ret.update((k, k) for k in specs)
     else:
-      self.comparers.update(comparers)
+      ret.update(specs)
+    return ret
 
   #----------------------------------------------------------------------------
   def extend(self, *args, **kw):
-    params = dict(comparers=self.comparers)
+    params = dict(
+      comparers   = self.comparers,
+      spill_size  = self.spill_size,
+      spill_merge = self.spill_merge,
+      count_cache = self.count_cache,
+      count_ttl   = self.count_ttl,
+      count_namespace = self.count_namespace,
+      statement_timeout = self.statement_timeout,
+      shard_workers = self.shard_workers,
+      shard_threads = self.shard_threads,
+      filters     = self.filters,
+      fields      = self.fields,
+      yield_per   = self.yield_per,
+      max_orderings = self.max_orderings,
+    )
     for arg in args:
       params.update(arg)
     params.update(kw)
@@ -47,12 +251,42 @@ class Engine(object):
     '''
     Returns a two-element tuple of ``(narrowed_value, page_attributes)``.
     '''
-    if isinstance(result, sqlalchemy.orm.Query):
+    # note: `sqlalchemy` is only imported on demand; if it has not been
+    #       imported yet, `result` cannot be a SQLAlchemy query
+    if 'sqlalchemy.orm' in sys.modules \
+        and isinstance(result, sys.modules['sqlalchemy.orm'].Query):
       return self.apply_sqlalchemy_orm_query_query(p8n, result)
+    if isinstance(result, Presorted):
+      previous = p8n.get('presorted')
+      p8n.presorted = result.order
+      try:
+        return self.apply(p8n, result.value)
+      finally:
+        p8n.presorted = previous
+    if isinstance(result, Statement):
+      return self.apply_sqlalchemy_statement(p8n, result)
+    if isinstance(result, RawQuery):
+      return self.apply_dbapi_query(p8n, result)
+    if isinstance(result, ShardedQuery):
+      return self.apply_sharded_query(p8n, result)
+    if isinstance(result, MultiSource):
+      return self.apply_multi_source(p8n, result)
+    if isinstance(result, Dataset):
+      return self.apply_dataset(p8n, result)
+    if isinstance(result, SortedCollection):
+      return self.apply_sorted_collection(p8n, result)
     if isinstance(result, (list, tuple)):
       return self.apply_list(p8n, result)
+    if hasattr(result, '__iter__') \
+        and not morph.isstr(result) and not morph.isdict(result):
+      if self.is_presorted(p8n):
+        return self.apply_iterable_window(p8n, result)
+      if self.spill_size:
+        return self.apply_iterable_spilled(p8n, result)
     try: result = tuple(result)
     except: pass
+    if isinstance(result, tuple):
+      return self.apply_list(p8n, result)
     try:
       implementation = getattr(self, 'apply_' + self.route(result))
     except:
@@ -68,13 +302,52 @@ class Engine(object):
 
   #----------------------------------------------------------------------------
   def sorters(self, p8n):
-    if p8n.sort is not SmartSort:
-      return p8n.sort
-    return [(key, True) for key in self.comparers.keys()]
+    '''
+    Returns the effective sort specification of the current request as
+    a list of ``(method, ascending)`` tuples. The list is normalized so
+    that equivalent specifications are equal (e.g. when used as cache
+    keys): repeated methods are dropped (only the first occurrence can
+    decide the order), as are methods whose comparer is ``None``.
+    '''
+    return self._normalize(p8n.sort)
 
   #----------------------------------------------------------------------------
-  def apply_list(self, p8n, value):
+  def _normalize(self, sort):
+    if sort is SmartSort:
+      sort = [(key, True) for key in self.comparers.keys()]
+    ret  = []
+    seen = set()
+    for meth, asc in sort:
+      if meth in seen or self.comparers.get(meth, meth) is None:
+        continue
+      seen.add(meth)
+      ret.append((meth, bool(asc)))
+    return ret
+
+  #----------------------------------------------------------------------------
+  def is_presorted(self, p8n):
+    '''
+    Returns whether or not the current result set is already sorted in
+    the requested order, i.e. whether the requested sort order is a
+    prefix of the order declared by a `Presorted` wrapper or by the
+    paginator's `presorted` option. Both orders are compared in their
+    normalized form (see :meth:`sorters`).
+    '''
+    order = p8n.get('presorted')
+    if order is None:
+      order = getattr(p8n.paginator, 'presorted', None)
+    if order is None:
+      return False
+    order   = self._normalize(SortValidator.decode(order))
     sorters = self.sorters(p8n)
+    return sorters == order[:len(sorters)]
+
+  #----------------------------------------------------------------------------
+  def comparator(self, p8n, value, sorters):
+    '''
+    Returns a ``cmp``-style function that orders two items of `value`
+    according to `sorters`.
+    '''
     def sortfunc(a, b):
       for meth, asc in sorters:
         spec = self.comparers[meth]
@@ -102,7 +375,189 @@ class Engine(object):
           return 1
         return -1
       return 0
-    value = sorted(value, cmp=sortfunc)
+    return sortfunc
+
+  #----------------------------------------------------------------------------
+  def matcher(self, p8n):
+    '''
+    Returns a predicate function that returns whether or not an item
+    matches all of the filters of the current request, or ``None`` if
+    there are no filters. String filters are resolved as attributes or
+    item keys (in the same way as comparers) and callable filters are
+    called with the keyword arguments `pagination`, `item`, `op`, and
+    `value`.
+    '''
+    filters = p8n.get('filter') if p8n is not None else None
+    if not filters:
+      return None
+    tests = [self._test(p8n, name, op, arg) for name, op, arg in filters]
+    def match(item):
+      for test in tests:
+        if not test(item):
+          return False
+      return True
+    return match
+
+  #----------------------------------------------------------------------------
+  def _test(self, p8n, name, op, arg):
+    spec = self.filters[name]
+    if isinstance(spec, tuple):
+      spec = spec[0]
+    if six.callable(spec):
+      return lambda item: spec(pagination=p8n, item=item, op=op, value=arg)
+    if not morph.isstr(spec):
+      raise ValueError(
+        'pagination filters of in-memory result sets must be a callable,'
+        ' an attribute, or an item key')
+    def get(item):
+      try:
+        return getattr(item, spec)
+      except AttributeError:
+        return item[spec]
+    if op == 'in':
+      return lambda item: get(item) in arg
+    if op == 'range':
+      lo, hi = arg
+      return lambda item: \
+        ( lo is None or get(item) >= lo ) and ( hi is None or get(item) <= hi )
+    if op == 'prefix':
+      return lambda item: \
+        morph.isstr(get(item)) and get(item).startswith(arg)
+    return lambda item: get(item) == arg
+
+  #----------------------------------------------------------------------------
+  def where(self, p8n, query, entity=None):
+    '''
+    Returns the SQLAlchemy ORM query or Core statement `query` with the
+    filters of the current request applied as ``WHERE`` clauses. String
+    filters are resolved against `entity` (if it has an attribute of
+    that name) and callable filters are called with the keyword
+    arguments `pagination`, `query`, `op`, and `value` and must return
+    the filtered query.
+    '''
+    filters = p8n.get('filter')
+    if not filters:
+      return query
+    import sqlalchemy
+    for name, op, arg in filters:
+      spec = self.filters[name]
+      if isinstance(spec, tuple):
+        spec = spec[0]
+      if six.callable(spec) and not hasattr(spec, '__clause_element__'):
+        query = spec(pagination=p8n, query=query, op=op, value=arg)
+        continue
+      if morph.isstr(spec):
+        attr = getattr(entity, spec, None) if entity is not None else None
+        spec = attr \
+          if hasattr(attr, '__clause_element__') \
+          else sqlalchemy.literal_column(spec)
+      if op == 'in':
+        clause = spec.in_(arg)
+      elif op == 'range':
+        clauses = []
+        if arg[0] is not None:
+          clauses.append(spec >= arg[0])
+        if arg[1] is not None:
+          clauses.append(spec <= arg[1])
+        if not clauses:
+          continue
+        clause = sqlalchemy.and_(*clauses)
+      elif op == 'prefix':
+        clause = spec.startswith(arg, autoescape=True)
+      else:
+        clause = spec == arg
+      query = query.filter(clause)
+    return query
+
+  #----------------------------------------------------------------------------
+  def project(self, p8n, items):
+    '''
+    Trims the dict items of the page `items` down to the fields
+    selected by the current request, keyed by field name. Other items
+    (e.g. SQLAlchemy results, whose projection is pushed into the
+    query) are passed through unchanged.
+    '''
+    keys = []
+    for name in p8n.fields:
+      spec = self.fields[name]
+      keys.append((name, spec if morph.isstr(spec) else spec.key))
+    def trim(item):
+      if not isinstance(item, dict):
+        return item
+      return dict((name, item[key]) for name, key in keys if key in item)
+    if isinstance(items, (list, tuple)):
+      return [trim(item) for item in items]
+    return six.moves.map(trim, items)
+
+  #----------------------------------------------------------------------------
+  def streaming(self, p8n):
+    '''
+    Returns whether or not the current request is an unlimited export
+    whose rows should be streamed from the database in batches of
+    `yield_per` rows (instead of being fetched all at once). If so,
+    the pagination state's ``stream`` key is set, which tells the
+    paginator not to force the page into a list.
+    '''
+    if not self.yield_per or p8n.limit > 0 or self.statement_timeout:
+      return False
+    p8n.stream = True
+    return True
+
+  #----------------------------------------------------------------------------
+  def count(self, p8n, key, counter):
+    '''
+    Returns the result set count as returned by calling `counter`. If
+    a `count_cache` is configured, the count is cached under `key`
+    (which must uniquely identify the result set, including the
+    database that it is counted in) and the value returned by the
+    `count_namespace` callback for `count_ttl` seconds.
+    '''
+    if self.count_cache is None:
+      return counter()
+    if self.count_namespace is not None:
+      key = repr(self.count_namespace(pagination=p8n)) + '|' + key
+    key = 'count:' + key
+    ret = self.count_cache.get(key)
+    if ret is None:
+      ret = counter()
+      self.count_cache.put(key, ret, ttl=self.count_ttl)
+    return ret
+
+  #----------------------------------------------------------------------------
+  def statement_key(self, statement, bind=None):
+    '''
+    Returns a string that uniquely identifies the SQLAlchemy
+    `statement` including its bound parameters and the database URL
+    of `bind` (an engine, connection or session), for use as a count
+    cache key. Where supported (i.e. SQLAlchemy 1.4 and better), the
+    statement is only compiled the first time that a statement of the
+    same structure is seen.
+    '''
+    ckey = getattr(statement, '_generate_cache_key', None)
+    ckey = ckey() if ckey is not None else None
+    if ckey is None:
+      compiled = statement.compile()
+      sql    = str(compiled)
+      params = sorted(compiled.params.items())
+    else:
+      with _statement_sql_lock:
+        sql = _statement_sql.pop(ckey.key, None)
+      if sql is None:
+        sql = str(statement.compile())
+      with _statement_sql_lock:
+        _statement_sql[ckey.key] = sql
+        while len(_statement_sql) > _statement_sql_size:
+          _statement_sql.popitem(last=False)
+      params = [param.effective_value for param in ckey.bindparams]
+    return '|'.join([_bind_name(bind, statement), sql, repr(params)])
+
+  #----------------------------------------------------------------------------
+  def apply_list(self, p8n, value):
+    match = self.matcher(p8n)
+    if match is not None:
+      value = [item for item in value if match(item)]
+    if not self.is_presorted(p8n):
+      value = sorted(value, cmp=self.comparator(p8n, value, self.sorters(p8n)))
     count = len(value)
     if p8n.limit > 0:
       value = value[p8n.offset : p8n.offset + p8n.limit]
@@ -111,22 +566,529 @@ class Engine(object):
     return (value, dict(count=count))
 
   #----------------------------------------------------------------------------
-  def apply_sqlalchemy_orm_query_query(self, p8n, query):
-    for meth, asc in self.sorters(p8n):
+  def register(self, items):
+    '''
+    Precomputes the ascending and descending sort order of the static
+    result set `items` for each of the engine's comparers, and returns
+    a :class:`Dataset` that can then be returned by request handlers
+    (repeatedly). Requests whose single or leading sort key is one of
+    these comparers are then served by slicing the precomputed orders,
+    i.e. without sorting the result set. Each order is stored as an
+    ``array('I')`` of item indexes, i.e. the memory overhead is ``8 *
+    len(items)`` bytes per comparer (see :attr:`Dataset.nbytes`). Note
+    that callable comparers receive ``None`` as the pagination state.
+    '''
+    items  = tuple(items)
+    orders = dict()
+    for meth, spec in self.comparers.items():
+      if spec is None:
+        continue
+      perms = []
+      for asc in (True, False):
+        key = functools.cmp_to_key(
+          self.comparator(None, items, [(meth, asc)]))
+        perms.append(array(
+          'I', sorted(six.moves.range(len(items)),
+                      key=lambda idx: key(items[idx]))))
+      orders[meth] = (spec,) + tuple(perms)
+    return Dataset(items, orders)
+
+  #----------------------------------------------------------------------------
+  def apply_dataset(self, p8n, value):
+    items   = value.items
+    if p8n.get('filter'):
+      # the precomputed orders cannot be used for a filtered subset
+      return self.apply_list(p8n, items)
+    count   = len(items)
+    sorters = [
+      spec for spec in self.sorters(p8n)
+      if self.comparers[spec[0]] is not None]
+    start   = min(p8n.offset, count)
+    stop    = min(p8n.offset + p8n.limit, count) if p8n.limit > 0 else count
+    if not sorters:
+      return (list(items[start:stop]), dict(count=count))
+    meth, asc = sorters[0]
+    order = value.orders.get(meth)
+    if order is None or order[0] is not self.comparers[meth]:
+      return self.apply_list(p8n, items)
+    perm = order[1 if asc else 2]
+    if start >= stop or len(sorters) == 1:
+      return ([items[idx] for idx in perm[start:stop]], dict(count=count))
+    # the window's leading-key tie groups are expanded and then fully
+    # sorted, which yields the same order as a full (stable) sort
+    lead = self.comparator(p8n, items, sorters[:1])
+    lo   = start
+    hi   = stop
+    while lo > 0 and lead(items[perm[lo - 1]], items[perm[start]]) == 0:
+      lo -= 1
+    while hi < count and lead(items[perm[hi]], items[perm[stop - 1]]) == 0:
+      hi += 1
+    segment = sorted(
+      [items[idx] for idx in perm[lo:hi]],
+      cmp=self.comparator(p8n, items, sorters))
+    return (segment[start - lo:stop - lo], dict(count=count))
+
+  #----------------------------------------------------------------------------
+  def apply_sorted_collection(self, p8n, value):
+    if p8n.get('filter'):
+      return self.apply_list(p8n, list(value))
+    sorters = tuple(tuple(spec) for spec in self.sorters(p8n))
+    key     = tuple(
+      (meth, asc, self.comparers[meth]) for meth, asc in sorters)
+    try:
+      hash(key)
+    except TypeError:
+      # the ordering cannot be cached for unhashable comparers
+      return self.apply_list(p8n, list(value))
+    stop    = p8n.offset + p8n.limit if p8n.limit > 0 else None
+    items   = value.slice(
+      key, self.comparator(p8n, value, sorters), p8n.offset, stop)
+    return (items, dict(count=len(value)))
+
+  #----------------------------------------------------------------------------
+  def apply_iterable_spilled(self, p8n, value):
+    '''
+    Memory-bounded variant of :meth:`apply_list` for arbitrary
+    iterables: the input is consumed in runs of `spill_size` items,
+    each run is sorted and spilled to a temporary file, and the runs
+    are then lazily merged, reading only up to ``offset + limit``
+    items. At most `spill_merge` runs are kept open at any time.
+    '''
+    sorters = self.sorters(p8n)
+    if not sorters:
+      return self.apply_iterable_window(p8n, value)
+    stop    = p8n.offset + p8n.limit if p8n.limit > 0 else None
+    match   = self.matcher(p8n)
+    if match is not None:
+      value = six.moves.filter(match, value)
+    key    = functools.cmp_to_key(self.comparator(p8n, None, sorters))
+    levels = [[]]
+    count  = 0
+    try:
+      iterator = iter(value)
+      while True:
+        run = list(itertools.islice(iterator, self.spill_size))
+        if not run:
+          break
+        count += len(run)
+        run.sort(key=key)
+        levels[0].append(self._spill(run))
+        del run
+        # cascade merges upward so that each item is only re-spilled
+        # once per level, i.e. O(log(N)) times
+        for level, runs in enumerate(levels):
+          if len(runs) < self.spill_merge:
+            break
+          if level + 1 >= len(levels):
+            levels.append([])
+          levels[level + 1].append(self._spill(self._merge(runs, key)))
+          levels[level] = []
+      # note: the runs are merged oldest-first (i.e. highest level
+      #       first), so that ties keep their input order (as they do
+      #       in :meth:`apply_list`)
+      items = tuple(itertools.islice(
+        self._merge([run for runs in reversed(levels) for run in runs], key),
+        p8n.offset, stop))
+    finally:
+      for runs in levels:
+        for run in runs:
+          run.close()
+    return (items, dict(count=count))
+
+  #----------------------------------------------------------------------------
+  def apply_iterable_window(self, p8n, value):
+    '''
+    Paginates an iterable that does not need to be sorted (see
+    :meth:`is_presorted`) in a single pass, keeping only the items of
+    the requested page in memory (the remaining items are only
+    counted).
+    '''
+    stop  = p8n.offset + p8n.limit if p8n.limit > 0 else None
+    match = self.matcher(p8n)
+    if match is not None:
+      value = six.moves.filter(match, value)
+    count = 0
+    items = []
+    for item in value:
+      if count >= p8n.offset and ( stop is None or count < stop ):
+        items.append(item)
+      count += 1
+    return (tuple(items), dict(count=count))
+
+  #----------------------------------------------------------------------------
+  def _spill(self, items):
+    # note: each item is pickled independently (instead of using a
+    #       single `Pickler`) so that neither the pickler's nor the
+    #       unpickler's memo grows with the size of the run.
+    ret = tempfile.TemporaryFile()
+    for item in items:
+      pickle.dump(item, ret, pickle.HIGHEST_PROTOCOL)
+    ret.flush()
+    ret.seek(0)
+    return ret
+
+  #----------------------------------------------------------------------------
+  def _merge(self, runs, key):
+    def _load(run):
+      while True:
+        try:
+          yield key(pickle.load(run))
+        except EOFError:
+          run.close()
+          return
+    # note: `cmp_to_key` wrappers are used as the heap values (instead
+    #       of `heapq.merge(key=...)`) for python 2 compatibility.
+    for item in heapq.merge(*[_load(run) for run in runs]):
+      yield item.obj
+
+  #----------------------------------------------------------------------------
+  def apply_multi_source(self, p8n, value):
+    stop   = p8n.offset + p8n.limit if p8n.limit > 0 else None
+    window = p8n.copy(offset=0, limit=stop or 0)
+    pages  = []
+    count  = 0
+    for source in value.sources:
+      items, attrs = self.apply(window, source)
+      count += attrs.get('count', 0)
+      pages.append(items)
+    return self._merge_sources(p8n, pages, count, stop)
+
+  #----------------------------------------------------------------------------
+  def apply_sharded_query(self, p8n, value):
+    stop   = p8n.offset + p8n.limit if p8n.limit > 0 else None
+    window = p8n.copy(offset=0, limit=stop or 0)
+    def _shard(source):
+      # note: the page is fetched in the worker thread as well, and each
+      #       shard gets its own copy of the state since `apply` may
+      #       update it (e.g. `presorted` or `stream`)
+      items, attrs = self.apply(window.copy(), source)
+      return (list(items), attrs.get('count', 0))
+    if value.timeout:
+      results = [
+        _Task(self._shard_slots, _shard, source) for source in value.sources]
+    else:
+      pool    = self.pool()
+      results = [pool.apply_async(_shard, (source,)) for source in value.sources]
+    expires = time.time() + value.timeout if value.timeout else None
+    pages   = []
+    count   = 0
+    skipped = []
+    for idx, result in enumerate(results):
+      try:
+        if expires is None:
+          items, total = result.get()
+        else:
+          try:
+            items, total = result.get(max(0, expires - time.time()))
+          except multiprocessing.TimeoutError:
+            raise StatementTimeout(value.timeout)
+      except Exception:
+        if value.partial != 'skip':
+          raise
+        skipped.append(idx)
+        continue
+      pages.append(items)
+      count += total
+    if skipped:
+      p8n.skipped_shards = tuple(skipped)
+    return self._merge_sources(p8n, pages, count, stop)
+
+  #----------------------------------------------------------------------------
+  def pool(self):
+    '''
+    Returns the thread pool (of `shard_workers` threads) that is used
+    to query shards concurrently, creating it on first use.
+    '''
+    if self._pool is None:
+      with self._pool_lock:
+        if self._pool is None:
+          self._pool = ThreadPool(self.shard_workers)
+    return self._pool
+
+  #----------------------------------------------------------------------------
+  def _merge_sources(self, p8n, pages, count, stop):
+    key = functools.cmp_to_key(
+      self.comparator(p8n, None, self.sorters(p8n)))
+    # note: see `_merge` for why `cmp_to_key` wrappers are used
+    merged = heapq.merge(*[six.moves.map(key, page) for page in pages])
+    return (
+      (item.obj for item in itertools.islice(merged, p8n.offset, stop)),
+      dict(count=count))
+
+  #----------------------------------------------------------------------------
+  def ordering(self, p8n, entity=None):
+    '''
+    Returns the SQLAlchemy ordering steps for the current sort
+    specification as a tuple of ``(callable, arguments)`` pairs. For
+    callable comparers, `arguments` is ``(method, ascending)``;
+    otherwise `callable` is None and `arguments` is a tuple of ``ORDER
+    BY`` clauses. String comparers are resolved against `entity`
+    (if it has an attribute of that name). The steps are computed
+    once per `(entity, sort)` combination (using the normalized sort
+    specification, see :meth:`sorters`) and then cached, so that
+    SQLAlchemy sees the very same clause objects on every request.
+    Only the `max_orderings` most recently used steps are kept.
+    '''
+    sorters = tuple(self.sorters(p8n))
+    key = (entity, sorters)
+    with self._orderings_lock:
+      ret = self._orderings.pop(key, None)
+      if ret is not None:
+        self._orderings[key] = ret
+        return ret
+    import sqlalchemy
+    steps   = []
+    clauses = []
+    for meth, asc in sorters:
       spec = self.comparers[meth]
       if spec is None:
         continue
-      elif six.callable(spec):
-        query = spec(pagination=p8n, query=query, method=meth, ascending=asc)
-      elif morph.isstr(spec):
-        query = query.order_by(spec + ( '' if asc else ' DESC' ))
+      if six.callable(spec):
+        if clauses:
+          steps.append((None, tuple(clauses)))
+          clauses = []
+        steps.append((spec, (meth, asc)))
+        continue
+      if morph.isstr(spec):
+        attr = getattr(entity, spec, None) if entity is not None else None
+        spec = attr \
+          if hasattr(attr, '__clause_element__') \
+          else sqlalchemy.literal_column(spec)
+      clauses.append(spec if asc else sqlalchemy.desc(spec))
+    if clauses:
+      steps.append((None, tuple(clauses)))
+    ret = tuple(steps)
+    with self._orderings_lock:
+      # note: if another thread computed the same steps concurrently,
+      #       its steps are used so that the clause objects stay stable
+      ret = self._orderings.setdefault(key, ret)
+      while len(self._orderings) > self.max_orderings:
+        self._orderings.popitem(last=False)
+    return ret
+
+  #----------------------------------------------------------------------------
+  def order_by(self, p8n, entity=None):
+    '''
+    Returns the cached tuple of ``ORDER BY`` clauses for the current
+    sort specification, suitable for use with hand-built statements,
+    e.g. ``select(Model).order_by(*engine.order_by(p8n, Model))``. Raises
+    a ValueError if any of the comparers involved is a callable.
+    '''
+    steps = self.ordering(p8n, entity)
+    if [func for func, args in steps if func is not None]:
+      raise ValueError(
+        'callable comparers cannot be expressed as ORDER BY clauses')
+    return tuple(clause for func, args in steps for clause in args)
+
+  #----------------------------------------------------------------------------
+  def apply_sqlalchemy_orm_query_query(self, p8n, query):
+    descs  = query.column_descriptions
+    entity = descs[0].get('entity') if descs else None
+    query  = self.where(p8n, query, entity)
+    if p8n.get('fields') and entity is not None:
+      import sqlalchemy.orm
+      attrs = [
+        getattr(entity, spec) if morph.isstr(spec) else spec
+        for spec in (self.fields[name] for name in p8n.fields)]
+      query = query.options(sqlalchemy.orm.load_only(*attrs))
+    steps  = self.ordering(p8n, entity) if not self.is_presorted(p8n) else ()
+    for func, args in steps:
+      if func is None:
+        query = query.order_by(*args)
+      else:
+        query = func(
+          pagination=p8n, query=query, method=args[0], ascending=args[1])
+    key   = self.statement_key(query.statement, query.session) \
+      if self.count_cache else None
+    page  = query.offset(p8n.offset)
+    if p8n.limit > 0:
+      page = page.limit(p8n.limit)
+    elif self.streaming(p8n):
+      # note: `yield_per` also enables server-side cursors (where
+      #       supported by the backend)
+      page = page.yield_per(self.yield_per)
+    with self.timeout_guard(query.session if self.statement_timeout else None):
+      count = self.count(p8n, key, query.count)
+      if self.statement_timeout:
+        page = page.all()
+    return (page, dict(count=count))
+
+  #----------------------------------------------------------------------------
+  def apply_sqlalchemy_statement(self, p8n, value):
+    import sqlalchemy
+    if isinstance(value.bind, sqlalchemy.engine.Engine):
+      # note: statements are always executed via an explicit connection
+      #       (SQLAlchemy 2.x has no connectionless execution, and the
+      #       statement timeout must be applied to a single connection).
+      #       streamed results keep it checked out until exhausted.
+      conn   = value.bind.connect()
+      stream = False
+      try:
+        result, attrs = self.apply_sqlalchemy_statement(
+          p8n, Statement(value.statement, conn, mappings=value.mappings))
+        stream = bool(p8n.get('stream'))
+        if stream:
+          return (self._closing(result, conn), attrs)
+        return (result if isinstance(result, list) else result.all(), attrs)
+      finally:
+        if not stream:
+          conn.close()
+    stmt  = self.where(p8n, value.statement)
+    cstmt = sqlalchemy.select(sqlalchemy.func.count()).select_from(
+      stmt.order_by(None).subquery())
+    steps = self.ordering(p8n) if not self.is_presorted(p8n) else ()
+    for func, args in steps:
+      if func is None:
+        stmt = stmt.order_by(*args)
       else:
-        query = query.order_by(spec if asc else sqlalchemy.desc(spec))
-    count = query.count()
-    query = query.offset(p8n.offset)
+        stmt = func(
+          pagination=p8n, query=stmt, method=args[0], ascending=args[1])
+    if p8n.get('fields'):
+      columns = stmt.selected_columns
+      stmt = stmt.with_only_columns(*[
+        columns[spec] if morph.isstr(spec) else spec
+        for spec in (self.fields[name] for name in p8n.fields)])
+    stmt = stmt.offset(p8n.offset)
+    stream = False
     if p8n.limit > 0:
-      query = query.limit(p8n.limit)
-    return (query, dict(count=count))
+      stmt = stmt.limit(p8n.limit)
+    elif self.streaming(p8n):
+      stream = True
+      stmt = stmt.execution_options(stream_results=True)
+    with self.timeout_guard(value.bind) as bind:
+      count = self.count(
+        p8n, self.statement_key(cstmt, bind) if self.count_cache else None,
+        lambda: bind.execute(cstmt).scalar())
+      result = bind.execute(stmt)
+      if stream:
+        result = result.yield_per(self.yield_per)
+      if value.mappings:
+        result = result.mappings()
+      if self.statement_timeout:
+        result = result.all()
+    return (result, dict(count=count))
+
+  #----------------------------------------------------------------------------
+  @staticmethod
+  def _closing(result, conn):
+    try:
+      for item in result:
+        yield item
+    finally:
+      conn.close()
+
+  #----------------------------------------------------------------------------
+  @contextlib.contextmanager
+  def timeout_guard(self, bind):
+    '''
+    A context manager that aborts any statements executed via the
+    SQLAlchemy connection or session `bind` that exceed the engine's
+    `statement_timeout`, raising a :class:`StatementTimeout` instead.
+    It yields the connection to execute statements with (or `bind`
+    itself, if no timeout is configured). Currently, timeouts are
+    supported for SQLite (via a progress handler) and PostgreSQL (via
+    a transaction-local ``statement_timeout``); other databases are
+    not guarded.
+    '''
+    if not self.statement_timeout or bind is None:
+      yield bind
+      return
+    import sqlalchemy, sqlalchemy.exc, sqlalchemy.orm
+    timeout  = self.statement_timeout
+    conn     = bind.connection() \
+      if isinstance(bind, sqlalchemy.orm.Session) else bind
+    dialect  = conn.dialect.name
+    deadline = time.time() + timeout
+    raw = txn = restore = None
+    if dialect == 'sqlite':
+      raw = conn.connection
+      raw = getattr(raw, 'dbapi_connection', None) \
+        or getattr(raw, 'connection', raw)
+      raw.set_progress_handler(lambda: int(time.time() > deadline), 1000)
+    elif dialect == 'postgresql':
+      if not conn.in_transaction():
+        txn = conn.begin()
+      restore = conn.execute(sqlalchemy.text(
+        'SELECT current_setting(\'statement_timeout\'),'
+        ' set_config(\'statement_timeout\', :value, true)'),
+        dict(value=str(int(timeout * 1000)))).scalar()
+    try:
+      yield conn
+      if restore is not None and txn is None:
+        conn.execute(sqlalchemy.text(
+          'SELECT set_config(\'statement_timeout\', :value, true)'),
+          dict(value=restore))
+    except sqlalchemy.exc.DBAPIError as exc:
+      orig = getattr(exc, 'orig', None)
+      if ( raw is not None and time.time() > deadline
+           and 'interrupted' in str(orig) ) \
+          or getattr(orig, 'pgcode', getattr(orig, 'sqlstate', None)) == '57014':
+        raise StatementTimeout(timeout)
+      raise
+    finally:
+      if raw is not None:
+        raw.set_progress_handler(None, 1000)
+      if txn is not None:
+        txn.rollback()
+
+  #----------------------------------------------------------------------------
+  def apply_dbapi_query(self, p8n, value):
+    if p8n.get('filter'):
+      raise ValueError('raw SQL pagination does not support filters')
+    sql = 'SELECT COUNT(*) FROM (' + value.sql + ') AS p8n_count'
+    def _count():
+      cursor = value.connection.cursor()
+      try:
+        cursor.execute(sql, value.params)
+        return cursor.fetchone()[0]
+      finally:
+        cursor.close()
+    count = self.count(
+      p8n, sql + '|' + repr(value.params) if self.count_cache else None,
+      _count)
+    order = []
+    for meth, asc in self.sorters(p8n) if not self.is_presorted(p8n) else ():
+      spec = self.comparers[meth]
+      if spec is None:
+        continue
+      if not morph.isstr(spec):
+        raise ValueError(
+          'raw SQL pagination sort comparers must be column names')
+      order.append(spec + ( '' if asc else ' DESC' ))
+    sql  = value.sql
+    skip = 0
+    if order:
+      sql += ' ORDER BY ' + ', '.join(order)
+    # note: `offset` and `limit` are validated integers, and can
+    #       therefore be inlined regardless of the DB-API paramstyle
+    if p8n.limit > 0:
+      sql += ' LIMIT %d OFFSET %d' % (p8n.limit, p8n.offset)
+    elif p8n.offset > 0:
+      if value.nolimit:
+        sql += ' %s OFFSET %d' % (value.nolimit, p8n.offset)
+      else:
+        skip = p8n.offset
+    return (self._fetch(value, sql, skip), dict(count=count))
+
+  #----------------------------------------------------------------------------
+  def _fetch(self, value, sql, skip):
+    cursor = value.connection.cursor()
+    try:
+      cursor.execute(sql, value.params)
+      while True:
+        rows = cursor.fetchmany(value.batch_size)
+        if not rows:
+          break
+        if skip:
+          if skip >= len(rows):
+            skip -= len(rows)
+            continue
+          rows = rows[skip:]
+          skip = 0
+        for row in rows:
+          yield row
+    finally:
+      cursor.close()
 
 #------------------------------------------------------------------------------
 # end of $Id$
@@ -6,9 +6,16 @@
 # copy: (C) Copyright 2015-EOT Canary Health, Inc., All Rights Reserved.
 #------------------------------------------------------------------------------
 
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import threading
+
 import morph
 
 from .decoder import SortValidator, SmartSort
+from .state import PaginationState
+
+__all__ = ('Mapper', 'MultiMapper')
 
 #------------------------------------------------------------------------------
 class Mapper(object):
@@ -18,6 +25,14 @@ class Mapper(object):
   set and the pagination meta-information.
   '''
 
+  # whether or not `put` consumes the narrowed items lazily (in which
+  # case the paginator's `force_list` option is ignored)
+  lazy = False
+
+  # whether or not the mapper paginates multiple result sets itself
+  # (see :class:`MultiMapper`)
+  multi = False
+
   #----------------------------------------------------------------------------
   def __init__(self, target=None, *args, **kw):
     super(Mapper, self).__init__(*args, **kw)
@@ -106,6 +121,16 @@ class Mapper(object):
 
   #----------------------------------------------------------------------------
   def put_meta(self, p8n, result, value):
+    try:
+      ret = dict(result)
+    except ValueError:
+      # todo: what the ... ?
+      ret = dict(result=result)
+    ret[p8n.paginator.page_name] = self.page_meta(p8n, value)
+    return ret
+
+  #----------------------------------------------------------------------------
+  def page_meta(self, p8n, value):
     page = dict()
     if 'count' in value[1]:
       page[p8n.paginator.count_name]  = value[1]['count']
@@ -118,15 +143,130 @@ class Mapper(object):
       page[p8n.paginator.sort_name] = sort
     page[p8n.paginator.attribute_name] = value[1].get(
       'attribute', p8n.paginator.result_name) or p8n.paginator.result_name
-    try:
-      ret = dict(result)
-    except ValueError:
-      # todo: what the ... ?
-      ret = dict(result=result)
+    return page
+
+
+#------------------------------------------------------------------------------
+class MultiMapper(Mapper):
+  '''
+  A `Mapper` that paginates several result sets ("collections") of the
+  dict returned by the request handler in a single response. Each of
+  the `targets` (a dict or a sequence of ``(path, options)`` pairs
+  that maps the dotted-dictionary path of a collection to the
+  paginator options to use for it, or a list of paths) is paginated by
+  a sub-paginator that extends the current paginator. The collections
+  are processed, and their states and `page` meta-information are
+  ordered, in the order of the `targets` (use a sequence of pairs or
+  an OrderedDict where that order matters on Python 2). Unless
+  otherwise specified, each collection's `page_name` is the last
+  component of its path, i.e. its pagination parameters are namespaced
+  by its name (e.g. ``users.offset``). The `page` meta-information of
+  all collections is returned keyed by name.
+
+  The collections' parameters are decoded (and validated) up-front,
+  and then, if `concurrent` is truthy, the collections are paginated
+  concurrently in a thread pool, each with its own count and page
+  queries. Note that this requires the result sets to be safe to be
+  evaluated in different threads, e.g. SQLAlchemy queries must not
+  share a session.
+  '''
+
+  multi = True
+
+  #----------------------------------------------------------------------------
+  def __init__(self, targets=None, concurrent=True, *args, **kw):
+    super(MultiMapper, self).__init__(*args, **kw)
+    if morph.isstr(targets):
+      targets = [targets]
+    if morph.isseq(targets):
+      targets = [
+        (target, None) if morph.isstr(target) else target
+        for target in targets]
+    self.targets     = OrderedDict(targets or ())
+    self.concurrent  = concurrent
+    self._paginators = dict()
+    self._pool       = None
+    self._lock       = threading.Lock()
+
+  #----------------------------------------------------------------------------
+  def extend(self, *args, **kw):
+    params = dict(
+      target=self.target, targets=self.targets, concurrent=self.concurrent)
+    for arg in args:
+      params.update(arg)
+    params.update(kw)
+    return self.__class__(**params)
+
+  #----------------------------------------------------------------------------
+  def paginators(self, paginator):
+    '''
+    Returns an OrderedDict that maps each collection's name to the
+    sub-paginator (derived from `paginator`) that paginates it.
+    '''
+    with self._lock:
+      ret = self._paginators.get(paginator)
+      if ret is None:
+        ret = OrderedDict()
+        for target, options in self.targets.items():
+          options = dict(options or {})
+          options.setdefault('page_name', target.split('.')[-1])
+          options['mapper'] = Mapper(target=target)
+          ret[options['page_name']] = paginator.extend(**options)
+        self._paginators[paginator] = ret
+      return ret
+
+  #----------------------------------------------------------------------------
+  def pool(self):
+    with self._lock:
+      if self._pool is None:
+        self._pool = ThreadPool(max(1, len(self.targets)))
+      return self._pool
+
+  #----------------------------------------------------------------------------
+  def decode(self, p8n):
+    '''
+    Decodes (and validates) the pagination parameters of all
+    collections, stores their states in `p8n`'s ``collections``
+    attribute (an OrderedDict keyed by name), and returns them.
+    '''
+    states = OrderedDict()
+    for name, pager in self.paginators(p8n.paginator).items():
+      state = PaginationState(paginator=pager, request=p8n.request)
+      state.update(pager.decoder.decode(state))
+      states[name] = state
+    p8n.collections = states
+    return states
+
+  #----------------------------------------------------------------------------
+  def apply(self, p8n, result, handler):
+    '''
+    Paginates all collections in `result` and returns an OrderedDict
+    that maps each collection's name to a two-element tuple of
+    ``(state, value)``, where `state` is the collection's pagination
+    state (see :meth:`decode`) and `value` is the result of
+    :meth:`Paginator.apply`.
+    '''
+    states = p8n.get('collections')
+    if states is None:
+      states = self.decode(p8n)
+    def _apply(state):
+      return (state, state.paginator.apply(state, result, handler))
+    if self.concurrent and len(states) > 1:
+      values = self.pool().map(_apply, list(states.values()))
+    else:
+      values = [_apply(state) for state in states.values()]
+    return OrderedDict(zip(states.keys(), values))
+
+  #----------------------------------------------------------------------------
+  def put(self, p8n, result, value):
+    page = OrderedDict()
+    for name, (state, val) in value.items():
+      result     = state.paginator.mapper.put_data(state, result, val)
+      page[name] = state.paginator.mapper.page_meta(state, val)
+    ret = dict(result)
     ret[p8n.paginator.page_name] = page
     return ret
 
-
 #------------------------------------------------------------------------------
 # end of $Id$
 #------------------------------------------------------------------------------
@@ -6,13 +6,21 @@
 # copy: (C) Copyright 2015-EOT Canary Health, Inc., All Rights Reserved.
 #------------------------------------------------------------------------------
 
+from collections import OrderedDict
+import datetime
+import decimal
+import hashlib
+import time
+
 import six
 from pyramid.request import Request
-from aadict import aadict
+from pyramid.httpexceptions import HTTPNotModified
 
-from .decoder import Decoder, SmartSort
+from .decoder import Decoder, SmartSort, SortValidator
 from .mapper import Mapper
 from .engine import Engine
+from .state import PaginationState
+from .profiling import Profiler
 
 #------------------------------------------------------------------------------
 def _extend(klass, base, spec):
@@ -27,6 +35,32 @@ def _extend(klass, base, spec):
   return klass().extend(spec)
 
 
+#------------------------------------------------------------------------------
+_SCALARS = six.string_types + six.integer_types + (
+  six.binary_type, float, bool, type(None), decimal.Decimal,
+  datetime.date, datetime.time, datetime.timedelta)
+
+_UNCACHEABLE = object()
+
+def _snapshot(value):
+  # returns a deep copy of `value` if it consists only of dicts, lists,
+  # tuples and scalars (i.e. if it can be safely cached and shared),
+  # and `_UNCACHEABLE` otherwise (e.g. for responses and generators)
+  if isinstance(value, _SCALARS):
+    return value
+  if type(value) in (list, tuple):
+    ret = [_snapshot(item) for item in value]
+    if _UNCACHEABLE in ret:
+      return _UNCACHEABLE
+    return type(value)(ret)
+  if type(value) is dict:
+    ret = dict((key, _snapshot(item)) for key, item in value.items())
+    if _UNCACHEABLE in ret.values():
+      return _UNCACHEABLE
+    return ret
+  return _UNCACHEABLE
+
+
 #------------------------------------------------------------------------------
 class Paginator(object):
 
@@ -36,8 +70,14 @@ class Paginator(object):
     offset_default   = 0,               # `offset` default value
     limit_name       = 'limit',         # `limit` parameter name
     limit_default    = 25,              # `limit` default value
+    offset_max       = None,            # maximum `offset` value
+    limit_max        = None,            # maximum `limit` value (disallows unlimited)
+    limit_policy     = 'reject',        # out-of-bounds policy: 'reject' or 'clamp'
     sort_name        = 'sort',          # `sort` parameter name
     sort_default     = SmartSort,       # `sort` default value
+    presorted        = None,            # sort order that result sets already have
+    filter_name      = 'filter',        # `filter` parameters namespace
+    fields_name      = 'fields',        # `fields` parameter name
     count_name       = 'count',         # `count` response parameter name
     attribute_name   = 'attribute',     # `attribute` response parameter name
     result_name      = 'result',        # `result` response namespace
@@ -47,6 +87,16 @@ class Paginator(object):
     map_item         = None,            # per-item result callback hook
     map_list         = None,            # entire result callback hook
     map_return       = None,            # return value callback hook
+    version          = None,            # collection version callback (enables ETags)
+    cache            = None,            # paginated output cache (e.g. `MemoryCache`)
+    cache_vary       = None,            # additional output cache key callback
+    cache_tags       = (),              # output cache invalidation tags
+    profile          = None,            # per-request profiling predicate
+    profile_sink     = None,            # profile summary callback
+    profile_modes    = Profiler.DEFAULT_MODES,
+                                        # profilers to use
+    profile_limit    = 20,              # number of reported functions/allocation sites
+    telemetry        = None,            # workload telemetry (e.g. `Telemetry`)
   )
 
   #----------------------------------------------------------------------------
@@ -63,9 +113,15 @@ class Paginator(object):
     self.decoder  = _extend(Decoder, None, decoder)
     self.mapper   = _extend(Mapper,  None, mapper)
     self.engine   = _extend(Engine,  None, engine)
-    self.schema   = None  # used by :class:`Decoder`
     if 'comparers' in kw:
       self.engine   = self.engine.extend(comparers=kw.pop('comparers'))
+    if 'filters' in kw:
+      self.engine   = self.engine.extend(filters=kw.pop('filters'))
+    if 'fields' in kw:
+      self.engine   = self.engine.extend(fields=kw.pop('fields'))
+    # the decoder schema is built eagerly (and is immutable) so that
+    # concurrent requests never race to build it
+    self.schema   = self.decoder.make_schema(PaginationState(paginator=self))
     super(Paginator, self).__init__(*args, **kw)
 
   #----------------------------------------------------------------------------
@@ -95,18 +151,225 @@ class Paginator(object):
     def _wrapped(*args, **kw):
       return self.paginate(func, *args, **kw)
     _wrapped.__doc__ = func.__doc__
+    _wrapped.__paginator__ = self
+    _wrapped.__view_name__ = self.view_name(func)
     return _wrapped
 
   #----------------------------------------------------------------------------
   def paginate(self, handler, *args, **kw):
+    if self.profile is not None:
+      request = [arg for arg in args if isinstance(arg, Request)][0]
+      if self.profile(request=request):
+        return self.profiled(request, handler, *args, **kw)
+    return self.paginate_cached(handler, *args, **kw)
+
+  #----------------------------------------------------------------------------
+  def paginate_cached(self, handler, *args, **kw):
+    '''
+    Paginates the current request via the output `cache` (if enabled).
+    Only plain data (i.e. dicts, lists, tuples, and scalars) is cached,
+    i.e. responses (such as 304 Not Modified responses) and lazily
+    consumed results (generators and streams) are not. Each request
+    receives its own copy of the cached value.
+
+    The decoded pagination state and the ETag are cached along with
+    the output, so that cache hits skip decoding and validation but
+    still set up the pagination state. If `version` is set, the ETag
+    is recomputed on each hit, and entries whose ETag no longer
+    matches (i.e. that were cached for a previous version) are
+    replaced.
+    '''
+    if self.cache is None:
+      return self._paginate(handler, *args, **kw)
+    request = [arg for arg in args if isinstance(arg, Request)][0]
+    key   = self.cache_key(handler, request)
+    entry = self.cache.get(key)
+    if entry is not None:
+      p8n, etag = self._restore(request, entry)
+      if etag == entry['etag']:
+        if etag is not None:
+          if etag in request.if_none_match:
+            return HTTPNotModified(etag=etag)
+          request.response.etag = etag
+        return _snapshot(entry['value'])
+    ret   = self._paginate(handler, *args, **kw)
+    entry = self._entry(request, ret)
+    if entry is not _UNCACHEABLE:
+      self.cache.put(key, entry, tags=self.cache_tags)
+    return ret
+
+  #----------------------------------------------------------------------------
+  def _entry(self, request, value):
+    # returns the output cache entry for the paginated `value`, which
+    # holds the ETag and a plain copy of `value` and of the decoded
+    # pagination state (see `_restore`), or `_UNCACHEABLE`
+    p8n = getattr(request, self.request_name, None)
+    if p8n is None:
+      return _UNCACHEABLE
+    return _snapshot(dict(
+      value       = value,
+      state       = self._freeze(p8n),
+      collections = [
+        (name, self._freeze(state))
+        for name, state in ( p8n.get('collections') or {} ).items()],
+      etag        = self.etag(p8n) if self.version is not None else None,
+    ))
+
+  #----------------------------------------------------------------------------
+  @staticmethod
+  def _freeze(p8n):
+    ret = dict(
+      offset = p8n.offset,
+      limit  = p8n.limit,
+      sort   = SortValidator.encode(p8n.sort))
+    for name in ('count', 'filter', 'fields'):
+      if p8n.get(name) is not None:
+        ret[name] = p8n[name]
+    return ret
+
+  #----------------------------------------------------------------------------
+  def _restore(self, request, entry):
+    # recreates the pagination state from the output cache `entry`
+    # (without decoding the request), stores it on the request, and
+    # returns a two-element tuple of ``(state, etag)``
+    def _thaw(paginator, values):
+      state = PaginationState(paginator=paginator, request=request)
+      state.update(values)
+      state.sort = SortValidator.decode(values['sort'])
+      return state
+    p8n = _thaw(self, entry['state'])
+    if entry['collections']:
+      pagers = self.mapper.paginators(self)
+      p8n.collections = OrderedDict(
+        (name, _thaw(pagers[name], values))
+        for name, values in entry['collections'])
+    setattr(request, self.request_name, p8n)
+    return (p8n, self.etag(p8n) if self.version is not None else None)
+
+  #----------------------------------------------------------------------------
+  def profiled(self, request, handler, *args, **kw):
+    '''
+    Paginates the current request under the profilers selected by the
+    `profile_modes` option, stores the summary (see
+    :class:`pyramid_pagination.Profiler`) in the pagination state's
+    ``profile`` attribute, and passes it to the `profile_sink`.
+    '''
+    phases = dict(
+      decode  = self.decoder.decode,
+      handler = handler,
+      engine  = self.engine.apply,
+      mapper  = [self.mapper.get, self.mapper.put],
+    )
+    profiler = Profiler(modes=self.profile_modes, limit=self.profile_limit)
+    ret, summary = profiler.run(
+      phases, self.paginate_cached, handler, *args, **kw)
+    p8n = getattr(request, self.request_name, None)
+    if p8n is not None:
+      p8n.profile = summary
+    if self.profile_sink is not None:
+      self.profile_sink(request=request, state=p8n, profile=summary)
+    return ret
+
+  #----------------------------------------------------------------------------
+  def cache_key(self, handler, request):
+    '''
+    Returns the output cache key for the current request, which is
+    composed of the view identity, the request path, all request
+    parameters, the raw pagination parameters (which may be taken from
+    elsewhere, see the decoder's `request_param` option), and the value
+    returned by the `cache_vary` callback. The key is built from the
+    raw parameters so that cache hits do not need to decode them; the
+    cost is that equivalent spellings (e.g. an explicit default limit)
+    are cached as separate entries, which is never incorrect.
+    '''
+    view = self.view_name(handler)
+    vary = self.cache_vary(request=request) if self.cache_vary else None
+    return '|'.join([
+      view,
+      request.path,
+      repr(sorted(request.params.items())),
+      self.decoder.fingerprint(PaginationState(paginator=self, request=request)),
+      repr(vary)])
+
+  #----------------------------------------------------------------------------
+  @staticmethod
+  def view_name(handler):
+    '''
+    Returns the name that identifies the request `handler` (e.g. for
+    output caching and telemetry), which is either the handler's
+    ``__view_name__`` attribute or its dotted name followed by the line
+    number of its definition, e.g. ``"myapp.views.Items.list:42"``. The
+    line number disambiguates handlers that have the same name (such
+    as nested functions and lambdas, and, on Python 2, methods of
+    different classes).
+    '''
+    ret = getattr(handler, '__view_name__', None)
+    if ret:
+      return ret
+    name = getattr(handler, '__qualname__', None)
+    if name is None:
+      name = getattr(handler, '__name__', None) or repr(handler)
+      klass = getattr(handler, 'im_class', None)
+      if klass is not None:
+        name = klass.__name__ + '.' + name
+    code = getattr(getattr(handler, '__func__', handler), '__code__', None)
+    if code is not None:
+      name += ':%d' % (code.co_firstlineno,)
+    return '.'.join([getattr(handler, '__module__', None) or '', name])
+
+  #----------------------------------------------------------------------------
+  def _paginate(self, handler, *args, **kw):
     # todo: i don't particulary like this searching for the "Request"...
     request = [arg for arg in args if isinstance(arg, Request)][0]
-    p8n = aadict(paginator=self, request=request)
+    p8n, response = self._prepare(request)
+    if response is not None:
+      return response
+    result = handler(*args, **kw)
+    if self.mapper.multi:
+      value = self.mapper.apply(p8n, result, handler)
+    else:
+      value = self.apply(p8n, result, handler)
+    value = self.mapper.put(p8n, result, value)
+    if self.map_return:
+      return self.map_return(state=p8n, result=result, value=value)
+    return value
+
+  #----------------------------------------------------------------------------
+  def _prepare(self, request):
+    # decodes the pagination state, stores it on the request, and
+    # handles ETags; returns a two-element tuple of ``(state,
+    # response)``, where `response` is a 304 Not Modified response if
+    # the client's copy is current and ``None`` otherwise
+    p8n = PaginationState(paginator=self, request=request)
     p8n.update(self.decoder.decode(p8n))
     setattr(request, self.request_name, p8n)
-    result = handler(*args, **kw)
+    if self.mapper.multi:
+      self.mapper.decode(p8n)
+    if self.version is not None:
+      etag = self.etag(p8n)
+      if etag in request.if_none_match:
+        return (p8n, HTTPNotModified(etag=etag))
+      request.response.etag = etag
+    return (p8n, None)
+
+  #----------------------------------------------------------------------------
+  def apply(self, p8n, result, handler):
+    '''
+    Selects the result set from the `handler`'s return value `result`
+    via the mapper and narrows it down via the engine and the `map_*`
+    hooks. Returns a two-element tuple of ``(narrowed_value,
+    page_attributes)``.
+    '''
     value  = self.mapper.get(p8n, result)
+    sample = self.telemetry is not None and self.telemetry.sampled()
+    if sample:
+      source = value
+      start  = time.time()
     value  = self.engine.apply(p8n, value)
+    if p8n.get('fields'):
+      value = ( self.engine.project(p8n, value[0]), value[1] )
+    if sample:
+      applied = time.time()
     if self.keep_items:
       p8n['items'] = tuple(value[0])
       value = ( p8n['items'], value[1] )
@@ -119,20 +382,70 @@ class Paginator(object):
     if self.map_list:
       value = self.map_list(
         state=p8n, result=result, value=value[0], attributes=value[1])
-    if self.force_list and not isinstance(value[0], (tuple, list)):
+    if self.force_list and not self.mapper.lazy and not p8n.get('stream') \
+        and not isinstance(value[0], (tuple, list)):
       value = ( tuple(value[0]), value[1] )
-    value = self.mapper.put(p8n, result, value)
-    if self.map_return:
-      return self.map_return(state=p8n, result=result, value=value)
+    if sample:
+      view = self.view_name(handler)
+      if self.mapper.target is not None:
+        view += ':' + self.mapper.target
+      self.telemetry.record(
+        view, p8n, source, applied - start, time.time() - applied)
     return value
 
+  #----------------------------------------------------------------------------
+  def register(self, items):
+    '''
+    Shorthand for ``self.engine.register(items)``, see
+    :meth:`Engine.register`.
+    '''
+    return self.engine.register(items)
+
+  #----------------------------------------------------------------------------
+  def etag(self, p8n):
+    '''
+    Returns the ETag for the current request, which combines the
+    collection version (as returned by the `version` callback) with
+    the decoded offset, limit, sort, filter, and fields parameters
+    (and, for a `MultiMapper`, those of each collection).
+    '''
+    tag = repr(self.version(state=p8n)) + self._state_tag(p8n)
+    for name, state in ( p8n.get('collections') or {} ).items():
+      tag += '|' + name + self._state_tag(state)
+    return hashlib.md5(tag.encode('utf-8')).hexdigest()
+
+  #----------------------------------------------------------------------------
+  @staticmethod
+  def _state_tag(p8n):
+    tag = repr((p8n.offset, p8n.limit, SortValidator.encode(p8n.sort)))
+    if p8n.get('filter'):
+      tag += repr(p8n.filter)
+    if p8n.get('fields'):
+      tag += repr(p8n.fields)
+    return tag
+
   #----------------------------------------------------------------------------
   @staticmethod
   def get_paginator(handle):
+    '''
+    Returns the `Paginator` that paginates the view callable `handle`
+    (either decorated with a paginator or derived via the ``paginate``
+    view option), or ``None`` if it is not paginated. Paginated views
+    reference their paginator directly via the ``__paginator__``
+    attribute, which is found by following pyramid's ``__wraps__``
+    chain of derived views; otherwise the view's closures are searched.
+    '''
     if not callable(handle):
       return None
     if isinstance(handle, Paginator):
       return handle
+    while handle is not None:
+      ret = getattr(handle, '__paginator__', None)
+      if isinstance(ret, Paginator):
+        return ret
+      if getattr(handle, '__wraps__', None) is None:
+        break
+      handle = handle.__wraps__
     try:
       handle = six.get_function_closure(handle)
     except AttributeError:
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# auth: Philip J Grabner <phil@canary.md>
+# date: 2026/10/19
+# copy: (C) Copyright 2015-EOT Canary Health, Inc., All Rights Reserved.
+#------------------------------------------------------------------------------
+
+import cProfile
+import pstats
+import time
+
+try:
+  import tracemalloc as _tracemalloc
+except ImportError:
+  _tracemalloc = None
+
+__all__ = ('Profiler',)
+
+#------------------------------------------------------------------------------
+def _code(func):
+  func = getattr(func, '__func__', func)
+  code = getattr(func, '__code__', None)
+  if code is None:
+    return None
+  return (code.co_filename, code.co_firstlineno, code.co_name)
+
+#------------------------------------------------------------------------------
+class Profiler(object):
+  '''
+  Runs a callable under ``cProfile`` and/or ``tracemalloc`` (as
+  selected by `modes`) and produces a compact, JSON-serializable
+  summary dict with the following keys:
+
+  * ``elapsed``: the wall-clock time of the call, in seconds.
+
+  * ``phases``: (``cprofile`` only) a dict of the cumulative time, in
+    seconds, spent in each of the named `phases` (see :meth:`run`).
+
+  * ``functions``: (``cprofile`` only) the `limit` functions with the
+    highest cumulative time, as a list of ``[function, ncalls,
+    tottime, cumtime]`` lists.
+
+  * ``memory``: (``tracemalloc`` only) a dict with the ``current`` and
+    ``peak`` traced memory in bytes, and the ``top`` `limit`
+    allocation sites as a list of ``[location, size, count]`` lists.
+    If tracing was already active, ``peak`` is ``None`` and the sizes
+    are relative to the start of the call.
+
+  Note that ``tracemalloc`` (and, on Python 3.12 and better, also
+  ``cProfile``) is process-global, i.e. concurrent requests in other
+  threads may be included in the summary. If a profiler cannot be
+  used (e.g. because another profiler is already active), the summary
+  contains an ``errors`` list instead of the corresponding keys.
+
+  The default `modes` (see `DEFAULT_MODES`) only include
+  ``tracemalloc`` if it is available, i.e. on Python 3.4 and better.
+  '''
+
+  DEFAULT_MODES = ('cprofile',) if _tracemalloc is None \
+    else ('cprofile', 'tracemalloc')
+
+  #----------------------------------------------------------------------------
+  def __init__(self, modes=DEFAULT_MODES, limit=20):
+    self.modes = modes
+    self.limit = limit
+
+  #----------------------------------------------------------------------------
+  def run(self, phases, func, *args, **kw):
+    '''
+    Calls ``func(*args, **kw)`` and returns a two-element tuple of
+    ``(return_value, summary)``. `phases` is a dict that maps phase
+    names to the functions or methods (or lists thereof) whose
+    cumulative times are reported in the summary's ``phases``.
+    '''
+    summary  = dict()
+    profiler = None
+    snapshot = None
+    if 'tracemalloc' in self.modes:
+      snapshot = self.memory_start(summary)
+    if 'cprofile' in self.modes:
+      profiler = cProfile.Profile()
+      try:
+        profiler.enable()
+      except ValueError as exc:
+        summary.setdefault('errors', []).append('cprofile: ' + str(exc))
+        profiler = None
+    start = time.time()
+    try:
+      ret = func(*args, **kw)
+    finally:
+      summary['elapsed'] = time.time() - start
+      if profiler is not None:
+        profiler.disable()
+        self.cpu_summary(summary, profiler, phases)
+      if snapshot is not None:
+        self.memory_summary(summary, snapshot)
+    return (ret, summary)
+
+  #----------------------------------------------------------------------------
+  def cpu_summary(self, summary, profiler, phases):
+    stats = pstats.Stats(profiler).stats
+    summary['phases'] = dict()
+    for name, funcs in phases.items():
+      if not isinstance(funcs, (list, tuple)):
+        funcs = [funcs]
+      times = [stats.get(_code(func)) for func in funcs]
+      summary['phases'][name] = \
+        sum(stat[3] for stat in times if stat is not None)
+    top = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)
+    summary['functions'] = [
+      ['%s:%d(%s)' % func, stat[1], stat[2], stat[3]]
+      for func, stat in top[:self.limit]]
+
+  #----------------------------------------------------------------------------
+  def memory_start(self, summary):
+    tracemalloc = _tracemalloc
+    if tracemalloc is None:
+      summary.setdefault('errors', []).append('tracemalloc: not available')
+      return None
+    if tracemalloc.is_tracing():
+      return (False, tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__)]))
+    tracemalloc.start()
+    return (True, None)
+
+  #----------------------------------------------------------------------------
+  def memory_summary(self, summary, snapshot):
+    tracemalloc = _tracemalloc
+    started, before = snapshot
+    current, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot().filter_traces([
+      tracemalloc.Filter(False, tracemalloc.__file__)])
+    if started:
+      tracemalloc.stop()
+      stats = after.statistics('lineno')
+      sizes = [(stat.traceback, stat.size, stat.count) for stat in stats]
+    else:
+      stats = after.compare_to(before, 'lineno')
+      sizes = [
+        (stat.traceback, stat.size_diff, stat.count_diff) for stat in stats]
+      current = sum(size for trace, size, count in sizes)
+      peak    = None
+    summary['memory'] = dict(
+      current = current,
+      peak    = peak,
+      top     = [
+        ['%s:%d' % (trace[0].filename, trace[0].lineno), size, count]
+        for trace, size, count in sizes[:self.limit]])
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# auth: Philip J Grabner <phil@canary.md>
+# date: 2026/10/19
+# copy: (C) Copyright 2015-EOT Canary Health, Inc., All Rights Reserved.
+#------------------------------------------------------------------------------
+
+_setattr = object.__setattr__
+
+#------------------------------------------------------------------------------
+class PaginationState(object):
+  '''
+  The per-request pagination state object (often referred to as
+  ``p8n``). The well-known fields are stored in slots, i.e. accessing
+  them is a plain attribute lookup, but any other key can be stored as
+  well. For backward compatibility with the previous dict-based state
+  object, it also supports the basic mapping interface (item access,
+  ``get``, ``update``, ``keys``, and ``in``); unset fields are treated
+  as missing keys. As with the previous state object, reading a missing
+  key as an attribute returns None.
+  '''
+
+  FIELDS = ('paginator', 'request', 'offset', 'limit', 'sort', 'items', 'count')
+
+  __slots__ = FIELDS + ('_extra',)
+
+  _fields = frozenset(FIELDS)
+
+  #----------------------------------------------------------------------------
+  def __init__(self, paginator=None, request=None, **kw):
+    _setattr(self, '_extra', None)
+    _setattr(self, 'paginator', paginator)
+    _setattr(self, 'request', request)
+    if kw:
+      self.update(kw)
+
+  #----------------------------------------------------------------------------
+  def __getattr__(self, name):
+    # note: only called if regular attribute lookup fails, i.e. for
+    #       unset slots and non-field keys
+    if name.startswith('__') and name.endswith('__'):
+      raise AttributeError(name)
+    extra = object.__getattribute__(self, '_extra')
+    if extra is not None and name in extra:
+      return extra[name]
+    return None
+
+  #----------------------------------------------------------------------------
+  def __setattr__(self, name, value):
+    if name in self._fields:
+      _setattr(self, name, value)
+      return
+    if self._extra is None:
+      _setattr(self, '_extra', dict())
+    self._extra[name] = value
+
+  #----------------------------------------------------------------------------
+  def __delattr__(self, name):
+    if name in self._fields:
+      object.__delattr__(self, name)
+      return
+    if self._extra is None or name not in self._extra:
+      raise AttributeError(name)
+    del self._extra[name]
+
+  #----------------------------------------------------------------------------
+  def __getitem__(self, key):
+    if key in self._fields:
+      try:
+        return object.__getattribute__(self, key)
+      except AttributeError:
+        raise KeyError(key)
+    if self._extra is None or key not in self._extra:
+      raise KeyError(key)
+    return self._extra[key]
+
+  #----------------------------------------------------------------------------
+  def __setitem__(self, key, value):
+    setattr(self, key, value)
+
+  #----------------------------------------------------------------------------
+  def __delitem__(self, key):
+    try:
+      delattr(self, key)
+    except AttributeError:
+      raise KeyError(key)
+
+  #----------------------------------------------------------------------------
+  def __contains__(self, key):
+    try:
+      self[key]
+      return True
+    except KeyError:
+      return False
+
+  #----------------------------------------------------------------------------
+  def __iter__(self):
+    return iter(self.keys())
+
+  #----------------------------------------------------------------------------
+  def __len__(self):
+    return len(self.keys())
+
+  #----------------------------------------------------------------------------
+  def __repr__(self):
+    return 'PaginationState(%s)' % (
+      ', '.join('%s=%r' % (key, self[key]) for key in self.keys()),)
+
+  #----------------------------------------------------------------------------
+  def keys(self):
+    ret = [key for key in PaginationState.FIELDS if key in self]
+    if self._extra:
+      ret.extend(self._extra.keys())
+    return ret
+
+  #----------------------------------------------------------------------------
+  def get(self, key, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  #----------------------------------------------------------------------------
+  def update(self, *args, **kw):
+    fields = self._fields
+    for arg in args + (kw,):
+      if isinstance(arg, dict):
+        arg = arg.items()
+      elif hasattr(arg, 'keys'):
+        arg = [(key, arg[key]) for key in arg.keys()]
+      for key, value in arg:
+        if key in fields:
+          _setattr(self, key, value)
+        else:
+          self.__setattr__(key, value)
+
+  #----------------------------------------------------------------------------
+  def copy(self, **kw):
+    '''
+    Returns a shallow copy of this state, with the fields specified
+    as keyword arguments overridden.
+    '''
+    ret = self.__class__()
+    ret.update(self, kw)
+    return ret
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# auth: Philip J Grabner <phil@canary.md>
+# date: 2026/10/19
+# copy: (C) Copyright 2015-EOT Canary Health, Inc., All Rights Reserved.
+#------------------------------------------------------------------------------
+
+from collections import OrderedDict
+import json
+import uuid
+
+from .mapper import Mapper
+
+__all__ = ('JsonStream', 'StreamingMapper', 'JsonStreamRenderer')
+
+#------------------------------------------------------------------------------
+class JsonStream(object):
+  '''
+  An iterable of JSON-encoded byte chunks that represents a paginated
+  response. The `value` (i.e. the response without the paginated
+  items, but with the ``page`` meta-information first) is encoded
+  up-front, and the `items` are then consumed and encoded lazily,
+  `chunk_size` items at a time.
+  '''
+
+  #----------------------------------------------------------------------------
+  def __init__(self, value, items, marker, chunk_size=64, default=None):
+    self.value      = value
+    self.items      = items
+    self.marker     = marker
+    self.chunk_size = chunk_size
+    self.default    = default
+
+  #----------------------------------------------------------------------------
+  def __iter__(self):
+    text = json.dumps(self.value, default=self.default)
+    head, tail = text.split(json.dumps(self.marker), 1)
+    yield ( head + '[' ).encode('utf-8')
+    chunk = []
+    first = True
+    for item in self.items:
+      chunk.append(json.dumps(item, default=self.default))
+      if len(chunk) >= self.chunk_size:
+        yield ( ( '' if first else ', ' ) + ', '.join(chunk) ).encode('utf-8')
+        first = False
+        chunk = []
+    if chunk:
+      yield ( ( '' if first else ', ' ) + ', '.join(chunk) ).encode('utf-8')
+    yield ( ']' + tail ).encode('utf-8')
+
+
+#------------------------------------------------------------------------------
+class StreamingMapper(Mapper):
+  '''
+  A `Mapper` that, instead of splicing the paginated items into the
+  return value, returns a :class:`JsonStream` that emits the ``page``
+  meta-information first and then serializes the items incrementally
+  as they are consumed from the engine. It is intended to be used
+  together with the :class:`JsonStreamRenderer`.
+  '''
+
+  lazy = True
+
+  #----------------------------------------------------------------------------
+  def __init__(self, chunk_size=64, default=None, *args, **kw):
+    super(StreamingMapper, self).__init__(*args, **kw)
+    self.chunk_size = chunk_size
+    self.default    = default
+
+  #----------------------------------------------------------------------------
+  def extend(self, *args, **kw):
+    params = dict(
+      target=self.target, chunk_size=self.chunk_size, default=self.default)
+    for arg in args:
+      params.update(arg)
+    params.update(kw)
+    return self.__class__(**params)
+
+  #----------------------------------------------------------------------------
+  def put(self, p8n, result, value):
+    marker = 'p8n-stream-' + uuid.uuid4().hex
+    result = super(StreamingMapper, self).put(
+      p8n, result, (marker, value[1]))
+    page = p8n.paginator.page_name
+    if page in result:
+      result = OrderedDict(
+        [(page, result[page])]
+        + [(key, val) for key, val in result.items() if key != page])
+    return JsonStream(
+      result, value[0], marker,
+      chunk_size=self.chunk_size, default=self.default)
+
+
+#------------------------------------------------------------------------------
+class JsonStreamRenderer(object):
+  '''
+  A Pyramid renderer factory that sends a :class:`JsonStream` as the
+  response's WSGI ``app_iter``; any other value is rendered as plain
+  JSON. Example registration:
+
+  .. code-block:: python
+
+    config.add_renderer('json-stream', JsonStreamRenderer())
+  '''
+
+  #----------------------------------------------------------------------------
+  def __init__(self, default=None):
+    self.default = default
+
+  #----------------------------------------------------------------------------
+  def __call__(self, info):
+    def _render(value, system):
+      request = system.get('request')
+      if request is not None:
+        response = request.response
+        if response.content_type == response.default_content_type:
+          response.content_type = 'application/json'
+      if not isinstance(value, JsonStream):
+        return json.dumps(value, default=self.default)
+      if value.default is None:
+        value.default = self.default
+      if request is None:
+        return b''.join(value)
+      request.response.app_iter = value
+      return None
+    return _render
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------
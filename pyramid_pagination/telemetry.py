@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+#------------------------------------------------------------------------------
+# file: $Id$
+# auth: Philip J Grabner <phil@canary.md>
+# date: 2026/10/19
+# copy: (C) Copyright 2015-EOT Canary Health, Inc., All Rights Reserved.
+#------------------------------------------------------------------------------
+
+import bisect
+from collections import Counter
+import random
+import sys
+import threading
+
+import six
+import morph
+
+from .decoder import SortValidator
+from .engine import Statement, RawQuery, Presorted
+
+__all__ = ('Histogram', 'ViewStats', 'describe_result', 'Telemetry')
+
+#------------------------------------------------------------------------------
+class Histogram(object):
+  '''
+  A fixed-bucket histogram. A value is counted in the first bucket
+  whose upper bound (inclusive) is greater than or equal to it; larger
+  values are counted in a final overflow bucket.
+  '''
+
+  #----------------------------------------------------------------------------
+  def __init__(self, bounds):
+    self.bounds = tuple(bounds)
+    self.counts = [0] * ( len(self.bounds) + 1 )
+    self.total  = 0
+    self.max    = None
+
+  #----------------------------------------------------------------------------
+  def add(self, value):
+    self.counts[bisect.bisect_left(self.bounds, value)] += 1
+    self.total += value
+    if self.max is None or value > self.max:
+      self.max = value
+
+  #----------------------------------------------------------------------------
+  def snapshot(self):
+    '''
+    Returns a dict with the total number of values (``count``), their
+    ``sum`` and ``max``, and the ``buckets`` as a list of ``[bound,
+    count]`` lists, where the bound of the overflow bucket is ``None``.
+    '''
+    return dict(
+      count   = sum(self.counts),
+      sum     = self.total,
+      max     = self.max,
+      buckets = [
+        [bound, count]
+        for bound, count in zip(self.bounds + (None,), self.counts)])
+
+
+#------------------------------------------------------------------------------
+class ViewStats(object):
+  '''
+  The pagination workload statistics of a single view.
+  '''
+
+  OFFSET_BOUNDS  = (0, 10, 100, 1000, 10000, 100000)
+  LATENCY_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+  #----------------------------------------------------------------------------
+  def __init__(self):
+    self.requests  = 0
+    self.offsets   = Histogram(self.OFFSET_BOUNDS)
+    self.limits    = Counter()
+    self.sorts     = Counter()
+    self.apply     = Histogram(self.LATENCY_BOUNDS)
+    self.fetch     = Histogram(self.LATENCY_BOUNDS)
+    self.kind      = None
+    self.table     = None
+    self.comparers = {}
+
+  #----------------------------------------------------------------------------
+  def snapshot(self):
+    return dict(
+      requests = self.requests,
+      kind     = self.kind,
+      table    = self.table,
+      offsets  = self.offsets.snapshot(),
+      limits   = dict(self.limits),
+      sorts    = dict(self.sorts),
+      apply_ms = self.apply.snapshot(),
+      fetch_ms = self.fetch.snapshot(),
+    )
+
+
+#------------------------------------------------------------------------------
+def describe_result(value):
+  '''
+  Returns a two-element tuple of ``(kind, table)`` for the result set
+  `value` as returned by the mapper, where `kind` is one of ``'orm'``
+  (a SQLAlchemy ORM query), ``'core'`` (a `Statement`), ``'sql'`` (a
+  `RawQuery`), or ``'list'`` (anything else), and `table` is the name
+  of the primary table of SQLAlchemy result sets, if determinable.
+  `Presorted` wrappers are described by the result set they wrap.
+  '''
+  while isinstance(value, Presorted):
+    value = value.value
+  if isinstance(value, Statement):
+    froms = getattr(value.statement, 'get_final_froms', None)
+    froms = froms() if froms else getattr(value.statement, 'froms', ())
+    return ('core', getattr(froms[0], 'name', None) if froms else None)
+  if isinstance(value, RawQuery):
+    return ('sql', None)
+  if 'sqlalchemy.orm' in sys.modules \
+      and isinstance(value, sys.modules['sqlalchemy.orm'].Query):
+    descs  = value.column_descriptions
+    entity = descs[0].get('entity') if descs else None
+    table  = getattr(entity, '__table__', None)
+    return ('orm', getattr(table, 'name', None))
+  return ('list', None)
+
+
+#------------------------------------------------------------------------------
+class Telemetry(object):
+  '''
+  Aggregates the pagination workload of all views paginated by the
+  paginators that it is configured for (see the `telemetry` option).
+  A `sample` fraction of requests is recorded (as decided by calling
+  `random`), and for each sampled request, the offset, limit, and
+  effective sort specification are counted, along with the time (in
+  milliseconds) spent applying the pagination in the engine (for
+  database result sets, this includes the count query and, except
+  for ORM queries, the page query) and fetching (and mapping) the
+  page items (for ORM queries, this includes the page query). So that
+  the memory used stays bounded, at most `max_sorts` distinct sort
+  specifications are counted per view; any others are counted as
+  ``'*'``.
+  '''
+
+  OTHER_SORTS = '*'
+
+  #----------------------------------------------------------------------------
+  def __init__(self, sample=1.0, random=random.random, max_sorts=64):
+    self.sample = sample
+    self.random = random
+    self.max_sorts = max_sorts
+    self._lock  = threading.Lock()
+    self._views = dict()
+
+  #----------------------------------------------------------------------------
+  def sampled(self):
+    '''
+    Returns whether or not the current request should be recorded.
+    '''
+    return self.sample >= 1 or self.random() < self.sample
+
+  #----------------------------------------------------------------------------
+  def record(self, view, state, value, apply, fetch):
+    '''
+    Records a sampled request to `view`, where `state` is the
+    pagination state, `value` is the result set returned by the
+    mapper, and `apply` and `fetch` are the durations in seconds.
+    '''
+    engine = state.paginator.engine
+    sort   = SortValidator.encode(engine.sorters(state))
+    kind, table = describe_result(value)
+    with self._lock:
+      stats = self._views.get(view)
+      if stats is None:
+        stats = self._views[view] = ViewStats()
+      stats.requests += 1
+      stats.offsets.add(state.offset)
+      stats.limits[state.limit] += 1
+      if sort not in stats.sorts and len(stats.sorts) >= self.max_sorts:
+        sort = self.OTHER_SORTS
+      stats.sorts[sort] += 1
+      stats.apply.add(apply * 1000.0)
+      stats.fetch.add(fetch * 1000.0)
+      stats.kind      = kind
+      stats.table     = table
+      stats.comparers = engine.comparers
+
+  #----------------------------------------------------------------------------
+  def reset(self):
+    with self._lock:
+      self._views.clear()
+
+  #----------------------------------------------------------------------------
+  def report(self):
+    '''
+    Returns a dict that maps each recorded view's name to a dict of
+    its statistics, namely the number of sampled ``requests``, the
+    result set ``kind`` and ``table`` (see :func:`describe_result`), the
+    ``offsets``, ``apply_ms``, and ``fetch_ms`` histograms (see
+    :meth:`Histogram.snapshot`), and the ``limits`` and ``sorts``
+    frequencies.
+    '''
+    with self._lock:
+      return dict(
+        (view, stats.snapshot()) for view, stats in self._views.items())
+
+  #----------------------------------------------------------------------------
+  def recommend_indexes(self, min_share=0.05):
+    '''
+    Returns a list of index recommendations for the sort orders used
+    by the views that paginate SQLAlchemy queries or statements, most
+    requested first. Each recommendation is a dict with the ``view``,
+    the ``table`` (if known), the index ``columns`` as a list of
+    ``[column, 'ASC' or 'DESC']`` lists, the number of sampled
+    ``requests`` it serves along with their ``share`` of the view's
+    requests, and, if the table is known, the suggested ``ddl``.
+
+    Only sort orders used by at least `min_share` of a view's requests
+    and consisting only of column comparers are considered, and sort
+    orders that are served by the index of a longer sort order (i.e.
+    they are a prefix of it, in the same or fully reversed direction)
+    are folded into it.
+    '''
+    with self._lock:
+      views = [
+        (view, stats.table, stats.requests, dict(stats.sorts), stats.comparers)
+        for view, stats in self._views.items()
+        if stats.kind in ('orm', 'core')]
+    ret = []
+    for view, table, requests, sorts, comparers in views:
+      candidates = []
+      for sort, count in sorts.items():
+        if count < min_share * requests:
+          continue
+        columns = self.index_columns(
+          SortValidator.decode(sort), comparers, table)
+        if columns:
+          candidates.append((columns, count))
+      recs = []
+      for columns, count in sorted(
+          candidates, key=lambda cand: (-len(cand[0]), -cand[1])):
+        flipped = [(col, not asc) for col, asc in columns]
+        for rec in recs:
+          if rec[0][:len(columns)] in (columns, flipped):
+            rec[1] += count
+            break
+        else:
+          recs.append([columns, count])
+      for columns, count in recs:
+        rec = dict(
+          view     = view,
+          table    = table,
+          columns  = [
+            [col, 'ASC' if asc else 'DESC'] for col, asc in columns],
+          requests = count,
+          share    = float(count) / requests,
+        )
+        if table:
+          rec['ddl'] = 'CREATE INDEX ix_%s_%s ON %s (%s)' % (
+            table,
+            '_'.join(''.join(c if c.isalnum() else '_' for c in col)
+                     for col, asc in columns),
+            table,
+            ', '.join(col + ( '' if asc else ' DESC' ) for col, asc in columns))
+        ret.append(rec)
+    ret.sort(key=lambda rec: (-rec['requests'], rec['view']))
+    return ret
+
+  #----------------------------------------------------------------------------
+  def index_columns(self, sorters, comparers, table):
+    '''
+    Returns the list of ``(column, ascending)`` tuples for `sorters`,
+    or ``None`` if any of the comparers is not a plain column or
+    column expression (e.g. a callable).
+    '''
+    ret = []
+    for meth, asc in sorters:
+      spec = comparers.get(meth)
+      if spec is None:
+        continue
+      if six.callable(spec) and not hasattr(spec, '__clause_element__'):
+        return None
+      if not morph.isstr(spec):
+        spec = str(spec)
+        if table and spec.startswith(table + '.'):
+          spec = spec[len(table) + 1:]
+      ret.append((spec, asc))
+    return ret or None
+
+#------------------------------------------------------------------------------
+# end of $Id$
+#------------------------------------------------------------------------------
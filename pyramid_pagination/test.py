@@ -12,8 +12,28 @@ import unittest
 from aadict import aadict
 import morph
 from pyramid.request import Request
+from pyramid.threadlocal import get_current_registry
 from six.moves.urllib.parse import urlencode
 
+#------------------------------------------------------------------------------
+class Tracked(object):
+  '''
+  A picklable item that tracks how many instances are alive (including
+  unpickled copies) and the peak thereof, as a portable measure of the
+  memory held by the engine.
+  '''
+  alive = 0
+  peak  = 0
+  def __new__(cls, *args, **kw):
+    cls.alive += 1
+    cls.peak = max(cls.peak, cls.alive)
+    return super(Tracked, cls).__new__(cls)
+  def __init__(self, id, name):
+    self.id   = id
+    self.name = name
+  def __del__(self):
+    type(self).alive -= 1
+
 #------------------------------------------------------------------------------
 class TestListPagination(unittest.TestCase):
 
@@ -39,6 +59,7 @@ class TestListPagination(unittest.TestCase):
           url += '?'
         url += urlencode(kw)
     ret = Request.blank(url)
+    ret.registry = get_current_registry()
     if data is not None:
       ret.data = data
     return ret
@@ -441,15 +462,377 @@ class TestListPagination(unittest.TestCase):
   #----------------------------------------------------------------------------
   def test_map_return_receives_pagination_state(self):
     from .paginator import paginate, Paginator
+    from .state import PaginationState
     @paginate(
       limit_default=5,
       map_return=lambda value, state, **kw: state)
     def n30(request):
       return list(range(30))
     state = n30(self.request())
-    self.assertIsInstance(state, aadict)
+    self.assertIsInstance(state, PaginationState)
     self.assertIsInstance(state.paginator, Paginator)
 
+  #----------------------------------------------------------------------------
+  def test_pagination_state(self):
+    from .state import PaginationState
+    state = PaginationState(offset=10, limit=5)
+    self.assertEqual(state.offset, 10)
+    self.assertEqual(state['limit'], 5)
+    self.assertEqual(state.get('items'), None)
+    self.assertFalse('items' in state)
+    # as with the previous `aadict` state, missing attributes are None
+    self.assertIsNone(state.sort)
+    self.assertIsNone(state.undefined)
+    self.assertNotIn('sort', state)
+    self.assertNotIn('undefined', state)
+    with self.assertRaises(KeyError):
+      state['sort']
+    with self.assertRaises(KeyError):
+      state['undefined']
+    state.update(dict(sort=[('name', True)]), items=(1, 2))
+    state['custom'] = 'value'
+    state.other = 'thing'
+    self.assertEqual(state.custom, 'value')
+    self.assertEqual(state['other'], 'thing')
+    self.assertEqual(
+      sorted(state.keys()),
+      ['custom', 'items', 'limit', 'offset', 'other', 'paginator', 'request', 'sort'])
+    self.assertEqual(
+      dict((key, state[key]) for key in state),
+      dict(paginator=None, request=None, offset=10, limit=5,
+           sort=[('name', True)], items=(1, 2), custom='value', other='thing'))
+    copy = state.copy(offset=0)
+    self.assertEqual((copy.offset, copy.limit, copy.custom), (0, 5, 'value'))
+    self.assertEqual(state.offset, 10)
+    del state['custom']
+    self.assertNotIn('custom', state)
+    with self.assertRaises(AttributeError):
+      state.__dict__
+
+  #----------------------------------------------------------------------------
+  def test_lazy_imports(self):
+    import subprocess, sys
+    out = subprocess.check_output([
+      sys.executable, '-c',
+      'import sys, pyramid_pagination;'
+      ' print("sqlalchemy" in sys.modules)'])
+    self.assertEqual(out.strip(), b'False')
+    # without formencode, the built-in fallbacks are used
+    out = subprocess.check_output([
+      sys.executable, '-c',
+      'import sys; sys.modules["formencode"] = None;'
+      ' import pyramid_pagination as pp;'
+      ' v = pp.SortValidator(if_empty=pp.SmartSort);'
+      ' print((v.to_python("a,b-"), v.to_python("") is pp.SmartSort,'
+      ' hasattr(pp, "RenameFields"),'
+      ' pp.InvalidType() is pp.DecodeError))'])
+    self.assertEqual(
+      out.strip(), b"([('a', True), ('b', False)], True, False, True)")
+
+  #----------------------------------------------------------------------------
+  def test_formencode_validators(self):
+    import formencode
+    from .decoder import SortValidator, RenameFields, SmartSort
+    validator = SortValidator(if_missing=SmartSort)
+    self.assertIsInstance(validator, formencode.validators.FancyValidator)
+    self.assertEqual(validator.to_python('a,b-'), [('a', True), ('b', False)])
+    self.assertEqual(validator.to_python(''), ())
+    with self.assertRaises(formencode.api.Invalid) as cm:
+      validator.to_python(7)
+    self.assertEqual(str(cm.exception), 'Please specify a string or list of strings')
+    class Schema(formencode.Schema):
+      allow_extra_fields = True
+      sort = SortValidator(if_missing=SmartSort)
+      chained_validators = [RenameFields({'sort': 'order'})]
+    self.assertEqual(
+      Schema().to_python({'sort': 'x-'}), {'order': [('x', False)]})
+    self.assertEqual(Schema().to_python({}), {'order': SmartSort})
+
+  #----------------------------------------------------------------------------
+  def test_invalid_params(self):
+    import formencode.api
+    from .paginator import paginate
+    @paginate
+    def handler(request):
+      return [1, 2, 3]
+    with self.assertRaises(formencode.api.Invalid) as cm:
+      handler(self.request(**{'page.offset': 'x', 'page.limit': '-1'}))
+    self.assertEqual(
+      str(cm.exception),
+      'page.limit: Please enter a number that is 0 or greater\n'
+      'page.offset: Please enter an integer value')
+    self.assertEqual(
+      sorted(cm.exception.error_dict.keys()), ['page.limit', 'page.offset'])
+    self.assertEqual(
+      handler(self.request(**{'page.offset': '', 'page.limit': '2'}))['page'],
+      {'offset': 0, 'limit': 2, 'count': 3, 'attribute': 'result'})
+
+  #----------------------------------------------------------------------------
+  def test_limits(self):
+    import formencode.api
+    from .paginator import paginate
+    pager = paginate(limit_max=10, offset_max=100)
+    def items(request):
+      return list(range(200))
+    handler = pager(items)
+    self.assertEqual(
+      handler(self.request(**{'page.limit': '10', 'page.offset': '100'}))['page'],
+      {'offset': 100, 'limit': 10, 'count': 200, 'attribute': 'result'})
+    with self.assertRaises(formencode.api.Invalid) as cm:
+      handler(self.request(**{'page.limit': '11'}))
+    self.assertEqual(
+      str(cm.exception), 'page.limit: Please enter a number from 1 to 10')
+    with self.assertRaises(formencode.api.Invalid) as cm:
+      handler(self.request(**{'page.limit': '0'}))
+    self.assertEqual(
+      str(cm.exception), 'page.limit: Please enter a number from 1 to 10')
+    with self.assertRaises(formencode.api.Invalid) as cm:
+      handler(self.request(**{'page.offset': '101'}))
+    self.assertEqual(
+      str(cm.exception), 'page.offset: Please enter a number that is 100 or smaller')
+    clamped = pager.extend(limit_policy='clamp')(items)
+    self.assertEqual(
+      clamped(self.request(**{'page.limit': '0', 'page.offset': '5000000'}))['page'],
+      {'offset': 100, 'limit': 10, 'count': 200, 'attribute': 'result'})
+    self.assertEqual(
+      handler(self.request())['page'],
+      {'offset': 0, 'limit': 10, 'count': 200, 'attribute': 'result'})
+    self.assertEqual(
+      handler(self.request(**{'page.limit': '25'}))['page'],
+      {'offset': 0, 'limit': 10, 'count': 200, 'attribute': 'result'})
+    unlimited = paginate(limit_default=0, limit_max=10)(items)
+    self.assertEqual(
+      unlimited(self.request())['page'],
+      {'offset': 0, 'limit': 10, 'count': 200, 'attribute': 'result'})
+    with self.assertRaises(formencode.api.Invalid) as cm:
+      unlimited(self.request(**{'page.limit': '11'}))
+
+  #----------------------------------------------------------------------------
+  def test_filters(self):
+    import formencode.api
+    from .paginator import paginate
+    from .state import PaginationState
+    from .collection import SortedCollection
+    people = [
+      dict(name='alice', age=31), dict(name='bob', age=17),
+      dict(name='alfred', age=58), dict(name='carol', age=17)]
+    pager = paginate(
+      comparers=['name', 'age'],
+      filters={'name': 'name', 'age': ('age', int),
+               'adult': lambda pagination, item, op, value: item['age'] >= 18})
+    handler = pager(lambda request: people)
+    names = lambda **kw: [
+      item['name'] for item in handler(self.request(**kw))['result']]
+    self.assertEqual(names(**{'page.filter.age': '17'}), ['bob', 'carol'])
+    self.assertEqual(names(**{'page.filter.name.in': 'bob,alice'}), ['alice', 'bob'])
+    self.assertEqual(names(**{'page.filter.age.range': '18,'}), ['alfred', 'alice'])
+    self.assertEqual(
+      names(**{'page.filter.name.prefix': 'al', 'page.filter.age.range': ',40'}),
+      ['alice'])
+    self.assertEqual(names(**{'page.filter.adult': 'yes'}), ['alfred', 'alice'])
+    # repeated parameters are decoded into a single filter
+    request = self.request('/?page.filter.name.in=bob&page.filter.age=17'
+                           '&page.filter.name.in=alice')
+    self.assertEqual(
+      handler.__paginator__.decoder.filter_params(
+        PaginationState(paginator=handler.__paginator__, request=request)),
+      [('name', 'in', ['bob', 'alice']), ('age', None, ['17'])])
+    self.assertEqual(
+      [item['name'] for item in handler(request)['result']], ['bob'])
+    self.assertEqual(
+      handler(self.request(**{'page.filter.age': '17', 'page.limit': '1'}))['page'],
+      {'offset': 0, 'limit': 1, 'count': 2, 'attribute': 'result'})
+    with self.assertRaises(formencode.api.Invalid) as cm:
+      names(**{'page.filter.height': '3'})
+    self.assertEqual(str(cm.exception), 'page.filter.height: Invalid filter "height"')
+    with self.assertRaises(formencode.api.Invalid) as cm:
+      names(**{'page.filter.age': 'old'})
+    self.assertEqual(str(cm.exception), 'page.filter.age: Invalid filter value')
+    with self.assertRaises(formencode.api.Invalid) as cm:
+      names(**{'page.filter.age.range': '1'})
+    self.assertEqual(
+      str(cm.exception), 'page.filter.age.range: Please specify a range as "MIN,MAX"')
+    with self.assertRaises(formencode.api.Invalid) as cm:
+      names(**{'page.filter.age.like': '1'})
+    self.assertEqual(
+      str(cm.exception), 'page.filter.age.like: Invalid filter operator "like"')
+    collection = pager(lambda request: SortedCollection(people))
+    self.assertEqual(
+      collection(self.request(**{'page.filter.age': '17', 'page.sort': 'name-'}))['result'],
+      [dict(name='carol', age=17), dict(name='bob', age=17)])
+    structured = pager.extend(decoder={'request_param': 'data', 'structured': True})(
+      lambda request: people)
+    self.assertEqual(
+      structured(self.request(page={'filter': {'age': {'range': [18, 40]}}}))['result'],
+      [dict(name='alice', age=31)])
+
+  #----------------------------------------------------------------------------
+  def test_fields(self):
+    import formencode.api
+    from .paginator import paginate
+    people = [
+      dict(id=1, name='alice', age=31, email='a@example.com'),
+      dict(id=2, name='bob', age=17, email='b@example.com')]
+    seen = []
+    pager = paginate(
+      comparers=['name'], fields={'id': 'id', 'name': 'name', 'years': 'age'},
+      map_item=lambda item, **kw: seen.append(item) or item)
+    handler = pager(lambda request: people)
+    self.assertEqual(
+      list(handler(self.request(**{'page.fields': 'name,years'}))['result']),
+      [dict(name='alice', years=31), dict(name='bob', years=17)])
+    self.assertEqual(seen[0], dict(name='alice', years=31))
+    self.assertEqual(list(handler(self.request())['result']), people)
+    with self.assertRaises(formencode.api.Invalid) as cm:
+      handler(self.request(**{'page.fields': 'name,email'}))
+    self.assertEqual(str(cm.exception), 'page.fields: Invalid field "email"')
+    structured = pager.extend(decoder={'request_param': 'data', 'structured': True})(
+      lambda request: people)
+    self.assertEqual(
+      list(structured(self.request(page={'fields': ['id']}))['result']),
+      [dict(id=1), dict(id=2)])
+
+  #----------------------------------------------------------------------------
+  def test_concurrent_requests(self):
+    from multiprocessing.pool import ThreadPool
+    from .paginator import paginate
+    pager  = paginate(comparers=['mod', 'num'])
+    schema = pager.schema
+    self.assertIsNotNone(schema)
+    items  = [dict(num=num, mod=num % 7) for num in range(200)]
+    handler = pager(lambda request: items)
+    def _request(num):
+      offset, limit = num % 50, 1 + num % 13
+      sort = ('mod,num', 'mod-,num', 'num-')[num % 3]
+      keys = dict(
+        [('mod', lambda item: (item['mod'], item['num'])),
+         ('mod-', lambda item: (-item['mod'], item['num'])),
+         ('num-', lambda item: -item['num'])])
+      expected = sorted(items, key=keys[sort.split(',')[0]])[offset:offset + limit]
+      result = handler(self.request(**{
+        'page.offset': str(offset), 'page.limit': str(limit), 'page.sort': sort}))
+      return (result['result'] == expected
+              and result['page'] == dict(
+                offset=offset, limit=limit, sort=sort, count=200,
+                attribute='result'))
+    pool = ThreadPool(16)
+    try:
+      results = pool.map(_request, range(800))
+    finally:
+      pool.close()
+      pool.join()
+    self.assertEqual(results, [True] * 800)
+    self.assertIs(pager.schema, schema)
+
+  #----------------------------------------------------------------------------
+  def test_view_deriver(self):
+    import json
+    from pyramid.config import Configurator
+    from .paginator import paginate, Paginator
+    from .cache import MemoryCache
+    from .telemetry import Telemetry
+    telemetry = Telemetry()
+    pager = paginate(
+      comparers=['num'], limit_default=3, cache=MemoryCache(), telemetry=telemetry)
+    def n10(request):
+      return [dict(num=num) for num in range(10)]
+    class Views(object):
+      def __init__(self, request):
+        self.request = request
+      def evens(self):
+        return [dict(num=num) for num in range(0, 10, 2)]
+      def odds(self):
+        return [dict(num=num) for num in range(1, 10, 2)]
+    config = Configurator()
+    config.include('pyramid_pagination')
+    config.add_route('plain', '/plain')
+    config.add_route('dict', '/dict')
+    config.add_route('paginator', '/paginator')
+    config.add_route('other', '/other')
+    config.add_route('evens', '/evens')
+    config.add_route('odds', '/odds')
+    config.add_view(n10, route_name='plain', renderer='json')
+    config.add_view(n10, route_name='dict', renderer='json',
+                    paginate={'comparers': ['num'], 'limit_default': 2})
+    config.add_view(n10, route_name='paginator', renderer='json', paginate=pager)
+    config.add_view(n10, route_name='other', renderer='json', paginate=pager)
+    config.add_view(Views, attr='evens', route_name='evens', renderer='json', paginate=pager)
+    config.add_view(Views, attr='odds', route_name='odds', renderer='json', paginate=pager)
+    app = config.make_wsgi_app()
+    def get(url):
+      return json.loads(self.request(url).get_response(app).text)
+    self.assertEqual(len(get('/plain')), 10)
+    self.assertEqual(
+      get('/dict?page.sort=num-'),
+      dict(result=[dict(num=9), dict(num=8)],
+           page=dict(offset=0, limit=2, sort='num-', count=10, attribute='result')))
+    self.assertEqual(
+      get('/paginator?page.offset=8'),
+      dict(result=[dict(num=8), dict(num=9)],
+           page=dict(offset=8, limit=3, count=10, attribute='result')))
+    self.assertIs(Paginator.get_paginator(pager(n10)), pager)
+    views = dict(
+      (view['introspectable']['route_name'], view['introspectable']['derived_callable'])
+      for view in config.registry.introspector.get_category('views'))
+    self.assertIsNone(Paginator.get_paginator(views['plain']))
+    self.assertIs(Paginator.get_paginator(views['paginator']), pager)
+    # views of the same callable or class do not share cached output
+    nums = lambda url: [item['num'] for item in get(url)['result']]
+    self.assertEqual(nums('/other'), [0, 1, 2])
+    self.assertEqual(nums('/evens'), [0, 2, 4])
+    self.assertEqual(nums('/odds'), [1, 3, 5])
+    self.assertEqual(
+      sorted(name.split('@')[-1] for name in telemetry.report().keys()),
+      ['evens', 'odds', 'other', 'paginator'])
+    self.assertTrue([
+      name for name in telemetry.report().keys()
+      if name.endswith('.Views.odds@odds')])
+
+  #----------------------------------------------------------------------------
+  def test_presorted(self):
+    from .paginator import paginate
+    from .engine import Presorted
+    calls = []
+    def bynum(a, b):
+      calls.append(1)
+      return cmp(a, b)
+    pager = paginate(comparers={'num': bynum}, presorted='num', limit_default=3)
+    n10 = pager(lambda request: list(range(10)))
+    self.assertEqual(n10(self.request())['result'], [0, 1, 2])
+    self.assertEqual(n10(self.request(**{'page.offset': '8'}))['result'], [8, 9])
+    self.assertEqual(calls, [])
+    self.assertEqual(n10(self.request(**{'page.sort': 'num-'}))['result'], [9, 8, 7])
+    self.assertNotEqual(calls, [])
+    consumed = []
+    def generate():
+      for num in range(1000):
+        consumed.append(num)
+        yield num
+    gen = pager(lambda request: generate())
+    self.assertEqual(
+      gen(self.request(**{'page.offset': '5'})),
+      dict(result=(5, 6, 7), page=dict(offset=5, limit=3, count=1000, attribute='result')))
+    self.assertEqual(len(consumed), 1000)
+    wrapped = paginate(comparers=['num'], limit_default=3)(
+      lambda request: Presorted([dict(num=num) for num in (3, 2, 1)], 'num-'))
+    self.assertEqual(
+      wrapped(self.request(**{'page.sort': 'num-'}))['result'],
+      [dict(num=3), dict(num=2), dict(num=1)])
+    self.assertEqual(
+      wrapped(self.request(**{'page.sort': 'num'}))['result'],
+      [dict(num=1), dict(num=2), dict(num=3)])
+    # `None` comparers are ignored in the declared order as well
+    del calls[:]
+    ranked = paginate(
+      comparers={'rank': None, 'num': bynum}, presorted='rank,num-', limit_default=3)(
+      lambda request: list(range(9, -1, -1)))
+    self.assertEqual(ranked(self.request(**{'page.sort': 'num-'}))['result'], [9, 8, 7])
+    self.assertEqual(calls, [])
+    # telemetry describes the wrapped result set
+    from .engine import RawQuery
+    from .telemetry import describe_result
+    self.assertEqual(describe_result(Presorted(RawQuery('SELECT 1'), 'num')), ('sql', None))
+
   #----------------------------------------------------------------------------
   def test_keep_items_default(self):
     from .paginator import paginate
@@ -491,6 +874,549 @@ class TestListPagination(unittest.TestCase):
         result = [0, 1, 2],
         page   = {'count': 30, 'attribute': 'result', 'limit': 3, 'offset': 0}))
 
+  #----------------------------------------------------------------------------
+  def test_iterable_spilled(self):
+    from .paginator import paginate
+    @paginate(
+      engine={'spill_size': 7, 'spill_merge': 3},
+      comparers={'num': cmp}, decoder={'request_param': 'data'})
+    def n300(request):
+      return ( ( num * 7 ) % 300 for num in range(300) )
+    self.assertEqual(
+      n300(self.request(**{'page.offset': 290, 'page.limit': 5})),
+      dict(
+        result = (290, 291, 292, 293, 294),
+        page   = dict(offset=290, limit=5, count=300, attribute='result')))
+    self.assertEqual(
+      n300(self.request(**{'page.sort': 'num-', 'page.offset': 295, 'page.limit': 0})),
+      dict(
+        result = (4, 3, 2, 1, 0),
+        page   = dict(offset=295, limit=0, count=300, sort='num-', attribute='result')))
+
+  #----------------------------------------------------------------------------
+  def test_iterable_spilled_stable(self):
+    from .paginator import paginate
+    pager = paginate(
+      engine={'spill_size': 7, 'spill_merge': 3},
+      comparers=['key'], decoder={'request_param': 'data'})
+    def items():
+      return ( dict(key=num % 4, num=num) for num in range(100) )
+    spilled = pager(lambda request: items())
+    inmemory = pager(lambda request: list(items()))
+    for params in ({'page.sort': 'key'}, {'page.sort': 'key-'}):
+      params['page.limit'] = 0
+      expect = inmemory(self.request(**params))['result']
+      self.assertEqual(
+        [item['num'] for item in expect[:4]],
+        [0, 4, 8, 12] if params['page.sort'] == 'key' else [3, 7, 11, 15])
+      self.assertEqual(
+        tuple(spilled(self.request(**params))['result']), tuple(expect))
+
+  #----------------------------------------------------------------------------
+  def test_multi_source(self):
+    from .paginator import paginate
+    from .engine import MultiSource
+    def evens():
+      for num in range(0, 40, 2):
+        yield dict(num=num)
+    @paginate(comparers=['num'], decoder={'request_param': 'data'})
+    def nums(request):
+      return MultiSource(
+        [dict(num=num) for num in range(1, 40, 2)], evens(), [dict(num=7)])
+    self.assertEqual(
+      nums(self.request(**{'page.offset': 5, 'page.limit': 4})),
+      dict(
+        result = (dict(num=5), dict(num=6), dict(num=7), dict(num=7)),
+        page   = dict(offset=5, limit=4, count=41, attribute='result')))
+    self.assertEqual(
+      nums(self.request(**{'page.sort': 'num-', 'page.limit': 3})),
+      dict(
+        result = (dict(num=39), dict(num=38), dict(num=37)),
+        page   = dict(offset=0, limit=3, count=41, sort='num-', attribute='result')))
+    self.assertEqual(
+      [item['num'] for item in nums(
+        self.request(**{'page.offset': 38, 'page.limit': 0}))['result']],
+      [37, 38, 39])
+
+  #----------------------------------------------------------------------------
+  def test_sorted_collection(self):
+    from .paginator import paginate
+    from .collection import SortedCollection
+    items = SortedCollection(
+      dict(id=num, name='n' + str(num % 5)) for num in range(200))
+    compares = []
+    def cmp_id(a, b):
+      compares.append(1)
+      return cmp(a['id'], b['id'])
+    @paginate(comparers={'name': 'name', 'id': cmp_id}, decoder={'request_param': 'data'})
+    def handler(request):
+      return items
+    def ids(**kw):
+      ret = handler(self.request(**kw))
+      return ret['page']['count'], [item['id'] for item in ret['result']]
+    self.assertEqual(ids(**{'page.sort': 'id-', 'page.limit': 3}), (200, [199, 198, 197]))
+    self.assertEqual(
+      ids(**{'page.sort': 'name-', 'page.limit': 6}), (200, [4, 9, 14, 19, 24, 29]))
+    # subsequent requests do not sort, and modifications only bisect
+    del compares[:]
+    self.assertEqual(ids(**{'page.sort': 'id-', 'page.offset': 3, 'page.limit': 2}), (200, [196, 195]))
+    self.assertEqual(compares, [])
+    items.add(dict(id=1000, name='n4'))
+    items.remove(dict(id=199, name='n4'))
+    self.assertLess(len(compares), 50)
+    self.assertEqual(ids(**{'page.sort': 'id-', 'page.limit': 2}), (200, [1000, 198]))
+    self.assertEqual(
+      ids(**{'page.sort': 'name-', 'page.limit': 6}), (200, [4, 9, 14, 19, 24, 29]))
+    self.assertEqual(
+      ids(**{'page.sort': 'name-,id', 'page.limit': 0, 'page.offset': 198}), (200, [190, 195]))
+    with self.assertRaises(ValueError):
+      items.remove(dict(id=199, name='n4'))
+    # equivalent sort specifications share an ordering
+    self.assertEqual(len(items._orderings), 3)
+    self.assertEqual(
+      ids(**{'page.sort': 'id-,id', 'page.limit': 2}), (200, [1000, 198]))
+    self.assertEqual(len(items._orderings), 3)
+    # only the most recently used orderings are kept
+    items.max_orderings = 2
+    ids(**{'page.sort': 'name', 'page.limit': 2})
+    self.assertEqual(
+      list(items._orderings.keys()),
+      [(('id', False, cmp_id),), (('name', True, 'name'),)])
+
+  #----------------------------------------------------------------------------
+  def test_dataset(self):
+    from .paginator import paginate
+    from .collection import Dataset
+    items = [
+      dict(id=num, name='n' + str(( num * 7 ) % 5), size=( num * 13 ) % 11)
+      for num in range(100)]
+    compares = []
+    def cmp_size(a, b):
+      compares.append(1)
+      return cmp(a['size'], b['size'])
+    pager   = paginate(
+      comparers={'id': 'id', 'name': 'name', 'size': cmp_size},
+      decoder={'request_param': 'data'})
+    dataset = pager.register(items)
+    self.assertIsInstance(dataset, Dataset)
+    self.assertEqual(dataset.nbytes, 3 * 2 * 100 * dataset.orders['id'][1].itemsize)
+    listed  = pager(lambda request: items)
+    indexed = pager(lambda request: dataset)
+    for sort in ('size', 'size-', 'name,size-', 'name-,id-', 'size,name', ''):
+      for offset, limit in ((0, 10), (7, 13), (95, 10), (20, 0), (120, 5)):
+        request = {'page.sort': sort, 'page.offset': offset, 'page.limit': limit}
+        self.assertEqual(
+          indexed(self.request(**request)), listed(self.request(**request)))
+    del compares[:]
+    result = indexed(self.request(**{'page.sort': 'size-', 'page.limit': 5}))
+    self.assertEqual(compares, [])
+    self.assertEqual(
+      [item['id'] for item in result['result']], [5, 16, 27, 38, 49])
+    self.assertEqual(result['page']['count'], 100)
+
+  #----------------------------------------------------------------------------
+  def test_profile(self):
+    from .paginator import paginate
+    from .profiling import Profiler
+    profiles = []
+    def sink(request, state, profile):
+      profiles.append((state, profile))
+    def handler(request):
+      return [dict(id=num) for num in range(50)]
+    pager = paginate(
+      comparers=['id'], profile_sink=sink,
+      profile=lambda request: request.headers.get('X-Profile') == 'on'
+        and request.remote_addr in ('127.0.0.1',))
+    paged = pager(handler)
+    request = self.request(**{'page.limit': '2'})
+    self.assertEqual(
+      paged(request),
+      dict(result=[dict(id=0), dict(id=1)],
+           page=dict(offset=0, limit=2, count=50, attribute='result')))
+    self.assertEqual(profiles, [])
+    self.assertNotIn('profile', request.pagination)
+    request = self.request(**{'page.limit': '2'})
+    request.headers['X-Profile'] = 'on'
+    request.remote_addr = '127.0.0.1'
+    self.assertEqual(paged(request)['page']['count'], 50)
+    self.assertEqual(len(profiles), 1)
+    state, profile = profiles[0]
+    self.assertIs(state, request.pagination)
+    self.assertIs(state.profile, profile)
+    self.assertNotIn('errors', profile)
+    self.assertEqual(
+      sorted(profile['phases'].keys()), ['decode', 'engine', 'handler', 'mapper'])
+    self.assertGreater(profile['phases']['handler'], 0)
+    self.assertGreaterEqual(profile['elapsed'], profile['phases']['engine'])
+    self.assertLessEqual(len(profile['functions']), 20)
+    if 'tracemalloc' not in Profiler.DEFAULT_MODES:
+      # python 2: memory profiling is only enabled when available
+      self.assertNotIn('memory', profile)
+      pager.extend(profile_modes=['tracemalloc'])(handler)(request)
+      self.assertEqual(profiles[-1][1]['errors'], ['tracemalloc: not available'])
+      return
+    self.assertGreater(profile['memory']['peak'], 0)
+    self.assertTrue(profile['memory']['top'])
+    paged = pager.extend(profile_modes=['tracemalloc'], profile_limit=3)(handler)
+    paged(request)
+    profile = profiles[-1][1]
+    self.assertEqual(sorted(profile.keys()), ['elapsed', 'memory'])
+    self.assertLessEqual(len(profile['memory']['top']), 3)
+
+  #----------------------------------------------------------------------------
+  def test_multi_mapper(self):
+    import threading
+    import formencode.api
+    from .paginator import paginate
+    from .mapper import MultiMapper
+    # note: a rendezvous of both collections (`threading.Barrier` is not
+    #       available on python 2) ensures that they are evaluated
+    #       concurrently -- sequential evaluation would time out
+    arrived = []
+    rendezvous = threading.Condition()
+    def items(count):
+      with rendezvous:
+        arrived.append(threading.current_thread())
+        rendezvous.notify_all()
+        while len(arrived) % 2:
+          rendezvous.wait(5)
+          if len(arrived) % 2:
+            raise AssertionError('collections were not evaluated concurrently')
+      for num in range(count):
+        yield dict(id=num, name='n' + str(count - num))
+    @paginate(
+      mapper=MultiMapper([
+        ('users',         dict(comparers=['id', 'name'], limit_default=2)),
+        ('groups.active', dict(comparers=['name'])),
+      ]))
+    def dashboard(request):
+      return dict(title='Dashboard', users=items(5), groups=dict(active=items(3)))
+    self.assertEqual(
+      dashboard(self.request(**{'users.sort': 'id-', 'active.offset': '1'})),
+      dict(
+        title  = 'Dashboard',
+        users  = [dict(id=4, name='n1'), dict(id=3, name='n2')],
+        groups = dict(active=[dict(id=1, name='n2'), dict(id=0, name='n3')]),
+        page   = dict(
+          users  = dict(offset=0, limit=2, count=5, sort='id-', attribute='users'),
+          active = dict(offset=1, limit=25, count=3, attribute='groups.active'))))
+    request = self.request(**{'active.limit': '1'})
+    dashboard(request)
+    self.assertEqual(
+      [(name, state.limit) for name, state in request.pagination.collections.items()],
+      [('users', 2), ('active', 1)])
+    self.assertEqual(len(arrived), 4)
+    self.assertNotEqual(arrived[0], arrived[1])
+    with self.assertRaises(formencode.api.Invalid) as cm:
+      dashboard(self.request(**{'active.sort': 'id'}))
+    self.assertEqual(
+      str(cm.exception), 'active.sort: Invalid sorting method "id"')
+
+  #----------------------------------------------------------------------------
+  def test_multi_mapper_etag(self):
+    from pyramid.httpexceptions import HTTPNotModified
+    from .paginator import paginate
+    from .mapper import MultiMapper
+    @paginate(
+      version=lambda state, **kw: 'v1',
+      mapper=MultiMapper([
+        ('users',         dict(comparers=['id'], limit_default=2)),
+        ('groups.active', dict(comparers=['id'])),
+      ], concurrent=False))
+    def dashboard(request):
+      return dict(
+        users=[dict(id=num) for num in range(5)],
+        groups=dict(active=[dict(id=num) for num in range(3)]))
+    request = self.request()
+    dashboard(request)
+    etag = request.response.etag
+    request = self.request()
+    request.if_none_match = etag
+    self.assertIsInstance(dashboard(request), HTTPNotModified)
+    # changing any collection's parameters invalidates the etag
+    for params in ({'users.offset': '2'}, {'active.sort': 'id-'}, {'active.limit': '1'}):
+      request = self.request(**params)
+      request.if_none_match = etag
+      ret = dashboard(request)
+      self.assertIsInstance(ret, dict)
+      self.assertNotEqual(request.response.etag, etag)
+    self.assertEqual([item['id'] for item in ret['groups']['active']], [0])
+
+  #----------------------------------------------------------------------------
+  def test_iterable_spilled_memory(self):
+    import gc
+    from .engine import Engine
+    def peak(size, engine=Engine(comparers=['id'], spill_size=100, spill_merge=4)):
+      items = ( Tracked((num * 7919) % size, 'item-' + str(num))
+                for num in range(size) )
+      gc.collect()
+      Tracked.alive = Tracked.peak = 0
+      value = engine.apply(aadict(offset=5, limit=2, sort=[('id', True)]), items)
+      self.assertEqual([item.id for item in value[0]], [5, 6])
+      self.assertEqual(value[1], dict(count=size))
+      return Tracked.peak
+    # the number of items held at any one time is bounded by the spill
+    # and merge sizes, i.e. independent of the result set size
+    small = peak(2000)
+    large = peak(16000)
+    self.assertLessEqual(small, 100 * 6)
+    self.assertLessEqual(large, small * 1.2)
+    self.assertEqual(peak(2000, Engine(comparers=['id'])), 2000)
+
+  #----------------------------------------------------------------------------
+  def test_stream_json(self):
+    import json
+    from .paginator import paginate
+    from .stream import StreamingMapper, JsonStream
+    @paginate(
+      limit_default=5,
+      mapper=StreamingMapper(chunk_size=2, target='result'),
+      map_item=lambda item, **kw: item)
+    def n30(request):
+      return dict(meta='data', result=( num for num in range(30) ))
+    ret = n30(self.request())
+    self.assertIsInstance(ret, JsonStream)
+    self.assertIsInstance(ret.items, types.GeneratorType)
+    chunks = list(ret)
+    self.assertTrue(chunks[0].startswith(b'{"page": {'))
+    self.assertEqual(len(chunks), 5)
+    self.assertEqual(
+      json.loads(b''.join(chunks).decode('utf-8')),
+      dict(
+        meta   = 'data',
+        result = [0, 1, 2, 3, 4],
+        page   = dict(offset=0, limit=5, count=30, attribute='result')))
+
+  #----------------------------------------------------------------------------
+  def test_stream_json_renderer(self):
+    import json
+    from pyramid.config import Configurator
+    from .paginator import paginate
+    from .stream import StreamingMapper, JsonStream, JsonStreamRenderer
+    @paginate(mapper=StreamingMapper(target='data.items'), map_item=lambda item, **kw: dict(n=item))
+    def n30(context, request):
+      return dict(data=dict(items=list(range(30))))
+    config = Configurator()
+    config.add_renderer('json-stream', JsonStreamRenderer())
+    config.add_route('n30', '/n30')
+    config.add_view(n30, route_name='n30', renderer='json-stream')
+    response = self.request('/n30?page.offset=27').get_response(config.make_wsgi_app())
+    self.assertEqual(response.content_type, 'application/json')
+    self.assertIsInstance(response.app_iter, JsonStream)
+    self.assertEqual(
+      json.loads(response.body.decode('utf-8')),
+      dict(
+        data   = dict(items=[dict(n=27), dict(n=28), dict(n=29)]),
+        page   = dict(offset=27, limit=25, count=30, attribute='data.items')))
+
+  #----------------------------------------------------------------------------
+  def test_version_etag(self):
+    from pyramid.httpexceptions import HTTPNotModified
+    from .paginator import paginate
+    calls = []
+    version = ['v1']
+    @paginate(limit_default=3, version=lambda state, **kw: version[0])
+    def n30(request):
+      calls.append(request)
+      return list(range(30))
+    request = self.request()
+    self.assertEqual(
+      n30(request),
+      dict(
+        result = [0, 1, 2],
+        page   = dict(offset=0, limit=3, count=30, attribute='result')))
+    etag = request.response.etag
+    self.assertTrue(etag)
+    self.assertEqual(len(calls), 1)
+    request = self.request()
+    request.if_none_match = etag
+    ret = n30(request)
+    self.assertIsInstance(ret, HTTPNotModified)
+    self.assertEqual(ret.etag, etag)
+    self.assertEqual(len(calls), 1)
+    request = self.request(**{'page.offset': '3'})
+    request.if_none_match = etag
+    self.assertEqual(n30(request)['result'], [3, 4, 5])
+    self.assertNotEqual(request.response.etag, etag)
+    version[0] = 'v2'
+    request = self.request()
+    request.if_none_match = etag
+    self.assertEqual(n30(request)['result'], [0, 1, 2])
+    self.assertEqual(len(calls), 3)
+
+  #----------------------------------------------------------------------------
+  def test_cache(self):
+    from .paginator import paginate
+    from .cache import MemoryCache
+    now = [1000]
+    cache = MemoryCache(ttl=10, maxsize=3, clock=lambda: now[0])
+    calls = []
+    @paginate(
+      limit_default=3, cache=cache, cache_tags=('numbers',),
+      cache_vary=lambda request: request.params.get('user'))
+    def n30(request):
+      calls.append(request)
+      return list(range(30))
+    first = n30(self.request())
+    self.assertEqual(
+      first,
+      dict(
+        result = [0, 1, 2],
+        page   = dict(offset=0, limit=3, count=30, attribute='result')))
+    second = n30(self.request())
+    self.assertEqual(second, first)
+    self.assertIsNot(second, first)
+    self.assertIsNot(second['result'], first['result'])
+    second['result'].append(3)
+    self.assertEqual(n30(self.request())['result'], [0, 1, 2])
+    self.assertEqual(len(calls), 1)
+    self.assertEqual(n30(self.request(**{'page.offset': '3'}))['result'], [3, 4, 5])
+    self.assertEqual(n30(self.request(user='alice'))['result'], [0, 1, 2])
+    self.assertEqual(len(calls), 3)
+    self.assertEqual(
+      cache.stats(),
+      dict(hits=2, misses=3, expirations=0, evictions=0, size=3))
+    # LRU: re-using `first` leaves offset=3 as the least recently used
+    n30(self.request())
+    n30(self.request(user='bob'))
+    self.assertEqual(cache.stats()['evictions'], 1)
+    n30(self.request())
+    self.assertEqual(len(calls), 4)
+    # TTL
+    now[0] += 11
+    self.assertIsNot(n30(self.request()), first)
+    self.assertEqual(len(calls), 5)
+    self.assertEqual(cache.stats()['expirations'], 1)
+    # tag invalidation
+    cache.invalidate('numbers')
+    self.assertEqual(cache.stats()['size'], 0)
+    n30(self.request())
+    self.assertEqual(len(calls), 6)
+    # all request parameters are part of the key
+    self.assertEqual(n30(self.request(q='a'))['result'], [0, 1, 2])
+    self.assertEqual(n30(self.request(q='b'))['result'], [0, 1, 2])
+    self.assertEqual(len(calls), 8)
+
+  #----------------------------------------------------------------------------
+  def test_cache_uncacheable(self):
+    from pyramid.httpexceptions import HTTPNotModified
+    from .paginator import paginate
+    from .cache import MemoryCache
+    from .stream import StreamingMapper, JsonStream
+    cache = MemoryCache()
+    calls = []
+    version = ['v1']
+    @paginate(
+      limit_default=3, cache=cache, version=lambda state, **kw: version[0])
+    def n30(request):
+      calls.append(request)
+      return list(range(30))
+    request = self.request()
+    n30(request)
+    etag = request.response.etag
+    # a 304 response is never cached...
+    cache.clear()
+    request = self.request()
+    request.if_none_match = etag
+    self.assertIsInstance(n30(request), HTTPNotModified)
+    self.assertEqual(cache.stats()['size'], 0)
+    self.assertEqual(n30(self.request())['result'], [0, 1, 2])
+    self.assertEqual(len(calls), 2)
+    # ... but cache hits still set up the state and honor the etag
+    request = self.request()
+    self.assertEqual(n30(request)['result'], [0, 1, 2])
+    self.assertEqual(request.pagination.limit, 3)
+    self.assertEqual(request.response.etag, etag)
+    request = self.request()
+    request.if_none_match = etag
+    self.assertIsInstance(n30(request), HTTPNotModified)
+    self.assertEqual(len(calls), 2)
+    # hits skip decoding, but restore the decoded state
+    from .decoder import SmartSort
+    decoded = []
+    decode  = n30.__paginator__.decoder.decode
+    n30.__paginator__.decoder.decode = lambda *args: decoded.append(1) or decode(*args)
+    try:
+      request = self.request(**{'page.offset': '3'})
+      self.assertEqual(n30(request)['result'], [3, 4, 5])
+      self.assertEqual(len(decoded), 1)
+      request = self.request(**{'page.offset': '3'})
+      self.assertEqual(n30(request)['result'], [3, 4, 5])
+      self.assertEqual(len(decoded), 1)
+      self.assertEqual(
+        (request.pagination.offset, request.pagination.limit, request.pagination.sort),
+        (3, 3, SmartSort))
+    finally:
+      del n30.__paginator__.decoder.decode
+    # entries of a previous version are replaced, not served
+    version[0] = 'v2'
+    request = self.request()
+    request.if_none_match = etag
+    self.assertEqual(n30(request)['result'], [0, 1, 2])
+    self.assertEqual(len(calls), 4)
+    self.assertNotEqual(request.response.etag, etag)
+    request = self.request()
+    self.assertEqual(n30(request)['result'], [0, 1, 2])
+    self.assertEqual(len(calls), 4)
+    # streams and generators are consumed lazily
+    @paginate(
+      limit_default=3, cache=cache,
+      mapper=StreamingMapper(chunk_size=2, target='result'),
+      map_item=lambda item, **kw: item)
+    def streamed(request):
+      return dict(result=( num for num in range(30) ))
+    self.assertIsInstance(streamed(self.request()), JsonStream)
+    @paginate(limit_default=3, cache=cache, mapper={'target': 'result'})
+    def generated(request):
+      calls.append(request)
+      return dict(result=list(range(30)), extra=( num for num in range(3) ))
+    size = cache.stats()['size']
+    self.assertEqual(list(generated(self.request())['extra']), [0, 1, 2])
+    self.assertEqual(list(generated(self.request())['extra']), [0, 1, 2])
+    self.assertEqual(len(calls), 6)
+    self.assertEqual(cache.stats()['size'], size)
+
+  #----------------------------------------------------------------------------
+  def test_cache_sqlite(self):
+    import os, shutil, tempfile, subprocess, sys
+    from .paginator import paginate
+    from .cache import SqliteCache
+    tmpdir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmpdir)
+    path = os.path.join(tmpdir, 'cache.db')
+    now = [1000]
+    cache = SqliteCache(path, ttl=10, maxsize=2, clock=lambda: now[0])
+    calls = []
+    @paginate(limit_default=3, cache=cache, cache_tags=('numbers',))
+    def n30(request):
+      calls.append(request)
+      return list(range(30))
+    expected = dict(
+      result = [0, 1, 2],
+      page   = dict(offset=0, limit=3, count=30, attribute='result'))
+    self.assertEqual(n30(self.request()), expected)
+    self.assertEqual(n30(self.request()), expected)
+    self.assertEqual(len(calls), 1)
+    self.assertEqual(
+      cache.stats(),
+      dict(hits=1, misses=1, expirations=0, evictions=0, size=1))
+    # shared with other processes
+    subprocess.check_call([sys.executable, '-c', (
+      'from pyramid_pagination.cache import SqliteCache;'
+      'SqliteCache(%r).put("other", [1, 2, 3], ttl=0, tags=["numbers"])' % (path,))],
+      cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    self.assertEqual(cache.get('other'), [1, 2, 3])
+    # eviction, expiry & invalidation
+    n30(self.request(**{'page.offset': '3'}))
+    self.assertEqual(cache.stats()['evictions'], 1)
+    self.assertEqual(cache.get('other'), [1, 2, 3])
+    now[0] += 11
+    n30(self.request(**{'page.offset': '3'}))
+    self.assertEqual(cache.stats()['expirations'], 1)
+    self.assertEqual(len(calls), 3)
+    cache.invalidate('numbers')
+    self.assertEqual(cache.stats()['size'], 0)
+
 
 #------------------------------------------------------------------------------
 class TestSqlalchemyPagination(unittest.TestCase):
@@ -505,7 +1431,10 @@ class TestSqlalchemyPagination(unittest.TestCase):
   #----------------------------------------------------------------------------
   def makedb(self):
     import sqlalchemy as sa
-    from sqlalchemy.ext.declarative import declarative_base
+    try:
+      from sqlalchemy.orm import declarative_base
+    except ImportError:
+      from sqlalchemy.ext.declarative import declarative_base
     from sqlalchemy.orm import sessionmaker
     engine = sa.create_engine('sqlite://')
     Base = declarative_base()
@@ -652,6 +1581,546 @@ class TestSqlalchemyPagination(unittest.TestCase):
         page   = dict(offset=0, limit=25, count=4, sort='name,age-', attribute='result'),
         result = [4, 2, 1, 3]))
 
+  #----------------------------------------------------------------------------
+  def test_sqlalchemy_sort_cached(self):
+    import sqlalchemy as sa
+    from sqlalchemy.engine import default
+    if not hasattr(default, 'CACHE_MISS'):
+      raise unittest.SkipTest('SQLAlchemy version does not cache compilation')
+    model = self.populate(self.makedb())
+    from .paginator import paginate
+    @paginate(comparers={'name': 'name', 'age': model.Person.age}, decoder={'request_param': 'data'})
+    def peeps(request):
+      return self.query(model, request)
+    misses = []
+    @sa.event.listens_for(model.engine, 'before_cursor_execute')
+    def _count(conn, cursor, statement, params, context, executemany):
+      if context.cache_hit is default.CACHE_MISS:
+        misses.append(statement)
+    for offset in range(3):
+      self.assertEqual(
+        self.dictify(peeps(self.request(**{'page.sort': 'name-,age', 'page.offset': offset, 'page.limit': 1})), pluck='id'),
+        dict(
+          page   = dict(offset=offset, limit=1, count=4, sort='name-,age', attribute='result'),
+          result = [[3, 1, 2][offset]]))
+    # count query + page query, each compiled once only
+    self.assertEqual(len(misses), 2)
+    p8n = aadict(sort=[('name', False), ('age', True)])
+    engine = paginate.get_paginator(peeps).engine
+    self.assertIs(
+      engine.ordering(p8n, model.Person), engine.ordering(p8n, model.Person))
+    # equivalent sort specifications share the steps, which are bounded
+    self.assertIs(
+      engine.ordering(aadict(sort=[('name', False), ('age', True), ('name', True)]), model.Person),
+      engine.ordering(p8n, model.Person))
+    engine = engine.extend(max_orderings=2)
+    steps = engine.ordering(p8n, model.Person)
+    engine.ordering(aadict(sort=[('name', True)]), model.Person)
+    self.assertIs(engine.ordering(p8n, model.Person), steps)
+    engine.ordering(aadict(sort=[('age', True)]), model.Person)
+    self.assertEqual(
+      list(engine._orderings.keys()),
+      [(model.Person, (('name', False), ('age', True))),
+       (model.Person, (('age', True),))])
+    self.assertEqual(
+      str(sa.select(model.Person.id).order_by(*engine.order_by(p8n, model.Person))),
+      str(sa.select(model.Person.id).order_by(model.Person.name.desc(), model.Person.age)))
+
+  #----------------------------------------------------------------------------
+  def test_sqlalchemy_statement(self):
+    import sqlalchemy as sa
+    if not hasattr(sa.sql.Select, 'subquery'):
+      raise unittest.SkipTest('SQLAlchemy version does not support 2.0-style statements')
+    model = self.populate(self.makedb())
+    from .paginator import paginate
+    from .engine import Statement
+    persons = model.Person.__table__
+    @paginate(sort_default='name,age-', comparers={'name': 'name', 'age': persons.c.age}, decoder={'request_param': 'data'})
+    def peeps(request):
+      stmt = sa.select(persons.c.id, persons.c.name)
+      if 'minage' in request.data:
+        stmt = stmt.where(persons.c.age >= request.data['minage'])
+      return Statement(stmt, model.session, mappings=request.data.get('mappings'))
+    self.assertEqual(
+      peeps(self.request(**{'page.limit': 3})),
+      dict(
+        page   = dict(offset=0, limit=3, count=4, attribute='result'),
+        result = ((4, 'acrn'), (2, 'delt'), (1, 'zeta'))))
+    with model.engine.connect() as conn:
+      @paginate(comparers={'age': 'age'}, decoder={'request_param': 'data'})
+      def peepsc(request):
+        return Statement(sa.select(persons), conn, mappings=True)
+      self.assertEqual(
+        self.dictify(peepsc(self.request(**{'page.sort': 'age-', 'page.offset': 1})), pluck='id'),
+        dict(
+          page   = dict(offset=1, limit=25, count=4, sort='age-', attribute='result'),
+          result = [4, 3, 2]))
+    self.assertEqual(
+      peeps(self.request(**{'minage': 5, 'mappings': True})),
+      dict(
+        page   = dict(offset=0, limit=25, count=2, attribute='result'),
+        result = (dict(id=4, name='acrn'), dict(id=1, name='zeta'))))
+
+  #----------------------------------------------------------------------------
+  def test_sqlalchemy_filters(self):
+    import sqlalchemy as sa
+    model = self.populate(self.makedb())
+    from .paginator import paginate
+    from .engine import Statement
+    persons = model.Person.__table__
+    pager = paginate(
+      comparers=['name', 'id'], sort_default='name,id',
+      filters={'name': 'name', 'age': ('age', int),
+               'core_age': (persons.c.age, int),
+               'adult': lambda pagination, query, op, value:
+                 query.filter(sa.literal_column('age') >= 5)})
+    @pager
+    def peeps(request):
+      return model.session.query(model.Person)
+    @pager
+    def peepsc(request):
+      return Statement(sa.select(persons.c.id, persons.c.name), model.engine)
+    self.assertEqual(
+      self.dictify(peeps(self.request(**{
+        'page.filter.name': 'zeta', 'page.limit': '1'})), pluck='id'),
+      dict(page=dict(offset=0, limit=1, count=2, attribute='result'), result=[1]))
+    self.assertEqual(
+      self.dictify(peeps(self.request(**{
+        'page.filter.age.range': '3,7', 'page.filter.name.prefix': 'z'})), pluck='id'),
+      dict(page=dict(offset=0, limit=25, count=1, attribute='result'), result=[3]))
+    self.assertEqual(
+      self.dictify(peeps(self.request(**{'page.filter.adult': '1'})), pluck='id'),
+      dict(page=dict(offset=0, limit=25, count=2, attribute='result'), result=[4, 1]))
+    self.assertEqual(
+      [row.id for row in peepsc(self.request(**{'page.filter.core_age.in': '2,8'}))['result']],
+      [2, 1])
+    self.assertEqual(
+      peepsc(self.request(**{'page.filter.name.prefix': 'z_'}))['page']['count'], 0)
+
+  #----------------------------------------------------------------------------
+  def test_sqlalchemy_fields(self):
+    import sqlalchemy as sa
+    model = self.populate(self.makedb())
+    from .paginator import paginate
+    from .engine import Statement
+    persons = model.Person.__table__
+    pager = paginate(comparers=['name', 'id'], sort_default='name,id', fields=['id', 'name'])
+    @pager
+    def peeps(request):
+      return model.session.query(model.Person)
+    @pager
+    def peepsc(request):
+      return Statement(sa.select(persons), model.engine, mappings=True)
+    result = peeps(self.request(**{'page.fields': 'name', 'page.limit': '2'}))['result']
+    self.assertEqual([peep.id for peep in result], [4, 2])
+    self.assertEqual(
+      [sorted(sa.inspect(peep).unloaded) for peep in result], [['age'], ['age']])
+    self.assertEqual(
+      [dict(row) for row in peepsc(self.request(**{'page.fields': 'id', 'page.limit': '2'}))['result']],
+      [dict(id=4), dict(id=2)])
+
+  #----------------------------------------------------------------------------
+  def test_sqlalchemy_yield_per(self):
+    import sqlalchemy as sa
+    model = self.populate(self.makedb())
+    from .paginator import paginate
+    from .engine import Statement
+    from .cache import MemoryCache
+    persons = model.Person.__table__
+    cache = MemoryCache()
+    pager = paginate(
+      comparers=['name', 'id'], sort_default='name,id',
+      engine={'yield_per': 2}, cache=cache)
+    @pager
+    def peeps(request):
+      return model.session.query(model.Person)
+    @pager
+    def peepsc(request):
+      return Statement(sa.select(persons.c.id), model.engine)
+    request = self.request(**{'page.limit': '0'})
+    result = peeps(request)
+    self.assertTrue(request.pagination.stream)
+    self.assertNotIsInstance(result['result'], (list, tuple))
+    self.assertEqual(result['page']['count'], 4)
+    self.assertEqual([peep.id for peep in result['result']], [4, 2, 1, 3])
+    model.session.close()
+    events = []
+    sa.event.listen(model.engine, 'checkout', lambda *args: events.append('out'))
+    sa.event.listen(model.engine, 'checkin', lambda *args: events.append('in'))
+    result = peepsc(self.request(**{'page.limit': '0', 'page.offset': '1'}))['result']
+    self.assertEqual(events, ['out'])
+    self.assertEqual([row.id for row in result], [2, 1, 3])
+    # the connection is released once the stream is exhausted
+    self.assertEqual(events, ['out', 'in'])
+    self.assertEqual(
+      [row.id for row in peepsc(self.request(**{'page.limit': '2'}))['result']],
+      [4, 2])
+    self.assertEqual(events, ['out', 'in', 'out', 'in'])
+    self.assertEqual(cache.stats()['size'], 0)
+    request = self.request(**{'page.limit': '2'})
+    self.assertIsInstance(peeps(request)['result'], tuple)
+    self.assertNotIn('stream', request.pagination)
+
+  #----------------------------------------------------------------------------
+  def test_sqlalchemy_presorted(self):
+    import sqlalchemy as sa
+    model = self.populate(self.makedb())
+    from .paginator import paginate
+    from .engine import Presorted, Statement
+    persons = model.Person.__table__
+    # note: the declared orders deliberately differ from the actual
+    #       orders, which shows that no ORDER BY clause is appended
+    @paginate(comparers=['name', 'id'], presorted='name,id')
+    def peeps(request):
+      return model.session.query(model.Person)
+    self.assertEqual(
+      self.dictify(peeps(self.request()), pluck='id')['result'], [1, 2, 3, 4])
+    self.assertEqual(
+      self.dictify(peeps(self.request(**{'page.sort': 'id-'})), pluck='id')['result'],
+      [4, 3, 2, 1])
+    @paginate(comparers=['name', 'id'])
+    def peepsc(request):
+      return Presorted(
+        Statement(sa.select(persons.c.id).order_by(persons.c.age.desc()), model.engine),
+        'name')
+    self.assertEqual(
+      [row.id for row in peepsc(self.request(**{'page.sort': 'name'}))['result']],
+      [1, 4, 3, 2])
+
+  #----------------------------------------------------------------------------
+  def test_sqlalchemy_statement_timeout(self):
+    import sqlalchemy as sa
+    if not hasattr(sa.sql.Select, 'subquery'):
+      raise unittest.SkipTest('SQLAlchemy version does not support 2.0-style statements')
+    model = self.populate(self.makedb())
+    from .paginator import paginate
+    from .engine import Statement, StatementTimeout
+    @paginate(comparers=['id'], engine={'statement_timeout': 0.2}, decoder={'request_param': 'data'})
+    def peeps(request):
+      return model.session.query(model.Person.id)
+    self.assertEqual(
+      peeps(self.request(**{'page.limit': 2, 'page.sort': 'id'})),
+      dict(
+        page   = dict(offset=0, limit=2, count=4, sort='id', attribute='result'),
+        result = [(1,), (2,)]))
+    @paginate(engine={'statement_timeout': 0.2}, decoder={'request_param': 'data'})
+    def slow(request):
+      seq = sa.select(sa.literal(1).label('n')).cte('seq', recursive=True)
+      seq = seq.union_all(sa.select(seq.c.n + 1).where(seq.c.n < 100000000))
+      return Statement(sa.select(seq.c.n), request.data['bind'])
+    for bind in (model.engine, model.session):
+      with self.assertRaises(StatementTimeout) as cm:
+        slow(self.request(bind=bind))
+      self.assertEqual(cm.exception.timeout, 0.2)
+    # the connection must be usable again afterwards
+    self.assertEqual(model.session.query(model.Person).count(), 4)
+
+  #----------------------------------------------------------------------------
+  def test_sqlalchemy_multi_source(self):
+    model1 = self.populate(self.makedb())
+    model2 = self.makedb()
+    model2.session.add(model2.Person(id=1, name='beta', age=5))
+    model2.session.add(model2.Person(id=2, name='yota', age=3))
+    model2.session.commit()
+    from .paginator import paginate
+    from .engine import MultiSource
+    @paginate(comparers=['name', 'age'])
+    def peeps(request):
+      return MultiSource(
+        model1.session.query(model1.Person), model2.session.query(model2.Person))
+    self.assertEqual(
+      self.dictify(peeps(self.request(**{'page.limit': '3', 'page.offset': '1', 'page.sort': 'age'})), pluck='name'),
+      dict(
+        page   = dict(offset=1, limit=3, count=6, sort='age', attribute='result'),
+        result = ['yota', 'zeta', 'beta']))
+
+  #----------------------------------------------------------------------------
+  def test_sqlalchemy_sharded(self):
+    import os, shutil, tempfile, threading
+    import sqlalchemy as sa
+    from sqlalchemy.orm import sessionmaker
+    from .paginator import paginate
+    from .engine import ShardedQuery, StatementTimeout
+    tmpdir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmpdir)
+    model = self.makedb()
+    sessions = []
+    for shard in range(3):
+      engine = sa.create_engine(
+        'sqlite:///' + os.path.join(tmpdir, 'shard%d.db' % shard),
+        connect_args={'check_same_thread': False})
+      model.Person.metadata.create_all(engine)
+      session = sessionmaker(bind=engine)()
+      for num in range(shard, 30, 3):
+        session.add(model.Person(id=num, name='p%02d' % num, age=num % 7))
+      session.commit()
+      sessions.append(session)
+      self.addCleanup(session.close)
+      self.addCleanup(engine.dispose)
+    release = threading.Event()
+    self.addCleanup(release.set)
+    def stalled():
+      release.wait(10)
+      yield model.Person(id=99, name='stalled', age=0)
+    def failing():
+      raise ValueError('shard down')
+      yield
+    @paginate(comparers=['age', 'id'], engine={'shard_workers': 4}, decoder={'request_param': 'data'})
+    def peeps(request):
+      extra = request.data.get('extra')
+      return ShardedQuery(
+        *[session.query(model.Person) for session in sessions]
+          + ( [extra()] if extra else [] ),
+        timeout=request.data.get('timeout'), partial=request.data.get('partial', 'raise'))
+    self.assertEqual(
+      self.dictify(peeps(self.request(**{'page.offset': 8, 'page.limit': 5, 'page.sort': 'id-'})), pluck='id'),
+      dict(
+        page   = dict(offset=8, limit=5, count=30, sort='id-', attribute='result'),
+        result = [21, 20, 19, 18, 17]))
+    self.assertEqual(
+      self.dictify(peeps(self.request(**{'page.limit': 6, 'page.sort': 'age,id-'})), pluck='id'),
+      dict(
+        page   = dict(offset=0, limit=6, count=30, sort='age,id-', attribute='result'),
+        result = [28, 21, 14, 7, 0, 29]))
+    # abandoned shards (more than there are workers) do not block
+    # later requests, with or without a timeout
+    for idx in range(5):
+      with self.assertRaises(StatementTimeout):
+        peeps(self.request(**{'extra': stalled, 'timeout': 0.1}))
+    self.assertEqual(
+      peeps(self.request(**{'timeout': 5, 'page.limit': 1}))['page']['count'], 30)
+    self.assertEqual(peeps(self.request(**{'page.limit': 1}))['page']['count'], 30)
+    # ... but the number of threads for timed shards is bounded: shards
+    # that find none available fail (i.e. time out) right away
+    def sleepy():
+      release.wait(10)
+      yield dict(num=0)
+    @paginate(comparers=['num'], engine={'shard_threads': 3}, decoder={'request_param': 'data'})
+    def bounded(request):
+      return ShardedQuery(
+        *[sleepy() for idx in range(request.data['stalled'])]
+          + [[dict(num=1)], [dict(num=2)]],
+        timeout=0.1, partial='skip')
+    request = self.request(stalled=3)
+    self.assertEqual(bounded(request)['page']['count'], 0)
+    self.assertEqual(request.pagination.skipped_shards, (0, 1, 2, 3, 4))
+    request = self.request(stalled=0)
+    self.assertEqual(bounded(request)['page']['count'], 0)
+    self.assertEqual(request.pagination.skipped_shards, (0, 1))
+    release.set()
+    with self.assertRaises(ValueError):
+      peeps(self.request(**{'extra': failing}))
+    request = self.request(**{'extra': failing, 'partial': 'skip', 'page.limit': 2})
+    self.assertEqual(
+      self.dictify(peeps(request), pluck='id'),
+      dict(
+        page   = dict(offset=0, limit=2, count=30, attribute='result'),
+        result = [0, 7]))
+    self.assertEqual(request.pagination.skipped_shards, (3,))
+
+  #----------------------------------------------------------------------------
+  def test_sqlalchemy_telemetry(self):
+    model = self.populate(self.makedb())
+    from .paginator import paginate, Paginator
+    from .telemetry import Telemetry
+    telemetry = Telemetry()
+    persons = model.Person.__table__
+    pager = paginate(
+      comparers={'name': 'name', 'age': persons.c.age, 'custom': lambda pagination, query, method, ascending: query},
+      telemetry=telemetry)
+    @pager
+    def peeps(request):
+      return model.session.query(model.Person)
+    @pager
+    def listed(request):
+      return [dict(name='a', age=1)]
+    requests = (
+      ['name,age-'] * 6 + ['name'] * 2 + ['age-'] * 3 + ['age'] * 2
+      + ['custom'] * 3 + ['name-,age'] * 3 + ['age,name'])
+    for sort in requests:
+      peeps(self.request(**{'page.sort': sort, 'page.offset': '2000', 'page.limit': '5'}))
+    listed(self.request())
+    report = telemetry.report()
+    view = Paginator.view_name(peeps)
+    self.assertEqual(
+      sorted(report.keys()),
+      sorted([view, Paginator.view_name(listed)]))
+    stats = report[view]
+    self.assertEqual(stats['requests'], 20)
+    self.assertEqual((stats['kind'], stats['table']), ('orm', 'persons'))
+    self.assertEqual(stats['limits'], {5: 20})
+    self.assertEqual(stats['sorts']['name,age-'], 6)
+    self.assertEqual(stats['offsets']['buckets'][4], [10000, 20])
+    self.assertEqual(stats['apply_ms']['count'], 20)
+    self.assertEqual(
+      telemetry.recommend_indexes(min_share=0.1),
+      [
+        dict(view=view, table='persons', requests=11, share=0.55,
+             columns=[['name', 'ASC'], ['age', 'DESC']],
+             ddl='CREATE INDEX ix_persons_name_age ON persons (name, age DESC)'),
+        dict(view=view, table='persons', requests=5, share=0.25,
+             columns=[['age', 'DESC']],
+             ddl='CREATE INDEX ix_persons_age ON persons (age DESC)'),
+      ])
+    randoms = [0.7, 0.2, 0.9]
+    sampled = Telemetry(sample=0.5, random=lambda: randoms.pop(0))
+    @paginate(telemetry=sampled)
+    def few(request):
+      return [1, 2, 3]
+    for idx in range(3):
+      few(self.request())
+    self.assertEqual(list(sampled.report().values())[0]['requests'], 1)
+    capped = Telemetry(max_sorts=4)
+    @paginate(comparers=('a', 'b', 'c'), telemetry=capped)
+    def many(request):
+      return []
+    for sort in ['a', 'a-', 'b', 'b-', 'c', 'c-', 'a,b', 'a,b-', 'a-,b', 'a-,b-']:
+      many(self.request(**{'page.sort': sort}))
+    stats = list(capped.report().values())[0]
+    self.assertEqual(stats['sorts'], {'a': 1, 'a-': 1, 'b': 1, 'b-': 1, '*': 6})
+
+  #----------------------------------------------------------------------------
+  def test_sqlalchemy_count_cache(self):
+    import sqlalchemy as sa
+    model = self.populate(self.makedb())
+    from .paginator import paginate
+    from .cache import MemoryCache
+    cache = MemoryCache()
+    @paginate(engine={'count_cache': cache}, decoder={'request_param': 'data'})
+    def peeps(request):
+      return self.query(model, request, param='data')
+    counts = []
+    @sa.event.listens_for(model.engine, 'before_cursor_execute')
+    def _count(conn, cursor, statement, params, context, executemany):
+      if 'count(' in statement.lower():
+        counts.append(statement)
+    for offset in range(3):
+      self.assertEqual(
+        self.dictify(peeps(self.request(**{'page.offset': offset, 'page.limit': 1})), pluck='id'),
+        dict(
+          page   = dict(offset=offset, limit=1, count=4, attribute='result'),
+          result = [offset + 1]))
+    self.assertEqual(len(counts), 1)
+    self.assertEqual(peeps(self.request(minage=6))['page']['count'], 2)
+    self.assertEqual(len(counts), 2)
+    self.assertEqual(cache.stats()['hits'], 2)
+    # statements are only compiled once per structure
+    compiled = []
+    compile = sa.sql.ClauseElement.compile
+    def _compile(self, *args, **kw):
+      compiled.append(self)
+      return compile(self, *args, **kw)
+    sa.sql.ClauseElement.compile = _compile
+    try:
+      for minage in (2, 4, 2):
+        peeps(self.request(minage=minage))
+    finally:
+      sa.sql.ClauseElement.compile = compile
+    self.assertEqual(len(counts), 4)
+    if hasattr(sa.sql.ClauseElement, '_generate_cache_key'):
+      self.assertEqual(len(compiled), 0)
+
+  #----------------------------------------------------------------------------
+  def test_sqlalchemy_count_cache_shards(self):
+    import os, shutil, sqlite3, tempfile
+    import sqlalchemy as sa
+    from .paginator import paginate
+    from .engine import Statement, RawQuery
+    from .cache import Cache, MemoryCache
+    with self.assertRaises(TypeError):
+      Cache()
+    tmpdir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmpdir)
+    items = sa.table('items', sa.column('id'))
+    shards = []
+    for idx in range(2):
+      engine = sa.create_engine('sqlite:///' + os.path.join(tmpdir, '%d.db' % (idx,)))
+      with engine.begin() as conn:
+        conn.execute(sa.text('CREATE TABLE items (id INTEGER PRIMARY KEY)'))
+        for num in range(3 + idx):
+          conn.execute(sa.text('INSERT INTO items (id) VALUES (%d)' % (num,)))
+      shards.append(engine)
+    cache = MemoryCache()
+    @paginate(comparers=['id'], engine={'count_cache': cache})
+    def shard(request):
+      return Statement(sa.select(items.c.id), shards[int(request.params['shard'])])
+    for idx in (0, 1, 0, 1):
+      self.assertEqual(shard(self.request(shard=str(idx)))['page']['count'], 3 + idx)
+    self.assertEqual(cache.stats()['hits'], 2)
+    # raw SQL queries require a namespace to tell databases apart
+    dbs = [sqlite3.connect(os.path.join(tmpdir, '%d.db' % (idx,))) for idx in range(2)]
+    for db in dbs:
+      self.addCleanup(db.close)
+    @paginate(
+      comparers=['id'],
+      engine={'count_cache': cache,
+              'count_namespace': lambda pagination: pagination.request.params['shard']})
+    def raw(request):
+      return RawQuery('SELECT id FROM items', (), dbs[int(request.params['shard'])])
+    for idx in (0, 1, 0, 1):
+      self.assertEqual(raw(self.request(shard=str(idx)))['page']['count'], 3 + idx)
+    self.assertEqual(cache.stats()['hits'], 4)
+
+
+#------------------------------------------------------------------------------
+class TestDbapiPagination(unittest.TestCase):
+
+  maxDiff = None
+
+  #----------------------------------------------------------------------------
+  @staticmethod
+  def request(*args, **kw):
+    return TestListPagination.request(*args, **kw)
+
+  #----------------------------------------------------------------------------
+  def makedb(self):
+    import sqlite3
+    db = sqlite3.connect(':memory:')
+    db.execute('CREATE TABLE persons (id INTEGER PRIMARY KEY, name TEXT, age INTEGER)')
+    db.executemany(
+      'INSERT INTO persons (id, name, age) VALUES (?, ?, ?)',
+      [(1, 'zeta', 8), (2, 'delt', 2), (3, 'zeta', 4), (4, 'acrn', 6)])
+    db.commit()
+    return db
+
+  #----------------------------------------------------------------------------
+  def test_dbapi(self):
+    db = self.makedb()
+    from .paginator import paginate
+    from .engine import RawQuery
+    @paginate(sort_default='name,age-', comparers=['name', 'age'])
+    def peeps(request):
+      return RawQuery(
+        'SELECT id, name FROM persons WHERE age >= ?',
+        (int(request.params.get('minage', 0)),), db, batch_size=2)
+    self.assertEqual(
+      peeps(self.request()),
+      dict(
+        page   = dict(offset=0, limit=25, count=4, attribute='result'),
+        result = ((4, 'acrn'), (2, 'delt'), (1, 'zeta'), (3, 'zeta'))))
+    self.assertEqual(
+      peeps(self.request(**{'page.sort': 'age', 'page.offset': '1', 'page.limit': '2'})),
+      dict(
+        page   = dict(offset=1, limit=2, count=4, sort='age', attribute='result'),
+        result = ((3, 'zeta'), (4, 'acrn'))))
+    self.assertEqual(
+      peeps(self.request(**{'minage': '4', 'page.offset': '1', 'page.limit': '0'})),
+      dict(
+        page   = dict(offset=1, limit=0, count=3, attribute='result'),
+        result = ((1, 'zeta'), (3, 'zeta'))))
+
+  #----------------------------------------------------------------------------
+  def test_dbapi_streaming(self):
+    db = self.makedb()
+    from .paginator import paginate
+    from .engine import RawQuery
+    @paginate(force_list=False, comparers=['id'], decoder={'request_param': 'data'})
+    def peeps(request):
+      return RawQuery('SELECT id FROM persons', connection=db, nolimit='LIMIT -1')
+    ret = peeps(self.request(**{'page.offset': 2, 'page.limit': 0}))
+    self.assertIsInstance(ret['result'], types.GeneratorType)
+    self.assertEqual(list(ret['result']), [(3,), (4,)])
+
 #------------------------------------------------------------------------------
 # end of $Id$
 #------------------------------------------------------------------------------
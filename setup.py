@@ -22,18 +22,24 @@ def read(*parts, **kw):
 test_dependencies = [
   'nose                 >= 1.3.0',
   'coverage             >= 3.5.3',
+  'FormEncode           >= 1.3.0',
+  'SQLAlchemy           >= 0.8.2',
+  'aadict               >= 0.2.2',
 ]
 
 dependencies = [
   'pyramid              >= 1.4.2',
   'six                  >= 1.6.1',
-  'aadict               >= 0.2.2',
   'morph                >= 0.1.2',
-  'FormEncode           >= 1.2.5',
-  'SQLAlchemy           >= 0.8.2',
 ]
 
 extras_dependencies = {
+  'formencode': [
+    'FormEncode           >= 1.3.0',
+  ],
+  'sqlalchemy': [
+    'SQLAlchemy           >= 0.8.2',
+  ],
 }
 
 entrypoints = {